@@ -5,87 +5,814 @@ import time
 import requests
 import re
 import math
+import random
+import base64
+import zlib
+import csv
+import io
+import codecs
+import hmac
+import ipaddress
+import select
+import unicodedata
+from datetime import datetime
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import psycopg2 
+import psycopg2.pool
+import psycopg2.errors
+import psycopg2.extensions
+from psycopg2.extras import execute_values
+from contextlib import contextmanager
+from functools import wraps
 from urllib.parse import urlparse 
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template, g, has_request_context, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 from flask_bcrypt import Bcrypt 
 from flask_jwt_extended import create_access_token, get_jwt_identity, jwt_required, JWTManager 
+try:
+    import orjson   # sérialiseur rapide pour les réponses en flux ; json de la stdlib sinon
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 load_dotenv() 
 
 # --- 1. Configuration ---
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['ETag', 'X-Curseur-Suivant'])
 
 # --- CONFIGURATION DE LA SÉCURITÉ ---
 app.config["JWT_SECRET_KEY"] = "ton-super-secret-jwt-change-moi"
 bcrypt = Bcrypt(app)
 jwt = JWTManager(app)
 
+# bcrypt est CPU-bound : hachage et vérification passent par un pool borné de VRAIS threads (le GIL est relâché
+# pendant le calcul), pour ne bloquer ni la boucle gevent ni plus de BCRYPT_THREADS cœurs à la fois.
+BCRYPT_THREADS = int(os.environ.get('BCRYPT_THREADS', 4))
+POOL_BCRYPT = None
+POOL_BCRYPT_PID = None
+
+def mode_cooperatif():
+    """Vrai sous gunicorn -k gevent (voir gunicorn.conf.py) : les I/O bloquantes deviennent coopératives."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+def executer_bcrypt(fonction, *args):
+    global POOL_BCRYPT, POOL_BCRYPT_PID
+    if POOL_BCRYPT is None or POOL_BCRYPT_PID != os.getpid():
+        if mode_cooperatif():
+            from gevent.threadpool import ThreadPool
+            POOL_BCRYPT = ThreadPool(BCRYPT_THREADS)
+        else:
+            POOL_BCRYPT = ThreadPoolExecutor(max_workers=BCRYPT_THREADS, thread_name_prefix='bcrypt')
+        POOL_BCRYPT_PID = os.getpid()
+    if mode_cooperatif():
+        return POOL_BCRYPT.apply(fonction, args)
+    return POOL_BCRYPT.submit(fonction, *args).result()
+
 # --- CONFIGURATION IA ---
 API_KEY = os.environ.get("GEMINI_API_KEY") 
 if not API_KEY:
     print("ERREUR FATALE : GEMINI_API_KEY n'est pas définie.")
 IA_MODEL_NAME = "gemini-pro-latest" 
-IA_API_URL = f"https://generativelanguage.googleapis.com/v1beta/models/{IA_MODEL_NAME}:generateContent?key={API_KEY}"
+# Surchargeable pour pointer vers un faux serveur local (tests, benchmarks)
+IA_API_URL = os.environ.get('IA_API_URL') or f"https://generativelanguage.googleapis.com/v1beta/models/{IA_MODEL_NAME}:generateContent?key={API_KEY}"
 print(f"Configuration IA : Prêt à appeler {IA_MODEL_NAME} via v1beta.")
-IA_COOLDOWN_SECONDS = 31
-LAST_IA_CALL_TIME = 0
+IA_APPELS_PAR_MINUTE = float(os.environ.get('IA_APPELS_PAR_MINUTE', 60 / 31))
+IA_RAFALE = int(os.environ.get('IA_RAFALE', 1))
+IA_APPELS_PAR_JOUR = int(os.environ.get('IA_APPELS_PAR_JOUR', 1500))   # 0 = pas de quota journalier
+IA_LIBELLES_PAR_UTILISATEUR_JOUR = int(os.environ.get('IA_LIBELLES_PAR_UTILISATEUR_JOUR', 0))   # 0 = illimité
+IA_LIMITEUR_ATTENTE_MAX_SECONDS = 60
+IA_TIMEOUT_SECONDS = float(os.environ.get('IA_TIMEOUT_SECONDS', 30))   # lecture
+IA_CONNECT_TIMEOUT_SECONDS = float(os.environ.get('IA_CONNECT_TIMEOUT_SECONDS', 5))
+IA_HTTP_TENTATIVES = int(os.environ.get('IA_HTTP_TENTATIVES', 3))   # par appel, sur 429 / 5xx / réseau
+IA_BACKOFF_BASE_SECONDS = 1
+IA_BACKOFF_MAX_SECONDS = 30
+IA_DISJONCTEUR_SEUIL = int(os.environ.get('IA_DISJONCTEUR_SEUIL', 5))   # appels en échec consécutifs avant ouverture
+IA_DISJONCTEUR_PAUSE_SECONDS = float(os.environ.get('IA_DISJONCTEUR_PAUSE_SECONDS', 60))
+IA_MAX_TENTATIVES = 3
+IA_TAILLE_LOT = int(os.environ.get('IA_TAILLE_LOT', 20))
+IA_QUEUE_POLL_SECONDS = 5
+IA_QUEUE_BAIL_SECONDS = 300   # une tâche EN_COURS plus vieille que ça (worker mort) est reprise
+IA_LONG_POLL_MAX_SECONDS = 20
+
+CATEGORIES_VALIDES = [
+    "Charges Fixes", "Alimentation", "Abonnements", "Sorties",
+    "Shopping", "Santé", "Transport", "Épargne", "Autres"
+]
+
+# --- MÉTRIQUES (format Prometheus) ---
+# /metrics et /api/stats/db : jeton « Authorization: Bearer » si défini, sinon accès depuis la machine locale uniquement
+METRIQUES_TOKEN = os.environ.get('METRIQUES_TOKEN')
+METRIQUES_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metriques:
+    """Compteurs et histogrammes en mémoire, exportés au format texte Prometheus.
+
+    Comme /api/stats/db, les valeurs sont PAR WORKER : le label `pid` distingue les processus.
+    """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._types = {}
+        self._series = {}
+
+    def declarer(self, nom, type_metrique, aide):
+        self._types[nom] = (type_metrique, aide)
+
+    def incrementer(self, nom, valeur=1, **labels):
+        cle = (nom, tuple(sorted(labels.items())))
+        with self._lock:
+            self._series[cle] = self._series.get(cle, 0) + valeur
+
+    def observer(self, nom, valeur, **labels):
+        cle = (nom, tuple(sorted(labels.items())))
+        with self._lock:
+            serie = self._series.get(cle)
+            if serie is None:
+                serie = self._series[cle] = [0] * len(self.buckets) + [0, 0.0]
+            for i, borne in enumerate(self.buckets):
+                if valeur <= borne:
+                    serie[i] += 1
+            serie[-2] += 1
+            serie[-1] += valeur
+
+    @contextmanager
+    def chronometre(self, nom, **labels):
+        debut = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observer(nom, time.perf_counter() - debut, **labels)
+
+    def exporter(self, jauges=()):
+        """Texte d'exposition Prometheus ; `jauges` : (nom, aide, valeur) calculées au moment du scrape."""
+        pid = str(os.getpid())
+        echapper = lambda valeur: str(valeur).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        formater = lambda labels: '{' + ','.join(f'{cle}="{echapper(valeur)}"' for cle, valeur in labels) + '}'
+        with self._lock:
+            series = sorted((cle, list(v) if isinstance(v, list) else v) for cle, v in self._series.items())
+        lignes = []
+        for nom, aide, valeur in jauges:
+            lignes += [f"# HELP {nom} {aide}", f"# TYPE {nom} gauge", f"{nom}{formater((('pid', pid),))} {valeur}"]
+        dernier_nom = None
+        for (nom, labels), valeur in series:
+            type_metrique, aide = self._types.get(nom, ('untyped', ''))
+            if nom != dernier_nom:
+                lignes += [f"# HELP {nom} {aide}", f"# TYPE {nom} {type_metrique}"]
+                dernier_nom = nom
+            labels = (('pid', pid),) + labels
+            if type_metrique != 'histogram':
+                lignes.append(f"{nom}{formater(labels)} {valeur}")
+                continue
+            for borne, compte in zip(self.buckets, valeur):
+                lignes.append(f"{nom}_bucket{formater(labels + (('le', borne),))} {compte}")
+            lignes.append(f"{nom}_bucket{formater(labels + (('le', '+Inf'),))} {valeur[-2]}")
+            lignes.append(f"{nom}_sum{formater(labels)} {valeur[-1]}")
+            lignes.append(f"{nom}_count{formater(labels)} {valeur[-2]}")
+        return "\n".join(lignes) + "\n"
+
+METRIQUES = Metriques(METRIQUES_BUCKETS)
+for _nom, _type, _aide in (
+    ('copilote_requete_duree_secondes', 'histogram', "Durée des requêtes HTTP par route"),
+    ('copilote_db_attente_connexion_secondes', 'histogram', "Attente d'une connexion du pool, par route"),
+    ('copilote_db_utilisation_connexion_secondes', 'histogram', "Durée d'emprunt d'une connexion (requêtes SQL comprises), par route"),
+    ('copilote_classifications_total', 'counter', "Libellés classés à la requête, par niveau (regle_perso, regle_generale, modele_local, file_ia)"),
+    ('copilote_classification_etape_secondes', 'histogram', "Durée de chaque étape de classification"),
+    ('copilote_llm_appels_total', 'counter', "Appels au LLM par résultat (succes, erreur, disjoncteur)"),
+    ('copilote_llm_appel_duree_secondes', 'histogram', "Durée d'un appel LLM (retries compris)"),
+    ('copilote_llm_libelles_total', 'counter', "Libellés traités par le LLM par résultat (categorise, a_verifier, erreur)"),
+    ('copilote_llm_attente_limiteur_secondes', 'histogram', "Attente du limiteur partagé avant un appel LLM"),
+):
+    METRIQUES.declarer(_nom, _type, _aide)
+
+def route_courante():
+    return (request.endpoint or 'inconnue') if has_request_context() else 'arriere_plan'
 
 # --- CONFIGURATION BDD ---
 DATABASE_URL = os.environ.get('DATABASE_URL')
 if not DATABASE_URL:
     print("ERREUR FATALE : DATABASE_URL n'est pas définie.")
 
+# Pool dimensionné PAR WORKER gunicorn : workers × DB_POOL_MAX doit rester sous max_connections de Postgres.
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 4))
+DB_POOL_TIMEOUT_SECONDS = float(os.environ.get('DB_POOL_TIMEOUT_SECONDS', 10))
+DB_HEALTHCHECK_IDLE_SECONDS = float(os.environ.get('DB_HEALTHCHECK_IDLE_SECONDS', 30))
+
+def attendre_gevent(conn, timeout=None):
+    """Callback d'attente psycopg2 en mode gevent : une requête SQL rend la main aux autres greenlets au lieu de bloquer le worker."""
+    from gevent.socket import wait_read, wait_write
+    while True:
+        etat = conn.poll()
+        if etat == psycopg2.extensions.POLL_OK:
+            return
+        if etat == psycopg2.extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif etat == psycopg2.extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"Résultat de poll() inattendu : {etat!r}")
+
+if mode_cooperatif():
+    psycopg2.extensions.set_wait_callback(attendre_gevent)
+    print("Mode gevent : Postgres et HTTP sortant coopératifs, bcrypt dans un pool de threads natifs.")
+
+class PoolConnexions:
+    """Pool de connexions Postgres thread-safe, créé paresseusement dans chaque processus (compatible fork gunicorn).
+
+    Les connexions restées inactives plus de `idle_check` secondes sont vérifiées par un `SELECT 1`
+    avant d'être prêtées ; une connexion morte est jetée et remplacée.
+    """
+
+    def __init__(self, dsn, minconn, maxconn, timeout, idle_check):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.idle_check = idle_check
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self._places = None
+        self._derniere_utilisation = {}
+        self._stats = {}
+
+    def _initialiser(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                return
+            # Après un fork, les sockets héritées du parent ne doivent pas être réutilisées
+            self._pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, self.dsn)
+            self._pid = os.getpid()
+            self._places = threading.BoundedSemaphore(self.maxconn)
+            self._derniere_utilisation = {}
+            self._stats = {
+                'checkouts': 0, 'en_cours': 0, 'pic_en_cours': 0, 'timeouts': 0,
+                'connexions_remplacees': 0, 'attente_totale_s': 0.0, 'attente_max_s': 0.0,
+            }
+
+    def _verifier(self, conn):
+        if conn.closed:
+            return False
+        derniere_utilisation = self._derniere_utilisation.get(id(conn))
+        if derniere_utilisation is None or time.monotonic() - derniere_utilisation < self.idle_check:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @contextmanager
+    def connexion(self):
+        if self._pool is None or self._pid != os.getpid():
+            self._initialiser()
+        debut = time.perf_counter()
+        if not self._places.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats['timeouts'] += 1
+            raise psycopg2.pool.PoolError(f"Aucune connexion disponible après {self.timeout}s")
+        attente = time.perf_counter() - debut
+        conn = None
+        try:
+            conn = self._pool.getconn()
+            if not self._verifier(conn):
+                self._pool.putconn(conn, close=True)
+                # Déjà rendue : si le getconn suivant échoue, le finally ne doit pas la rendre une seconde fois
+                conn = None
+                conn = self._pool.getconn()
+                with self._lock:
+                    self._stats['connexions_remplacees'] += 1
+            METRIQUES.observer('copilote_db_attente_connexion_secondes', attente, route=route_courante())
+            debut_utilisation = time.perf_counter()
+            with self._lock:
+                self._stats['checkouts'] += 1
+                self._stats['en_cours'] += 1
+                self._stats['pic_en_cours'] = max(self._stats['pic_en_cours'], self._stats['en_cours'])
+                self._stats['attente_totale_s'] += attente
+                self._stats['attente_max_s'] = max(self._stats['attente_max_s'], attente)
+            try:
+                yield conn
+            finally:
+                with self._lock:
+                    self._stats['en_cours'] -= 1
+                # Une transaction laissée ouverte (exception, oubli de commit) ne doit pas fuiter vers l'emprunteur suivant
+                if not conn.closed:
+                    try:
+                        conn.rollback()
+                    except psycopg2.Error:
+                        pass
+                self._derniere_utilisation[id(conn)] = time.monotonic()
+                METRIQUES.observer('copilote_db_utilisation_connexion_secondes', time.perf_counter() - debut_utilisation, route=route_courante())
+                self._pool.putconn(conn, close=bool(conn.closed))
+                conn = None
+        finally:
+            if conn is not None:
+                self._pool.putconn(conn, close=True)
+            self._places.release()
+
+    def stats(self):
+        if self._pool is None:
+            return {'pid': os.getpid(), 'taille_max': self.maxconn, 'initialise': False}
+        with self._lock:
+            stats = dict(self._stats)
+        checkouts = stats['checkouts'] or 1
+        stats['attente_moyenne_ms'] = round(stats['attente_totale_s'] / checkouts * 1000, 3)
+        stats['attente_max_ms'] = round(stats.pop('attente_max_s') * 1000, 3)
+        stats.pop('attente_totale_s')
+        stats.update({'pid': self._pid, 'taille_max': self.maxconn, 'initialise': True})
+        return stats
+
+DB_POOL = PoolConnexions(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT_SECONDS, DB_HEALTHCHECK_IDLE_SECONDS)
+
 def get_db_connection():
-    conn = psycopg2.connect(DATABASE_URL)
-    return conn
+    """À utiliser avec `with` : la connexion est rendue au pool (et la transaction annulée si non commitée) en sortie."""
+    return DB_POOL.connexion()
 
-# --- 2. Initialisation BDD ---
-def init_db():
+# --- CACHE DES RÈGLES GÉNÉRALES (Aho-Corasick) ---
+REGLES_GENERALES_REFRESH_SECONDS = 30
+
+class MatcheurMotsCles:
+    """Automate d'Aho-Corasick : trouve en une seule passe le mot-clé le plus long contenu dans un libellé.
+
+    En cas d'égalité de longueur, c'est le mot-clé de plus petit `ordre` (le plus ancien) qui gagne.
+    Les ajouts se font dans le trie ; les liens d'échec sont recalculés au prochain appel à `rechercher`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._transitions = [{}]
+        self._echecs = [0]
+        self._terminaux = [None]   # (longueur, ordre, valeur) du mot-clé se terminant sur ce nœud
+        self._meilleurs = [None]   # meilleur terminal atteignable via les liens d'échec
+        self._a_compiler = False
+
+    def __len__(self):
+        return sum(1 for terminal in self._terminaux if terminal is not None)
+
+    def nombre_noeuds(self):
+        return len(self._transitions)
+
+    @staticmethod
+    def _prioritaire(a, b):
+        if a is None: return b
+        if b is None: return a
+        if a[0] != b[0]: return a if a[0] > b[0] else b
+        return a if a[1] <= b[1] else b
+
+    def ajouter(self, mot_cle, valeur, ordre=0):
+        if not mot_cle:
+            return False
+        with self._lock:
+            noeud = 0
+            for caractere in mot_cle:
+                suivant = self._transitions[noeud].get(caractere)
+                if suivant is None:
+                    suivant = len(self._transitions)
+                    self._transitions[noeud][caractere] = suivant
+                    self._transitions.append({})
+                    self._echecs.append(0)
+                    self._terminaux.append(None)
+                    self._meilleurs.append(None)
+                noeud = suivant
+            # Même sémantique que ON CONFLICT DO NOTHING : la première règle enregistrée est conservée
+            if self._terminaux[noeud] is not None:
+                return False
+            self._terminaux[noeud] = (len(mot_cle), ordre, valeur)
+            self._a_compiler = True
+            return True
+
+    def _compiler(self):
+        file_attente = deque()
+        self._meilleurs[0] = self._terminaux[0]
+        for enfant in self._transitions[0].values():
+            self._echecs[enfant] = 0
+            self._meilleurs[enfant] = self._terminaux[enfant]
+            file_attente.append(enfant)
+        while file_attente:
+            noeud = file_attente.popleft()
+            for caractere, enfant in self._transitions[noeud].items():
+                echec = self._echecs[noeud]
+                while echec and caractere not in self._transitions[echec]:
+                    echec = self._echecs[echec]
+                echec = self._transitions[echec].get(caractere, 0)
+                self._echecs[enfant] = echec if echec != enfant else 0
+                self._meilleurs[enfant] = self._prioritaire(self._terminaux[enfant], self._meilleurs[self._echecs[enfant]])
+                file_attente.append(enfant)
+        self._a_compiler = False
+
+    def rechercher(self, texte):
+        with self._lock:
+            if self._a_compiler:
+                self._compiler()
+            transitions, echecs, meilleurs = self._transitions, self._echecs, self._meilleurs
+            noeud = 0
+            meilleur = None
+            for caractere in texte:
+                while noeud and caractere not in transitions[noeud]:
+                    noeud = echecs[noeud]
+                noeud = transitions[noeud].get(caractere, 0)
+                meilleur = self._prioritaire(meilleur, meilleurs[noeud])
+        return meilleur[2] if meilleur else None
+
+MATCHEUR_REGLES_GENERALES = MatcheurMotsCles()
+DERNIER_ID_REGLE_GENERALE = 0
+NOMBRE_REGLES_GENERALES_CHARGEES = 0   # règles d'id <= DERNIER_ID_REGLE_GENERALE présentes dans l'automate
+DERNIER_RAFRAICHISSEMENT_REGLES = 0
+DERNIER_CHARGEMENT_COMPLET_REGLES = 0
+REGLES_GENERALES_RECHARGEMENT_COMPLET_SECONDS = 600
+
+def rafraichir_regles_generales(force=False):
+    """Charge dans l'automate les règles générales ajoutées depuis le dernier chargement (y compris par les autres workers).
+
+    Les id sont attribués à l'insertion mais validés dans le désordre : si le nombre de règles d'id <= au dernier id
+    chargé ne correspond plus (id validé en retard, suppression), l'automate est reconstruit entièrement. Il l'est
+    aussi périodiquement, pour les renommages faits par `normaliser-regles`.
+    """
+    global MATCHEUR_REGLES_GENERALES, DERNIER_ID_REGLE_GENERALE, NOMBRE_REGLES_GENERALES_CHARGEES
+    global DERNIER_RAFRAICHISSEMENT_REGLES, DERNIER_CHARGEMENT_COMPLET_REGLES
+    if not force and time.time() - DERNIER_RAFRAICHISSEMENT_REGLES < REGLES_GENERALES_REFRESH_SECONDS:
+        return
+    complet = time.time() - DERNIER_CHARGEMENT_COMPLET_REGLES >= REGLES_GENERALES_RECHARGEMENT_COMPLET_SECONDS
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Table utilisateurs
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS utilisateurs (
-            id SERIAL PRIMARY KEY,
-            email TEXT NOT NULL UNIQUE,
-            password_hash TEXT NOT NULL
-        )
-        """)
-        
-        # Table règles générales
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS regles_generales (
-            id SERIAL PRIMARY KEY,
-            mot_cle TEXT NOT NULL UNIQUE,
-            libelle_nettoye TEXT NOT NULL,
-            categorie TEXT NOT NULL,
-            sous_categorie TEXT NOT NULL
-        )
-        """)
-        
-        # Table règles personnelles
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            if not complet:
+                cursor.execute("SELECT COUNT(*) FROM regles_generales WHERE id <= %s", (DERNIER_ID_REGLE_GENERALE,))
+                complet = cursor.fetchone()[0] != NOMBRE_REGLES_GENERALES_CHARGEES
+            cursor.execute(
+                "SELECT id, mot_cle, libelle_nettoye, categorie, sous_categorie FROM regles_generales WHERE id > %s ORDER BY id",
+                (0 if complet else DERNIER_ID_REGLE_GENERALE,)
+            )
+            rows = cursor.fetchall()
+            cursor.close()
+    except Exception as e:
+        print(f"Erreur BDD (chargement des règles générales) : {e}")
+        return
+    matcheur = MatcheurMotsCles() if complet else MATCHEUR_REGLES_GENERALES
+    for regle_id, mot_cle, libelle_nettoye, categorie, sous_categorie in rows:
+        matcheur.ajouter(mot_cle, (libelle_nettoye, categorie, sous_categorie), ordre=regle_id)
+    if complet:
+        # Échange d'un bloc : les requêtes en cours gardent l'ancien automate, cohérent
+        MATCHEUR_REGLES_GENERALES = matcheur
+        DERNIER_ID_REGLE_GENERALE = rows[-1][0] if rows else 0
+        NOMBRE_REGLES_GENERALES_CHARGEES = len(rows)
+        DERNIER_CHARGEMENT_COMPLET_REGLES = time.time()
+    elif rows:
+        DERNIER_ID_REGLE_GENERALE = rows[-1][0]
+        NOMBRE_REGLES_GENERALES_CHARGEES += len(rows)
+    MODELE_LOCAL.apprendre_regles([(regle_id, mot_cle, categorie) for regle_id, mot_cle, _, categorie, _ in rows])
+    DERNIER_RAFRAICHISSEMENT_REGLES = time.time()
+    if rows:
+        print(f"--- 🔎 {len(rows)} règle(s) générale(s) compilée(s){' (rechargement complet)' if complet else ''} ({len(matcheur)} au total) ---")
+
+# --- NORMALISATION DES LIBELLÉS ---
+# "CB CARREFOUR 1203 PARIS 12" et "CARTE X4587 03/12 CARREFOUR" doivent donner la même clé : "CARREFOUR".
+PREFIXES_PAIEMENT = [p.split() for p in (
+    'PAIEMENT PAR CARTE', 'PAIEMENT CB', 'ACHAT CB', 'FACTURE CARTE', 'CARTE', 'CB',
+    'PRLV SEPA', 'PRLV', 'PRELEVEMENT SEPA', 'PRELEVEMENT',
+    'VIR SEPA RECU', 'VIR SEPA EMIS', 'VIR SEPA', 'VIR INST', 'VIREMENT SEPA', 'VIREMENT', 'VIR',
+    'RETRAIT DAB', 'RETRAIT', 'ECHEANCE', 'ACHAT', 'PAIEMENT',
+)]
+MOTS_VIDES_INITIAUX = {'DU', 'AU', 'LE', 'LA', 'DE', 'DES', 'A'}
+# Mots traités comme des numéros : ils séparent la clé marchand du reste du libellé
+MOTS_SEPARATEURS = {
+    'REF', 'REFERENCE', 'FACTURE', 'NUM', 'NO', 'ECH', 'MANDAT',
+    'JANVIER', 'FEVRIER', 'MARS', 'AVRIL', 'MAI', 'JUIN', 'JUILLET', 'AOUT', 'SEPTEMBRE', 'OCTOBRE', 'NOVEMBRE', 'DECEMBRE',
+    'JANV', 'FEV', 'AVR', 'JUIL', 'SEPT', 'OCT', 'NOV', 'DEC',
+}
+NORMALISATION_MAX_MOTS = 4
+NORMALISATION_LONGUEUR_MIN = 3
+REGEX_DATE = re.compile(r'\b\d{1,4}[/.\-]\d{1,2}(?:[/.\-]\d{2,4})?\b')
+REGEX_MONTANT = re.compile(r'\b\d+[.,]\d{2}\b\s*(?:EUR\b|€)?')
+REGEX_NON_ALPHANUM = re.compile(r'[^A-Z0-9]+')
+
+SEPARATEUR_NUMERIQUE = ' 0 '   # une date ou un montant coupe le libellé comme n'importe quel numéro
+
+def normaliser_libelle(libelle):
+    """Construit la clé marchand canonique d'un libellé bancaire.
+
+    Supprime accents et préfixes de paiement ; dates, montants et numéros (magasin, carte, référence) servent de
+    séparateurs, et le premier groupe de mots sans chiffres est gardé. Si le résultat est trop court pour être
+    une règle fiable, le libellé complet nettoyé est retourné. Idempotente : normaliser une clé la redonne.
+    """
+    cle = cle_marchand(libelle)
+    # Le repli (libellé complet) peut lui-même contenir une clé : on itère jusqu'au point fixe (2 passes au plus)
+    for _ in range(3):
+        suivante = cle_marchand(cle)
+        if suivante == cle:
+            break
+        cle = suivante
+    return cle
+
+def cle_marchand(libelle):
+    texte = unicodedata.normalize('NFKD', libelle.upper()).encode('ascii', 'ignore').decode('ascii')
+    texte_complet = ' '.join(REGEX_NON_ALPHANUM.sub(' ', texte).split())
+    # Montants d'abord : « 45.20 EUR » ne doit pas être pris pour une date (laissant « EUR »)
+    texte = REGEX_DATE.sub(SEPARATEUR_NUMERIQUE, REGEX_MONTANT.sub(SEPARATEUR_NUMERIQUE, texte))
+    mots = REGEX_NON_ALPHANUM.sub(' ', texte).split()
+
+    # Préfixes et mots vides initiaux retirés ensemble : « DE CARTE FOO » ne doit pas garder « CARTE »
+    mot_retire = True
+    while mot_retire and mots:
+        mot_retire = False
+        if mots[0] in MOTS_VIDES_INITIAUX:
+            mots = mots[1:]
+            mot_retire = True
+            continue
+        for prefixe in PREFIXES_PAIEMENT:
+            if mots[:len(prefixe)] == prefixe:
+                mots = mots[len(prefixe):]
+                mot_retire = True
+                break
+
+    cle = []
+    for mot in mots:
+        if mot in MOTS_SEPARATEURS or any(c.isdigit() for c in mot):
+            if cle:
+                break
+            continue
+        if not cle and mot in MOTS_VIDES_INITIAUX:
+            continue
+        cle.append(mot)
+        if len(cle) >= NORMALISATION_MAX_MOTS:
+            break
+    cle = ' '.join(cle)
+    return cle if len(cle) >= NORMALISATION_LONGUEUR_MIN else (texte_complet or libelle.upper())
+
+def texte_de_recherche(libelle):
+    """Texte passé aux matchers : clé canonique + libellé brut, pour que les anciennes règles (libellés complets)
+    comme les nouvelles (clés canoniques) continuent de correspondre. Le saut de ligne empêche un mot-clé
+    de chevaucher les deux parties."""
+    return f"{normaliser_libelle(libelle)}\n{libelle.upper()}"
+
+# --- MODÈLE LOCAL (Bayes naïf sur n-grammes de caractères) ---
+# Niveau intermédiaire entre les règles et le LLM : rattrape les fautes de frappe et variantes de marchands.
+MODELE_LOCAL_DIMENSION = 2 ** 17   # n-grammes hachés (pas de vocabulaire à maintenir, apprentissage incrémental)
+MODELE_LOCAL_SEUIL = float(os.environ.get('MODELE_LOCAL_SEUIL', 0.9))   # probabilité a posteriori minimale
+MODELE_LOCAL_COUVERTURE_MIN = 0.6   # part des n-grammes du libellé déjà vus à l'entraînement
+MODELE_LOCAL_MIN_EXEMPLES = 50
+MODELE_LOCAL_RECHARGEMENT_SECONDS = 3600
+MODELE_LOCAL_CATEGORIES = CATEGORIES_VALIDES + ['Revenus']   # vocabulaire fermé : tout autre libellé de catégorie est ignoré
+MODELE_LOCAL_REESSAI_SECONDS = 60   # après un entraînement en échec (BDD indisponible)
+MODELE_LOCAL_MAX_TRANSACTIONS = 100000
+
+class ModeleLocal:
+    """Bayes naïf multinomial, NumPy : une ligne de comptes de n-grammes par catégorie.
+
+    Entraîné sur les règles générales et les transactions validées par les utilisateurs (methode 'Utilisateur'),
+    puis enrichi au fil de l'eau ; réentraîné entièrement toutes les heures pour intégrer les validations faites
+    dans les autres workers. L'entraînement (lecture BDD + hachage) tourne dans un thread d'arrière-plan et le
+    nouvel état est échangé d'un bloc : predire ne fait jamais d'I/O ni de calcul d'entraînement (il s'abstient
+    tant que le premier entraînement n'est pas terminé). Ne répond que si la probabilité dépasse le seuil ET
+    si le libellé ressemble à quelque chose de connu (couverture), sinon le LLM reste le dernier recours.
+    """
+
+    def __init__(self, dimension, categories, alpha=0.1):
+        self.dimension = dimension
+        self.alpha = alpha
+        # Catégories fixées à la construction : matrice préallouée, et les noms de catégories libres d'un
+        # utilisateur (PUT / PATCH) ne deviennent jamais des prédictions pour les autres
+        self.categories = list(categories)
+        self._index_categories = {categorie: i for i, categorie in enumerate(self.categories)}
+        self._lock = threading.Lock()
+        self._etat = self._etat_vide()   # (comptes, totaux, exemples), remplacé d'un bloc
+        self.dernier_id_regle = 0
+        self._charge_le = None
+        self._echec_le = 0
+        self._entrainement_pid = None   # processus où un entraînement est en cours (None = aucun)
+        self._apprentissages_recents = []   # (regle_id ou None, libelle, categorie) reçus pendant l'entraînement
+
+    def _etat_vide(self):
+        n = len(self.categories)
+        return np.zeros((n, self.dimension), dtype=np.float32), np.zeros(n, dtype=np.float64), np.zeros(n, dtype=np.float64)
+
+    def _caracteristiques(self, libelle):
+        cle = normaliser_libelle(libelle)
+        texte = f" {cle} "
+        grammes = [texte[i:i + n] for n in (3, 4, 5) for i in range(len(texte) - n + 1)] + ['#' + mot for mot in cle.split()]
+        hashes = np.fromiter((zlib.crc32(gramme.encode('utf-8')) for gramme in grammes), dtype=np.int64, count=len(grammes))
+        return np.unique(hashes % self.dimension, return_counts=True)
+
+    def _apprendre(self, etat, libelle, categorie):
+        """Ajoute un exemple à `etat` (sur place) ; une catégorie hors vocabulaire est ignorée."""
+        c = self._index_categories.get(categorie)
+        if c is None:
+            return etat
+        comptes, totaux, exemples = etat
+        indices, nombres = self._caracteristiques(libelle)
+        comptes[c, indices] += nombres
+        totaux[c] += nombres.sum()
+        exemples[c] += 1
+        return etat
+
+    def apprendre(self, libelle, categorie):
+        if categorie not in self._index_categories:
+            return
+        with self._lock:
+            if self._charge_le is not None:
+                self._etat = self._apprendre(self._etat, libelle, categorie)
+            if self._entrainement_pid == os.getpid():
+                self._apprentissages_recents.append((None, libelle, categorie))
+
+    def apprendre_regles(self, regles):
+        """regles : (id, mot_cle, categorie) ; ignore celles déjà intégrées lors de l'entraînement complet."""
+        with self._lock:
+            for regle_id, mot_cle, categorie in regles:
+                if categorie not in self._index_categories:
+                    continue
+                if self._entrainement_pid == os.getpid():
+                    self._apprentissages_recents.append((regle_id, mot_cle, categorie))
+                if self._charge_le is not None and regle_id > self.dernier_id_regle:
+                    self._etat = self._apprendre(self._etat, mot_cle, categorie)
+                    self.dernier_id_regle = regle_id
+
+    def _planifier_entrainement(self):
+        """À appeler sous self._lock : lance l'entraînement en arrière-plan s'il est dû et pas déjà en cours."""
+        if self._charge_le is not None and time.time() - self._charge_le < MODELE_LOCAL_RECHARGEMENT_SECONDS:
+            return
+        if self._entrainement_pid == os.getpid() or time.time() - self._echec_le < MODELE_LOCAL_REESSAI_SECONDS:
+            return
+        self._entrainement_pid = os.getpid()   # un entraînement hérité du parent (fork) ne tourne pas ici
+        self._apprentissages_recents = []
+        threading.Thread(target=self._entrainer, name='entrainement-modele-local', daemon=True).start()
+
+    def _construire(self, regles, validees):
+        etat = self._etat_vide()
+        dernier_id_regle = 0
+        for regle_id, mot_cle, categorie in regles:
+            etat = self._apprendre(etat, mot_cle, categorie)
+            dernier_id_regle = regle_id
+        for libelle, categorie in validees:
+            etat = self._apprendre(etat, libelle, categorie)
+        return etat, dernier_id_regle
+
+    def _entrainer(self):
+        try:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT id, mot_cle, categorie FROM regles_generales WHERE categorie = ANY(%s) ORDER BY id", (self.categories,))
+                regles = cursor.fetchall()
+                cursor.execute("""
+                    SELECT libelle, categorie FROM transactions
+                    WHERE methode = 'Utilisateur' AND categorie = ANY(%s)
+                    ORDER BY id DESC LIMIT %s
+                """, (self.categories, MODELE_LOCAL_MAX_TRANSACTIONS))
+                validees = cursor.fetchall()
+                cursor.close()
+            if mode_cooperatif():
+                # Calcul CPU : un vrai thread du pool gevent, pour ne pas figer la boucle d'événements
+                from gevent import get_hub
+                etat, dernier_id_regle = get_hub().threadpool.apply(self._construire, (regles, validees))
+            else:
+                etat, dernier_id_regle = self._construire(regles, validees)
+        except Exception as e:
+            print(f"Erreur lors de l'entraînement du modèle local : {e}")
+            with self._lock:
+                self._echec_le = time.time()
+                self._entrainement_pid = None
+            return
+        with self._lock:
+            # Ce qui a été appris pendant l'entraînement est rejoué sur le nouvel état avant l'échange
+            for regle_id, libelle, categorie in self._apprentissages_recents:
+                if regle_id is None:
+                    etat = self._apprendre(etat, libelle, categorie)
+                elif regle_id > dernier_id_regle:
+                    etat = self._apprendre(etat, libelle, categorie)
+                    dernier_id_regle = regle_id
+            self._etat, self.dernier_id_regle = etat, dernier_id_regle
+            self._charge_le = time.time()
+            self._entrainement_pid = None
+            self._apprentissages_recents = []
+        print(f"--- 📈 Modèle local entraîné : {len(regles)} règle(s), {len(validees)} validation(s), {int((etat[2] > 0).sum())} catégorie(s) ---")
+
+    def predire(self, libelle):
+        """Retourne (categorie, probabilite) si le modèle est assez sûr de lui, sinon None."""
+        with self._lock:
+            self._planifier_entrainement()
+            comptes_categories, totaux, exemples = self._etat
+        connues = np.flatnonzero(exemples)   # catégories sans aucun exemple : hors compétition
+        if len(connues) < 2 or exemples.sum() < MODELE_LOCAL_MIN_EXEMPLES:
+            return None
+        totaux, exemples = totaux[connues], exemples[connues]
+        indices, comptes = self._caracteristiques(libelle)
+        if not comptes.size:
+            return None
+        colonnes = comptes_categories[np.ix_(connues, indices)]
+        couverture = comptes[colonnes.sum(axis=0) > 0].sum() / comptes.sum()
+        if couverture < MODELE_LOCAL_COUVERTURE_MIN:
+            return None
+        scores = (np.log(exemples + 1) - np.log(exemples.sum() + len(connues))
+                  + np.log(colonnes + self.alpha) @ comptes
+                  - comptes.sum() * np.log(totaux + self.alpha * self.dimension))
+        probabilites = np.exp(scores - scores.max())
+        probabilites /= probabilites.sum()
+        meilleure = int(probabilites.argmax())
+        if probabilites[meilleure] < MODELE_LOCAL_SEUIL:
+            return None
+        return self.categories[connues[meilleure]], float(probabilites[meilleure])
+
+MODELE_LOCAL = ModeleLocal(MODELE_LOCAL_DIMENSION, MODELE_LOCAL_CATEGORIES)
+
+def classification_modele_local(libelle):
+    """Niveau « Modèle local » : classification au format des autres niveaux, ou None si le modèle s'abstient."""
+    prediction = MODELE_LOCAL.predire(libelle)
+    if prediction is None:
+        return None
+    categorie, probabilite = prediction
+    return {'libelle_nettoye': normaliser_libelle(libelle).title(), 'categorie': categorie,
+            'sous_categorie': f"Modèle local ({round(probabilite * 100)}%)", 'methode': 'Modèle local'}
+
+# --- MIGRATIONS DE SCHÉMA ---
+# Chaque migration est appliquée une seule fois ; la version courante est tracée dans schema_migrations.
+# Les migrations "en ligne" gèrent elles-mêmes leurs transactions pour ne jamais garder de verrou long.
+MIGRATIONS_VERROU_CONSULTATIF = 727001
+MIGRATION_TAILLE_LOT = 5000
+MIGRATION_LOCK_TIMEOUT = '3s'
+MIGRATION_TENTATIVES_VERROU = 20
+# Installation neuve uniquement : nombre de partitions HASH(user_id) de la table transactions (0 = pas de partitionnement)
+TRANSACTIONS_PARTITIONS = int(os.environ.get('TRANSACTIONS_PARTITIONS', 0))
+
+def migration_001_schema_initial(cursor):
+    # Table utilisateurs
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS utilisateurs (
+        id SERIAL PRIMARY KEY,
+        email TEXT NOT NULL UNIQUE,
+        password_hash TEXT NOT NULL
+    )
+    """)
+    
+    # Table règles générales
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS regles_generales (
+        id SERIAL PRIMARY KEY,
+        mot_cle TEXT NOT NULL UNIQUE,
+        libelle_nettoye TEXT NOT NULL,
+        categorie TEXT NOT NULL,
+        sous_categorie TEXT NOT NULL
+    )
+    """)
+    
+    # Table règles personnelles
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS regles_personnelles (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        mot_cle TEXT NOT NULL,
+        libelle_nettoye TEXT NOT NULL,
+        categorie TEXT NOT NULL,
+        sous_categorie TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES utilisateurs (id),
+        UNIQUE (user_id, mot_cle) 
+    )
+    """)
+    
+    # 🆕 NOUVELLE TABLE : Transactions utilisateur
+    cursor.execute("SELECT to_regclass('transactions') IS NOT NULL")
+    if cursor.fetchone()[0]:
+        if TRANSACTIONS_PARTITIONS:
+            print("TRANSACTIONS_PARTITIONS ignoré : la table transactions existe déjà (partitionnement réservé aux installations neuves).")
+    elif TRANSACTIONS_PARTITIONS:
+        # La clé de partitionnement doit faire partie de la clé primaire
         cursor.execute("""
-        CREATE TABLE IF NOT EXISTS regles_personnelles (
-            id SERIAL PRIMARY KEY,
+        CREATE TABLE transactions (
+            id SERIAL,
             user_id INTEGER NOT NULL,
-            mot_cle TEXT NOT NULL,
+            date DATE NOT NULL,
+            libelle TEXT NOT NULL,
             libelle_nettoye TEXT NOT NULL,
+            montant NUMERIC(12,2) NOT NULL,
             categorie TEXT NOT NULL,
             sous_categorie TEXT NOT NULL,
-            FOREIGN KEY (user_id) REFERENCES utilisateurs (id),
-            UNIQUE (user_id, mot_cle) 
-        )
+            methode TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, user_id),
+            FOREIGN KEY (user_id) REFERENCES utilisateurs (id)
+        ) PARTITION BY HASH (user_id)
         """)
-        
-        # 🆕 NOUVELLE TABLE : Transactions utilisateur
+        for reste in range(TRANSACTIONS_PARTITIONS):
+            cursor.execute(
+                f"CREATE TABLE transactions_p{reste} PARTITION OF transactions FOR VALUES WITH (MODULUS %s, REMAINDER %s)",
+                (TRANSACTIONS_PARTITIONS, reste)
+            )
+    else:
         cursor.execute("""
-        CREATE TABLE IF NOT EXISTS transactions (
+        CREATE TABLE transactions (
             id SERIAL PRIMARY KEY,
             user_id INTEGER NOT NULL,
             date TEXT NOT NULL,
@@ -100,73 +827,634 @@ def init_db():
         )
         """)
 
-        # 🆕 TABLE BUDGET (Pour ne pas perdre son objectif)
+    # 🆕 Compteur de version des transactions (ETag de GET /api/transactions)
+    cursor.execute("ALTER TABLE utilisateurs ADD COLUMN IF NOT EXISTS version_transactions BIGINT NOT NULL DEFAULT 0")
+
+    # 🆕 TABLE FILE IA (Classifications LLM traitées en arrière-plan)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS file_classification_ia (
+        libelle TEXT PRIMARY KEY,
+        statut TEXT NOT NULL DEFAULT 'EN_ATTENTE',
+        libelle_nettoye TEXT,
+        categorie TEXT,
+        sous_categorie TEXT,
+        methode TEXT,
+        tentatives INTEGER NOT NULL DEFAULT 0,
+        cree_le TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        pris_le TIMESTAMP,
+        resolu_le TIMESTAMP
+    )
+    """)
+
+    # 🆕 TABLE BUDGET (Pour ne pas perdre son objectif)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS budgets (
+        id SERIAL PRIMARY KEY,
+        user_id INTEGER NOT NULL UNIQUE,
+        data TEXT NOT NULL,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (user_id) REFERENCES utilisateurs (id)
+    )
+    """)
+
+def executer_sous_verrou_court(conn, instructions):
+    """Exécute `instructions` dans une transaction courte avec lock_timeout, en réessayant si le verrou n'est pas obtenu."""
+    cursor = conn.cursor()
+    for tentative in range(1, MIGRATION_TENTATIVES_VERROU + 1):
+        try:
+            cursor.execute("BEGIN")
+            cursor.execute(f"SET LOCAL lock_timeout = '{MIGRATION_LOCK_TIMEOUT}'")
+            for instruction in instructions:
+                cursor.execute(instruction)
+            cursor.execute("COMMIT")
+            cursor.close()
+            return
+        except psycopg2.errors.LockNotAvailable:
+            cursor.execute("ROLLBACK")
+            print(f"Migration : verrou indisponible, nouvelle tentative ({tentative}/{MIGRATION_TENTATIVES_VERROU})...")
+            time.sleep(min(tentative, 5))
+        except Exception:
+            cursor.execute("ROLLBACK")
+            cursor.close()
+            raise
+    cursor.close()
+    raise RuntimeError("Migration abandonnée : impossible d'obtenir le verrou sur la table.")
+
+def migration_002_colonnes_typees(conn):
+    """transactions.date TEXT -> DATE et montant REAL -> NUMERIC(12,2), sans réécrire la table sous verrou exclusif.
+
+    Schéma expand/contract : nouvelles colonnes alimentées par un trigger, remplissage par lots commités,
+    contrainte NOT NULL validée sans bloquer les écritures, puis bascule des noms dans une transaction très courte.
+    """
+    cursor = conn.cursor()
+    cursor.execute("SELECT data_type FROM information_schema.columns WHERE table_name = 'transactions' AND column_name = 'date'")
+    if cursor.fetchone()[0] == 'date':
+        cursor.close()
+        return
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM transactions)")
+    if not cursor.fetchone()[0]:
+        # Table vide : la réécriture est instantanée
+        cursor.execute("ALTER TABLE transactions ALTER COLUMN date TYPE DATE USING date::date, ALTER COLUMN montant TYPE NUMERIC(12,2)")
+        cursor.close()
+        return
+
+    cursor.execute("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS date_typee DATE, ADD COLUMN IF NOT EXISTS montant_type NUMERIC(12,2)")
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION transactions_sync_colonnes_typees() RETURNS trigger AS $$
+        BEGIN
+            NEW.date_typee := NEW.date::date;
+            NEW.montant_type := NEW.montant;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    executer_sous_verrou_court(conn, [
+        "DROP TRIGGER IF EXISTS transactions_sync_colonnes_typees ON transactions",
+        "CREATE TRIGGER transactions_sync_colonnes_typees BEFORE INSERT OR UPDATE ON transactions "
+        "FOR EACH ROW EXECUTE FUNCTION transactions_sync_colonnes_typees()",
+    ])
+
+    total = 0
+    while True:
         cursor.execute("""
-        CREATE TABLE IF NOT EXISTS budgets (
-            id SERIAL PRIMARY KEY,
-            user_id INTEGER NOT NULL UNIQUE,
-            data TEXT NOT NULL,
-            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES utilisateurs (id)
-        )
-        """)
-        
-        conn.commit()
+            UPDATE transactions SET date_typee = date::date, montant_type = montant
+            WHERE id IN (SELECT id FROM transactions WHERE date_typee IS NULL LIMIT %s)
+        """, (MIGRATION_TAILLE_LOT,))
+        if cursor.rowcount == 0:
+            break
+        total += cursor.rowcount
+        print(f"Migration 2 : {total} transactions converties...")
+
+    # VALIDATE ne prend qu'un verrou SHARE UPDATE EXCLUSIVE ; SET NOT NULL s'appuie ensuite dessus sans rescanner
+    cursor.execute("ALTER TABLE transactions DROP CONSTRAINT IF EXISTS transactions_date_nn, DROP CONSTRAINT IF EXISTS transactions_montant_nn")
+    cursor.execute("""
+        ALTER TABLE transactions ADD CONSTRAINT transactions_date_nn CHECK (date_typee IS NOT NULL) NOT VALID,
+                                 ADD CONSTRAINT transactions_montant_nn CHECK (montant_type IS NOT NULL) NOT VALID
+    """)
+    cursor.execute("ALTER TABLE transactions VALIDATE CONSTRAINT transactions_date_nn")
+    cursor.execute("ALTER TABLE transactions VALIDATE CONSTRAINT transactions_montant_nn")
+    cursor.close()
+
+    executer_sous_verrou_court(conn, [
+        "DROP TRIGGER transactions_sync_colonnes_typees ON transactions",
+        "ALTER TABLE transactions DROP COLUMN date, DROP COLUMN montant",
+        "ALTER TABLE transactions RENAME COLUMN date_typee TO date",
+        "ALTER TABLE transactions RENAME COLUMN montant_type TO montant",
+        "ALTER TABLE transactions ALTER COLUMN date SET NOT NULL, ALTER COLUMN montant SET NOT NULL",
+        "ALTER TABLE transactions DROP CONSTRAINT transactions_date_nn, DROP CONSTRAINT transactions_montant_nn",
+        "DROP FUNCTION transactions_sync_colonnes_typees()",
+    ])
+
+def creer_index_en_ligne(conn, nom, table, definition):
+    """CREATE INDEX CONCURRENTLY idempotent (un index invalide laissé par un échec précédent est reconstruit)."""
+    cursor = conn.cursor()
+    cursor.execute("""
+        SELECT i.indisvalid FROM pg_class c JOIN pg_index i ON i.indexrelid = c.oid WHERE c.relname = %s
+    """, (nom,))
+    existant = cursor.fetchone()
+    if existant and existant[0]:
         cursor.close()
-        conn.close()
-        print("Base de données PostgreSQL (4 tables) initialisée avec succès !")
-    except Exception as e:
-        print(f"ERREUR LORS DE L'INIT DB: {e}")
+        return
+    if existant:
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {nom}")
+    cursor.execute("SELECT relkind FROM pg_class WHERE relname = %s", (table,))
+    # CONCURRENTLY n'est pas supporté sur une table partitionnée (toujours neuve, donc vide, dans notre cas)
+    concurrently = '' if cursor.fetchone()[0] == 'p' else 'CONCURRENTLY'
+    cursor.execute(f"CREATE INDEX {concurrently} IF NOT EXISTS {nom} ON {table} {definition}")
+    cursor.close()
 
-def seed_database():
-    """Remplit la table regles_generales avec nos règles de base si elle est vide."""
-    base_rules = {
-        'NETFLIX': ('Netflix', 'Abonnements', 'Streaming'),
-        'LOYER': ('Loyer', 'Charges Fixes', 'Logement'),
-        'CARREFOUR': ('Courses (Carrefour)', 'Alimentation', 'Supermarché'),
-        'SALAIRE': ('Salaire', 'Revenus', 'Salaire'),
-        'PAUL': ('Boulangerie Paul', 'Alimentation', 'Boulangerie'),
-        'AXA': ('Assurance AXA', 'Charges Fixes', 'Assurances'),
-        'RESTAURANT': ('Restaurant', 'Sorties', 'Restaurant'),
-        'AMAZON': ('Amazon', 'Shopping', 'En ligne'),
-    }
-    
+def migration_003_index(conn):
+    # Requêtes par utilisateur triées par date + pagination par curseur (date, id)
+    creer_index_en_ligne(conn, 'idx_transactions_user_date', 'transactions', '(user_id, date, id)')
+    # Report des résultats de la file IA sur les transactions en attente
+    creer_index_en_ligne(conn, 'idx_transactions_en_attente_ia', 'transactions', "(UPPER(libelle)) WHERE methode = 'IA (En attente)'")
+    # Dépilement de la file IA par ancienneté
+    creer_index_en_ligne(conn, 'idx_file_classification_ia_statut', 'file_classification_ia', '(statut, cree_le)')
+    # regles_personnelles(user_id) est déjà couvert par l'index de la contrainte UNIQUE (user_id, mot_cle)
+
+AGREGATS_VERROU_RATTRAPAGE = 727004   # clé de verrou consultatif (727004, user_id) pendant le calcul initial
+
+def creer_fonction_agregats(cursor, rattrapage):
+    """Fonction du trigger des agrégats. En `rattrapage`, seuls les utilisateurs déjà recalculés sont mis à jour,
+    sous verrou consultatif partagé par utilisateur : le calcul initial d'un utilisateur (verrou exclusif) voit alors
+    toutes les écritures validées avant lui, et celles qui suivent passent par le trigger."""
+    verrous = filtre = ""
+    if rattrapage:
+        verrous = f"""
+            IF TG_OP = 'INSERT' THEN
+                PERFORM pg_advisory_xact_lock_shared({AGREGATS_VERROU_RATTRAPAGE}, user_id) FROM (SELECT DISTINCT user_id FROM nouvelles ORDER BY 1) u;
+            ELSE
+                PERFORM pg_advisory_xact_lock_shared({AGREGATS_VERROU_RATTRAPAGE}, user_id) FROM (SELECT DISTINCT user_id FROM anciennes ORDER BY 1) u;
+            END IF;
+        """
+        filtre = "WHERE user_id IN (SELECT user_id FROM agregats_mensuels_rattrapes)"
+    cursor.execute(f"""
+        CREATE OR REPLACE FUNCTION transactions_maj_agregats() RETURNS trigger AS $$
+        BEGIN
+            {verrous}
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                INSERT INTO agregats_mensuels AS a (user_id, mois, categorie, total, total_debits, nombre)
+                SELECT user_id, date_trunc('month', date)::date, categorie,
+                       -SUM(montant), -SUM(LEAST(montant, 0)), -COUNT(*)
+                FROM anciennes {filtre} GROUP BY 1, 2, 3
+                ON CONFLICT (user_id, mois, categorie) DO UPDATE SET
+                    total = a.total + EXCLUDED.total, total_debits = a.total_debits + EXCLUDED.total_debits, nombre = a.nombre + EXCLUDED.nombre;
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                INSERT INTO agregats_mensuels AS a (user_id, mois, categorie, total, total_debits, nombre)
+                SELECT user_id, date_trunc('month', date)::date, categorie,
+                       SUM(montant), SUM(LEAST(montant, 0)), COUNT(*)
+                FROM nouvelles {filtre} GROUP BY 1, 2, 3
+                ON CONFLICT (user_id, mois, categorie) DO UPDATE SET
+                    total = a.total + EXCLUDED.total, total_debits = a.total_debits + EXCLUDED.total_debits, nombre = a.nombre + EXCLUDED.nombre;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+
+def migration_004_agregats_mensuels(conn):
+    """Agrégats (user, mois, catégorie) maintenus par des triggers de niveau instruction (tables de transition) :
+    un import de 1000 lignes ne coûte qu'un upsert groupé, et tous les chemins d'écriture sont couverts.
+
+    Sans verrou de table pendant le calcul initial : les triggers sont posés d'abord (verrou court), puis chaque
+    utilisateur est recalculé dans sa propre transaction courte. Reprend là où il s'est arrêté en cas d'échec.
+    """
+    cursor = conn.cursor()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS agregats_mensuels (
+        user_id INTEGER NOT NULL,
+        mois DATE NOT NULL,
+        categorie TEXT NOT NULL,
+        total NUMERIC(14,2) NOT NULL DEFAULT 0,
+        total_debits NUMERIC(14,2) NOT NULL DEFAULT 0,
+        nombre INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, mois, categorie),
+        FOREIGN KEY (user_id) REFERENCES utilisateurs (id)
+    )
+    """)
+    cursor.execute("CREATE TABLE IF NOT EXISTS agregats_mensuels_rattrapes (user_id INTEGER PRIMARY KEY)")
+    creer_fonction_agregats(cursor, rattrapage=True)
+    executer_sous_verrou_court(conn, [
+        instruction
+        for operation, transitions in (('INSERT', 'NEW TABLE AS nouvelles'),
+                                       ('UPDATE', 'OLD TABLE AS anciennes NEW TABLE AS nouvelles'),
+                                       ('DELETE', 'OLD TABLE AS anciennes'))
+        for instruction in (
+            f"DROP TRIGGER IF EXISTS transactions_agregats_{operation.lower()} ON transactions",
+            f"CREATE TRIGGER transactions_agregats_{operation.lower()} AFTER {operation} ON transactions "
+            f"REFERENCING {transitions} FOR EACH STATEMENT EXECUTE FUNCTION transactions_maj_agregats()",
+        )
+    ])
+
+    total = 0
+    while True:
+        # Un utilisateur créé pendant le calcul est pris au tour suivant
+        cursor.execute("""
+            SELECT id FROM utilisateurs WHERE id NOT IN (SELECT user_id FROM agregats_mensuels_rattrapes) ORDER BY id LIMIT %s
+        """, (MIGRATION_TAILLE_LOT,))
+        user_ids = [row[0] for row in cursor.fetchall()]
+        if not user_ids:
+            break
+        for user_id in user_ids:
+            cursor.execute("BEGIN")
+            try:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", (AGREGATS_VERROU_RATTRAPAGE, user_id))
+                cursor.execute("INSERT INTO agregats_mensuels_rattrapes (user_id) VALUES (%s)", (user_id,))
+                cursor.execute("""
+                    INSERT INTO agregats_mensuels AS a (user_id, mois, categorie, total, total_debits, nombre)
+                    SELECT user_id, date_trunc('month', date)::date, categorie, SUM(montant), SUM(LEAST(montant, 0)), COUNT(*)
+                    FROM transactions WHERE user_id = %s GROUP BY 1, 2, 3
+                    ON CONFLICT (user_id, mois, categorie) DO UPDATE SET
+                        total = a.total + EXCLUDED.total, total_debits = a.total_debits + EXCLUDED.total_debits, nombre = a.nombre + EXCLUDED.nombre
+                """, (user_id,))
+                cursor.execute("COMMIT")
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+        total += len(user_ids)
+        print(f"Migration 4 : agrégats calculés pour {total} utilisateur(s)...")
+
+    # Tous les utilisateurs sont à jour : fonction définitive (ni verrou consultatif ni filtre)
+    creer_fonction_agregats(cursor, rattrapage=False)
+    cursor.close()
+    executer_sous_verrou_court(conn, ["DROP TABLE IF EXISTS agregats_mensuels_rattrapes"])
+
+# Une dépense est imputée au budget si elle est datée (date de l'opération) depuis son début : règle unique
+# du trigger, de la migration 011 et de l'enregistrement d'un budget
+PREDICAT_DEPENSE_BUDGET = "t.montant < 0 AND t.date >= b.debut::date"
+
+def imputer_depenses_du_budget(cursor, user_id):
+    """Décompte des enveloppes et du reste à vivre les dépenses déjà présentes depuis le début du budget
+    (celles qui arriveront ensuite, ou seront modifiées, passent par le trigger)."""
+    cursor.execute(f"""
+        WITH deltas AS (
+            SELECT t.categorie, SUM(t.montant) AS delta
+            FROM transactions t JOIN budgets b ON b.user_id = t.user_id
+            WHERE t.user_id = %s AND {PREDICAT_DEPENSE_BUDGET}
+            GROUP BY t.categorie
+        ), maj_enveloppes AS (
+            UPDATE enveloppes e SET montant_restant = e.montant_restant + d.delta
+            FROM deltas d WHERE e.user_id = %s AND e.categorie = d.categorie
+        )
+        UPDATE budgets SET reste_a_vivre_total = reste_a_vivre_total + (SELECT COALESCE(SUM(delta), 0) FROM deltas)
+        WHERE user_id = %s
+    """, (user_id, user_id, user_id))
+
+def creer_fonction_enveloppes(cursor):
+    # Une dépense (montant < 0) datée depuis le début du budget consomme son enveloppe et le reste à vivre.
+    # C'est la date de l'opération qui compte : importer un ancien relevé ne doit rien décompter.
+    delta_sql = """
+        WITH deltas AS (
+            SELECT t.user_id, t.categorie, SUM(t.montant) * {signe} AS delta
+            FROM {table} t JOIN budgets b ON b.user_id = t.user_id
+            WHERE {predicat}
+            GROUP BY t.user_id, t.categorie
+        ), maj_enveloppes AS (
+            UPDATE enveloppes e SET montant_restant = e.montant_restant + d.delta
+            FROM deltas d WHERE e.user_id = d.user_id AND e.categorie = d.categorie
+        )
+        UPDATE budgets b SET reste_a_vivre_total = b.reste_a_vivre_total + s.delta
+        FROM (SELECT user_id, SUM(delta) AS delta FROM deltas GROUP BY user_id) s
+        WHERE b.user_id = s.user_id;
+    """
+    cursor.execute(f"""
+        CREATE OR REPLACE FUNCTION transactions_maj_enveloppes() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                {delta_sql.format(table='anciennes', signe='-1', predicat=PREDICAT_DEPENSE_BUDGET)}
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                {delta_sql.format(table='nouvelles', signe='1', predicat=PREDICAT_DEPENSE_BUDGET)}
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+
+def migration_005_enveloppes(conn):
+    """Budget normalisé : une ligne par enveloppe, et restants décrémentés par trigger dans la transaction
+    qui insère / recatégorise / supprime la dépense (plus de réécriture du blob JSON côté client)."""
+    executer_sous_verrou_court(conn, ["""
+        ALTER TABLE budgets
+            ADD COLUMN IF NOT EXISTS revenus_observes NUMERIC(12,2),
+            ADD COLUMN IF NOT EXISTS fixes_observes NUMERIC(12,2),
+            ADD COLUMN IF NOT EXISTS reste_a_vivre_total NUMERIC(12,2),
+            ADD COLUMN IF NOT EXISTS message_ia TEXT,
+            ADD COLUMN IF NOT EXISTS debut TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            ALTER COLUMN data DROP NOT NULL
+    """, """
+    CREATE TABLE IF NOT EXISTS enveloppes (
+        user_id INTEGER NOT NULL,
+        categorie TEXT NOT NULL,
+        ordre INTEGER NOT NULL DEFAULT 0,
+        depense_observee NUMERIC(12,2) NOT NULL DEFAULT 0,
+        enveloppe_proposee NUMERIC(12,2) NOT NULL,
+        montant_restant NUMERIC(12,2) NOT NULL,
+        PRIMARY KEY (user_id, categorie),
+        FOREIGN KEY (user_id) REFERENCES utilisateurs (id)
+    )
+    """])
+
+    # Reprise des budgets existants (blob JSON) : verrous de ligne seulement
+    cursor = conn.cursor()
+    cursor.execute("BEGIN")
     try:
-        conn = get_db_connection()
+        cursor.execute("SELECT user_id, data, updated_at FROM budgets WHERE data IS NOT NULL AND reste_a_vivre_total IS NULL FOR UPDATE")
+        for user_id, data, updated_at in cursor.fetchall():
+            try:
+                budget = json.loads(data)
+            except (TypeError, ValueError):
+                continue
+            cursor.execute("""
+                UPDATE budgets SET revenus_observes = %s, fixes_observes = %s, reste_a_vivre_total = %s, message_ia = %s, debut = %s
+                WHERE user_id = %s
+            """, (budget.get('revenus_observes', 0), budget.get('fixes_observes', 0), budget.get('reste_a_vivre_total', 0),
+                  budget.get('message_ia', ''), updated_at, user_id))
+            enregistrer_enveloppes(cursor, user_id, budget.get('enveloppes_proposees', []))
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+
+    creer_fonction_enveloppes(cursor)
+    cursor.close()
+    executer_sous_verrou_court(conn, [
+        instruction
+        for operation, transitions in (('INSERT', 'NEW TABLE AS nouvelles'),
+                                       ('UPDATE', 'OLD TABLE AS anciennes NEW TABLE AS nouvelles'),
+                                       ('DELETE', 'OLD TABLE AS anciennes'))
+        for instruction in (
+            f"DROP TRIGGER IF EXISTS transactions_enveloppes_{operation.lower()} ON transactions",
+            f"CREATE TRIGGER transactions_enveloppes_{operation.lower()} AFTER {operation} ON transactions "
+            f"REFERENCING {transitions} FOR EACH STATEMENT EXECUTE FUNCTION transactions_maj_enveloppes()",
+        )
+    ])
+
+def migration_006_quotas_ia(cursor):
+    """Limiteur et registre de consommation IA partagés par tous les workers (et tous les hôtes)."""
+    cursor.execute("ALTER TABLE file_classification_ia ADD COLUMN IF NOT EXISTS demandeur INTEGER")
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS limiteur_ia (
+        nom TEXT PRIMARY KEY,
+        jetons DOUBLE PRECISION NOT NULL,
+        maj_le TIMESTAMPTZ NOT NULL DEFAULT clock_timestamp()
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS quota_ia_jour (
+        jour DATE PRIMARY KEY,
+        appels INTEGER NOT NULL DEFAULT 0,
+        libelles INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS usage_ia_utilisateurs (
+        user_id INTEGER NOT NULL,
+        jour DATE NOT NULL,
+        libelles INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, jour)
+    )
+    """)
+
+def migration_007_index_validations(conn):
+    # Entraînement du modèle local sur les transactions validées par les utilisateurs
+    creer_index_en_ligne(conn, 'idx_transactions_validees', 'transactions', "(id) WHERE methode = 'Utilisateur'")
+
+def migration_008_index_a_verifier(conn):
+    # Reclassement rétroactif quand une règle générale est apprise
+    creer_index_en_ligne(conn, 'idx_transactions_a_verifier', 'transactions', "(id) WHERE categorie = 'A_VERIFIER'")
+
+def migration_009_suivi_modifications(conn):
+    """Synchronisation différentielle : chaque écriture porte updated_at et un numéro de séquence par utilisateur
+    (version_transactions + 1, lu sous verrou de la ligne utilisateur), les suppressions laissent une pierre tombale.
+
+    Le verrou sérialise les écritures d'un même utilisateur jusqu'au commit : une ligne de séquence <= version
+    est toujours visible dès que cette version l'est, le jeton de synchronisation ne saute donc aucune modification.
+    """
+    # Défauts non volatils : pas de réécriture de la table (les lignes existantes sont toutes en séquence 0)
+    executer_sous_verrou_court(conn, [
+        "ALTER TABLE transactions ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+        "ADD COLUMN IF NOT EXISTS seq_modif BIGINT NOT NULL DEFAULT 0"
+    ])
+    cursor = conn.cursor()
+    cursor.execute("""
+    CREATE TABLE IF NOT EXISTS transactions_supprimees (
+        user_id INTEGER NOT NULL,
+        transaction_id INTEGER NOT NULL,
+        seq_modif BIGINT NOT NULL,
+        supprime_le TIMESTAMPTZ NOT NULL DEFAULT now(),
+        PRIMARY KEY (user_id, seq_modif, transaction_id)
+    )
+    """)
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION transactions_marquer_modification() RETURNS trigger AS $$
+        BEGIN
+            SELECT version_transactions + 1 INTO NEW.seq_modif
+            FROM utilisateurs WHERE id = NEW.user_id FOR NO KEY UPDATE;
+            NEW.updated_at := now();
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    cursor.execute("""
+        CREATE OR REPLACE FUNCTION transactions_pierres_tombales() RETURNS trigger AS $$
+        BEGIN
+            PERFORM 1 FROM utilisateurs WHERE id IN (SELECT user_id FROM anciennes) ORDER BY id FOR NO KEY UPDATE;
+            INSERT INTO transactions_supprimees (user_id, transaction_id, seq_modif)
+            SELECT a.user_id, a.id, u.version_transactions + 1
+            FROM anciennes a JOIN utilisateurs u ON u.id = a.user_id;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    """)
+    cursor.close()
+    executer_sous_verrou_court(conn, [
+        "DROP TRIGGER IF EXISTS transactions_suivi_modifications ON transactions",
+        "CREATE TRIGGER transactions_suivi_modifications BEFORE INSERT OR UPDATE ON transactions "
+        "FOR EACH ROW EXECUTE FUNCTION transactions_marquer_modification()",
+        "DROP TRIGGER IF EXISTS transactions_suivi_suppressions ON transactions",
+        "CREATE TRIGGER transactions_suivi_suppressions AFTER DELETE ON transactions "
+        "REFERENCING OLD TABLE AS anciennes FOR EACH STATEMENT EXECUTE FUNCTION transactions_pierres_tombales()",
+    ])
+
+def migration_010_index_modifications(conn):
+    # GET /api/transactions/changes : parcours par (séquence, id) depuis le jeton du client
+    creer_index_en_ligne(conn, 'idx_transactions_user_seq', 'transactions', '(user_id, seq_modif, id)')
+
+def migration_011_enveloppes_date_operation(cursor):
+    """Les installations migrées avant ce correctif décomptaient les dépenses selon created_at (date d'insertion) :
+    nouvelle fonction de trigger, puis restants recalés de l'écart entre les deux règles."""
+    creer_fonction_enveloppes(cursor)
+    cursor.execute(f"""
+        WITH ecarts AS (
+            SELECT t.user_id, t.categorie,
+                   COALESCE(SUM(t.montant) FILTER (WHERE {PREDICAT_DEPENSE_BUDGET}), 0)
+                   - COALESCE(SUM(t.montant) FILTER (WHERE t.created_at >= b.debut), 0) AS delta
+            FROM transactions t JOIN budgets b ON b.user_id = t.user_id
+            WHERE t.montant < 0 AND (t.date >= b.debut::date OR t.created_at >= b.debut)
+            GROUP BY t.user_id, t.categorie
+        ), maj_enveloppes AS (
+            UPDATE enveloppes e SET montant_restant = e.montant_restant + d.delta
+            FROM ecarts d WHERE e.user_id = d.user_id AND e.categorie = d.categorie
+        )
+        UPDATE budgets b SET reste_a_vivre_total = b.reste_a_vivre_total + s.delta
+        FROM (SELECT user_id, SUM(delta) AS delta FROM ecarts GROUP BY user_id) s
+        WHERE b.user_id = s.user_id
+    """)
+
+def migration_012_unaccent(cursor):
+    # Reclassement rétroactif : mêmes correspondances sans accents que les matcheurs en mémoire
+    cursor.execute("CREATE EXTENSION IF NOT EXISTS unaccent")
+
+# (version, description, fonction, transactionnelle) — une migration non transactionnelle reçoit une connexion en autocommit
+MIGRATIONS = [
+    (1, "Schéma initial", migration_001_schema_initial, True),
+    (2, "transactions : colonnes DATE / NUMERIC(12,2)", migration_002_colonnes_typees, False),
+    (3, "Index de support", migration_003_index, False),
+    (4, "Agrégats mensuels par catégorie", migration_004_agregats_mensuels, False),
+    (5, "Budgets : enveloppes normalisées et restants tenus par trigger", migration_005_enveloppes, False),
+    (6, "IA : limiteur partagé, quota journalier et consommation par utilisateur", migration_006_quotas_ia, True),
+    (7, "Index des transactions validées (modèle local)", migration_007_index_validations, False),
+    (8, "Index des transactions à vérifier (reclassement rétroactif)", migration_008_index_a_verifier, False),
+    (9, "Suivi des modifications : updated_at, séquence par utilisateur, pierres tombales", migration_009_suivi_modifications, False),
+    (10, "Index de synchronisation différentielle", migration_010_index_modifications, False),
+    (11, "Enveloppes : dépenses décomptées selon la date de l'opération", migration_011_enveloppes_date_operation, True),
+    (12, "Extension unaccent (correspondances SQL sans accents)", migration_012_unaccent, True),
+]
+
+def appliquer_migrations():
+    """Applique les migrations manquantes ; un verrou consultatif évite que deux processus migrent en même temps."""
+    with get_db_connection() as conn:
+        conn.autocommit = True
         cursor = conn.cursor()
-        
-        for mot_cle, details in base_rules.items():
-            libelle, categorie, sous_categorie = details
+        try:
+            cursor.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_VERROU_CONSULTATIF,))
             cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT NOT NULL,
+                    applique_le TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("SELECT version FROM schema_migrations")
+            deja_appliquees = {row[0] for row in cursor.fetchall()}
+            for version, description, migration, transactionnelle in MIGRATIONS:
+                if version in deja_appliquees:
+                    continue
+                print(f"Migration {version} : {description}...")
+                if transactionnelle:
+                    conn.autocommit = False
+                    migration(conn.cursor())
+                else:
+                    migration(conn)
+                    conn.autocommit = False
+                cursor.execute("INSERT INTO schema_migrations (version, description) VALUES (%s, %s)", (version, description))
+                conn.commit()
+                conn.autocommit = True
+            return MIGRATIONS[-1][0]
+        finally:
+            conn.rollback()
+            conn.autocommit = True
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_VERROU_CONSULTATIF,))
+            cursor.close()
+            conn.autocommit = False
+
+# --- 2. Initialisation BDD ---
+# Rien n'est exécuté à l'import : les workers démarrent sans aucun aller-retour BDD (pool et règles chargés à la demande).
+# Le schéma et les règles de base sont mis en place une fois par déploiement : flask --app app bootstrap
+def init_db():
+    version = appliquer_migrations()
+    print(f"Base de données PostgreSQL initialisée avec succès (schéma version {version}) !")
+
+REGLES_DE_BASE = {
+    'NETFLIX': ('Netflix', 'Abonnements', 'Streaming'),
+    'LOYER': ('Loyer', 'Charges Fixes', 'Logement'),
+    'CARREFOUR': ('Courses (Carrefour)', 'Alimentation', 'Supermarché'),
+    'SALAIRE': ('Salaire', 'Revenus', 'Salaire'),
+    'PAUL': ('Boulangerie Paul', 'Alimentation', 'Boulangerie'),
+    'AXA': ('Assurance AXA', 'Charges Fixes', 'Assurances'),
+    'RESTAURANT': ('Restaurant', 'Sorties', 'Restaurant'),
+    'AMAZON': ('Amazon', 'Shopping', 'En ligne'),
+}
+
+def seed_database():
+    """Insère les règles de base manquantes dans regles_generales, en une seule requête multi-lignes."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        inserees = execute_values(cursor, """
             INSERT INTO regles_generales (mot_cle, libelle_nettoye, categorie, sous_categorie)
-            VALUES (%s, %s, %s, %s)
+            VALUES %s
             ON CONFLICT (mot_cle) DO NOTHING
-            """, (mot_cle, libelle, categorie, sous_categorie))
-        
+            RETURNING id
+        """, [(mot_cle, *details) for mot_cle, details in REGLES_DE_BASE.items()], page_size=len(REGLES_DE_BASE), fetch=True)
         conn.commit()
         cursor.close()
-        conn.close()
-        print("Règles de base vérifiées et insérées.")
-    except Exception as e:
-        print(f"Erreur lors du 'seeding' de la BDD : {e}")
+    print(f"Règles de base vérifiées ({len(inserees)} insérée(s)).")
+
+def normaliser_regles_existantes():
+    """Job ponctuel : ramène les règles existantes sur leur clé canonique et fusionne les quasi-doublons.
+
+    Règles générales : la règle déjà canonique, sinon la plus ancienne, est conservée.
+    Règles personnelles : la règle déjà canonique, sinon la plus récente (dernier choix de l'utilisateur), est conservée.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        bilan = {}
+        for table, portee, garder_plus_recente in (('regles_generales', "''", False), ('regles_personnelles', 'user_id', True)):
+            cursor.execute(f"SELECT id, {portee}, mot_cle FROM {table} ORDER BY id")
+            groupes = {}
+            for regle_id, proprietaire, mot_cle in cursor.fetchall():
+                groupes.setdefault((proprietaire, normaliser_libelle(mot_cle)), []).append((regle_id, mot_cle))
+            a_supprimer, a_renommer = [], []
+            for (_, cle), regles in groupes.items():
+                gardee = next((r for r in regles if r[1] == cle), regles[-1] if garder_plus_recente else regles[0])
+                a_supprimer += [regle_id for regle_id, _ in regles if regle_id != gardee[0]]
+                if gardee[1] != cle:
+                    a_renommer.append((gardee[0], cle))
+            if a_supprimer:
+                cursor.execute(f"DELETE FROM {table} WHERE id = ANY(%s)", (a_supprimer,))
+            if a_renommer:
+                execute_values(cursor, f"""
+                    UPDATE {table} AS r SET mot_cle = v.mot_cle
+                    FROM (VALUES %s) AS v (id, mot_cle) WHERE r.id = v.id
+                """, a_renommer)
+            bilan[table] = {'supprimees': len(a_supprimer), 'renommees': len(a_renommer)}
+        cursor.execute("SELECT pg_notify(%s, '*')", (CANAL_REGLES_PERSONNELLES,))
+        conn.commit()
+        cursor.close()
+    return bilan
 
-# Initialisation au démarrage
-init_db()
-seed_database()
+@app.cli.command('normaliser-regles')
+def commande_normaliser_regles():
+    """flask --app app normaliser-regles"""
+    for table, chiffres in normaliser_regles_existantes().items():
+        print(f"{table} : {chiffres['renommees']} règle(s) renommée(s), {chiffres['supprimees']} doublon(s) supprimé(s)")
+    print(f"Les workers rechargent les règles générales sous {REGLES_GENERALES_RECHARGEMENT_COMPLET_SECONDS // 60} minutes.")
+
+@app.cli.command('bootstrap')
+def commande_bootstrap():
+    """flask --app app bootstrap (une fois par déploiement, avant de (re)démarrer les workers)"""
+    init_db()
+    seed_database()
     
 # --- 3. Logique Métier ---
 def sauvegarder_regle_generale(mot_cle, libelle_nettoye, categorie, sous_categorie):
+    mot_cle = normaliser_libelle(mot_cle)
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-        INSERT INTO regles_generales (mot_cle, libelle_nettoye, categorie, sous_categorie)
-        VALUES (%s, %s, %s, %s)
-        ON CONFLICT (mot_cle) DO NOTHING
-        """, (mot_cle.upper(), libelle_nettoye, categorie, sous_categorie))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+            INSERT INTO regles_generales (mot_cle, libelle_nettoye, categorie, sous_categorie)
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (mot_cle) DO NOTHING
+            RETURNING id
+            """, (mot_cle.upper(), libelle_nettoye, categorie, sous_categorie))
+            row = cursor.fetchone()
+            conn.commit()
+            cursor.close()
+        if row:
+            MATCHEUR_REGLES_GENERALES.ajouter(mot_cle.upper(), (libelle_nettoye, categorie, sous_categorie), ordre=row[0])
         print(f"--- 🧠 Règle GÉNÉRALE sauvegardée : {mot_cle.upper()} -> {categorie} ---")
         return True
     except Exception as e:
@@ -174,26 +1462,133 @@ def sauvegarder_regle_generale(mot_cle, libelle_nettoye, categorie, sous_categor
         return False
 
 def sauvegarder_regle_personnelle(user_id, mot_cle, libelle_nettoye, categorie, sous_categorie):
+    mot_cle = normaliser_libelle(mot_cle)
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-        INSERT INTO regles_personnelles (user_id, mot_cle, libelle_nettoye, categorie, sous_categorie)
-        VALUES (%s, %s, %s, %s, %s)
-        ON CONFLICT (user_id, mot_cle) DO UPDATE SET
-            libelle_nettoye = EXCLUDED.libelle_nettoye,
-            categorie = EXCLUDED.categorie,
-            sous_categorie = EXCLUDED.sous_categorie
-        """, (user_id, mot_cle.upper(), libelle_nettoye, categorie, sous_categorie))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+            INSERT INTO regles_personnelles (user_id, mot_cle, libelle_nettoye, categorie, sous_categorie)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (user_id, mot_cle) DO UPDATE SET
+                libelle_nettoye = EXCLUDED.libelle_nettoye,
+                categorie = EXCLUDED.categorie,
+                sous_categorie = EXCLUDED.sous_categorie
+            """, (user_id, mot_cle.upper(), libelle_nettoye, categorie, sous_categorie))
+            # Invalidation du matcheur de l'utilisateur dans tous les workers (envoyée au commit)
+            cursor.execute("SELECT pg_notify(%s, %s)", (CANAL_REGLES_PERSONNELLES, str(user_id)))
+            conn.commit()
+            cursor.close()
+        CACHE_REGLES_PERSONNELLES.invalider(user_id)
         print(f"--- 🧑‍💻 Règle PERSONNELLE sauvegardée (User {user_id}) : {mot_cle.upper()} -> {categorie} ---")
         return True
     except Exception as e:
         print(f"Erreur BDD (sauvegarde personnelle) : {e}")
         return False
 
+# --- Reclassement rétroactif (une seule instruction UPDATE par règle apprise) ---
+# Le libellé correspond si la clé apparaît dans le libellé en majuscules, tel quel ou ponctuation réduite à des espaces
+# (approximation SQL de texte_de_recherche) ; les validations manuelles (methode 'Utilisateur') ne sont jamais touchées.
+# Accents retirés comme dans normaliser_libelle (extension unaccent, migration 012) : « CAFÉ » correspond à « CAFE »
+CORRESPONDANCE_LIBELLE_SQL = "(UPPER(unaccent({t}.libelle)) LIKE {motif} OR regexp_replace(UPPER(unaccent({t}.libelle)), '[^A-Z0-9]+', ' ', 'g') LIKE {motif})"
+
+def motif_like(mot_cle):
+    return '%' + mot_cle.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+# Équivalent SQL de motif_like, pour les mots-clés lus en base
+MOTIF_LIKE_SQL = "('%%' || replace(replace(replace({colonne}, '\\', '\\\\'), '%%', '\\%%'), '_', '\\_') || '%%')"
+
+def reclasser_transactions_personnelles(user_id, mot_cle, libelle_nettoye, categorie, sous_categorie):
+    """Applique une règle personnelle aux transactions existantes de l'utilisateur ; retourne le nombre de lignes modifiées.
+
+    Même arbitrage que le matcheur : une transaction qui correspond aussi à une autre règle personnelle plus longue
+    (ou de même longueur mais plus ancienne) garde la classification de celle-ci.
+    """
+    cle = normaliser_libelle(mot_cle).upper()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            WITH maj AS (
+                UPDATE transactions t
+                SET libelle_nettoye = %(libelle_nettoye)s, categorie = %(categorie)s, sous_categorie = %(sous_categorie)s, methode = 'Regle (Perso)'
+                WHERE t.user_id = %(user_id)s AND t.methode <> 'Utilisateur'
+                  AND (t.libelle_nettoye, t.categorie, t.sous_categorie, t.methode)
+                      IS DISTINCT FROM (%(libelle_nettoye)s, %(categorie)s, %(sous_categorie)s, 'Regle (Perso)')
+                  AND {CORRESPONDANCE_LIBELLE_SQL.format(t='t', motif='%(motif)s')}
+                  AND NOT EXISTS (
+                      SELECT 1 FROM regles_personnelles p
+                      WHERE p.user_id = t.user_id AND p.mot_cle <> %(cle)s
+                        AND (LENGTH(p.mot_cle) > LENGTH(%(cle)s)
+                             OR (LENGTH(p.mot_cle) = LENGTH(%(cle)s) AND p.id < (
+                                 SELECT id FROM regles_personnelles WHERE user_id = %(user_id)s AND mot_cle = %(cle)s)))
+                        AND {CORRESPONDANCE_LIBELLE_SQL.format(t='t', motif=MOTIF_LIKE_SQL.format(colonne='p.mot_cle'))}
+                  )
+                RETURNING 1
+            )
+            SELECT COUNT(*) FROM maj
+        """, {'user_id': user_id, 'libelle_nettoye': libelle_nettoye, 'categorie': categorie,
+              'sous_categorie': sous_categorie, 'motif': motif_like(normaliser_libelle(mot_cle)), 'cle': cle})
+        nombre = cursor.fetchone()[0]
+        if nombre:
+            marquer_transactions_modifiees(cursor, [user_id])
+        conn.commit()
+        cursor.close()
+    return nombre
+
+def reclasser_transactions_generales(regles):
+    """regles : [(mot_cle, libelle_nettoye, categorie, sous_categorie)]. Tous utilisateurs, mais seulement les
+    transactions encore A_VERIFIER : une règle générale ne contredit ni un choix ni une règle personnelle."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # Correspondances calculées une fois (table temporaire) : elles donnent aussi les utilisateurs à verrouiller
+        execute_values(cursor, f"""
+            CREATE TEMP TABLE correspondances_reclassement ON COMMIT DROP AS
+            WITH regles (motif, longueur, libelle_nettoye, categorie, sous_categorie) AS (VALUES %s)
+            SELECT DISTINCT ON (t.id) t.id, t.user_id, r.libelle_nettoye, r.categorie, r.sous_categorie
+            FROM transactions t JOIN regles r ON {CORRESPONDANCE_LIBELLE_SQL.format(t='t', motif='r.motif')}
+            WHERE t.categorie = 'A_VERIFIER' AND t.methode <> 'Utilisateur'
+            ORDER BY t.id, r.longueur DESC
+        """, [(motif_like(mot_cle), len(mot_cle), libelle_nettoye, categorie, sous_categorie)
+              for mot_cle, libelle_nettoye, categorie, sous_categorie in regles], page_size=len(regles))
+        user_ids = verrouiller_utilisateurs(cursor, "SELECT user_id FROM correspondances_reclassement")
+        cursor.execute("""
+            WITH maj AS (
+                UPDATE transactions t
+                SET libelle_nettoye = c.libelle_nettoye, categorie = c.categorie, sous_categorie = c.sous_categorie, methode = 'Regle (Générale)'
+                FROM correspondances_reclassement c
+                WHERE t.id = c.id AND t.user_id = ANY(%s::INTEGER[])
+                  AND t.categorie = 'A_VERIFIER' AND t.methode <> 'Utilisateur'
+                RETURNING t.user_id
+            ), versions AS (
+                UPDATE utilisateurs SET version_transactions = version_transactions + 1
+                WHERE id IN (SELECT user_id FROM maj)
+            )
+            SELECT COUNT(*) FROM maj
+        """, (user_ids,))
+        nombre = cursor.fetchone()[0]
+        conn.commit()
+        cursor.close()
+    return nombre
+
+RECLASSEMENT_EXECUTEUR = None
+RECLASSEMENT_PID = None
+
+def planifier_reclassement_general(regles):
+    """Lance le reclassement rétroactif des règles générales apprises dans un thread dédié (hors worker IA et requêtes)."""
+    global RECLASSEMENT_EXECUTEUR, RECLASSEMENT_PID
+    if not regles:
+        return
+    if RECLASSEMENT_EXECUTEUR is None or RECLASSEMENT_PID != os.getpid():
+        RECLASSEMENT_EXECUTEUR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reclassement')
+        RECLASSEMENT_PID = os.getpid()
+
+    def tache():
+        try:
+            nombre = reclasser_transactions_generales(regles)
+            print(f"--- 🔁 Reclassement rétroactif : {nombre} transaction(s) pour {len(regles)} règle(s) générale(s) ---")
+        except Exception as e:
+            print(f"Erreur BDD (reclassement rétroactif) : {e}")
+    RECLASSEMENT_EXECUTEUR.submit(tache)
+
 def extraire_json_de_reponse(texte_brut):
     match = re.search(r'\{.*\}', texte_brut, re.DOTALL)
     if match:
@@ -201,116 +1596,822 @@ def extraire_json_de_reponse(texte_brut):
         except json.JSONDecodeError: return None
     return None
 
+def extraire_tableau_json_de_reponse(texte_brut):
+    match = re.search(r'\[.*\]', texte_brut, re.DOTALL)
+    if match:
+        try: return json.loads(match.group(0))
+        except json.JSONDecodeError: pass
+    # Pour un lot d'une seule transaction, le modèle répond parfois par un objet seul
+    resultat = extraire_json_de_reponse(texte_brut)
+    return [resultat] if isinstance(resultat, dict) else None
+
+class DisjoncteurOuvert(Exception):
+    pass
+
+class ClientLLM:
+    """Client HTTP du LLM : session keep-alive (une par processus), timeouts connexion/lecture,
+    retries avec backoff exponentiel + jitter sur 429 / 5xx / erreurs réseau, et disjoncteur.
+
+    Après `seuil_echecs` appels en échec consécutifs, le disjoncteur s'ouvre : les appels échouent immédiatement
+    (DisjoncteurOuvert) pendant `pause_disjoncteur` secondes, puis un seul appel d'essai est laissé passer.
+    """
+
+    def __init__(self, url, timeout_connexion, timeout_lecture, tentatives, backoff_base, backoff_max, seuil_echecs, pause_disjoncteur):
+        self.url = url
+        self.timeout = (timeout_connexion, timeout_lecture)
+        self.tentatives = max(1, tentatives)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.seuil_echecs = seuil_echecs
+        self.pause_disjoncteur = pause_disjoncteur
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._echecs_consecutifs = 0
+        self._ouvert_jusqua = 0.0
+        self._essai_en_cours = False
+
+    def _session_http(self):
+        if self._session is None or self._pid != os.getpid():
+            session = requests.Session()
+            adaptateur = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4)
+            session.mount('https://', adaptateur)
+            session.mount('http://', adaptateur)
+            session.headers['Content-Type'] = 'application/json'
+            self._session, self._pid = session, os.getpid()
+        return self._session
+
+    def attente_disjoncteur(self):
+        """Secondes avant qu'un appel soit de nouveau tenté (0 si le disjoncteur est fermé ou prêt pour un essai)."""
+        with self._lock:
+            if self._echecs_consecutifs < self.seuil_echecs:
+                return 0
+            return max(0.0, self._ouvert_jusqua - time.monotonic())
+
+    def _autoriser(self):
+        with self._lock:
+            if self._echecs_consecutifs < self.seuil_echecs:
+                return
+            if time.monotonic() < self._ouvert_jusqua or self._essai_en_cours:
+                raise DisjoncteurOuvert(f"LLM indisponible ({self._echecs_consecutifs} échecs consécutifs), appel court-circuité")
+            self._essai_en_cours = True
+
+    def _succes(self):
+        with self._lock:
+            if self._echecs_consecutifs >= self.seuil_echecs:
+                print("--- ✅ Disjoncteur LLM refermé ---")
+            self._echecs_consecutifs = 0
+            self._essai_en_cours = False
+
+    def _echec(self):
+        with self._lock:
+            self._echecs_consecutifs += 1
+            self._essai_en_cours = False
+            if self._echecs_consecutifs >= self.seuil_echecs:
+                self._ouvert_jusqua = time.monotonic() + self.pause_disjoncteur
+                print(f"--- 🔌 Disjoncteur LLM ouvert pour {self.pause_disjoncteur}s ({self._echecs_consecutifs} échecs consécutifs) ---")
+
+    def generer(self, corps):
+        """POST du corps JSON ; retourne la réponse décodée, ou lève une exception (DisjoncteurOuvert sans aucun appel).
+
+        Toute sortie sans verdict (exception inattendue) compte comme un échec : l'essai du disjoncteur est toujours libéré.
+        """
+        self._autoriser()
+        conclu = False
+        try:
+            session = self._session_http()
+            for tentative in range(1, self.tentatives + 1):
+                retry_after = None
+                try:
+                    response = session.post(self.url, json=corps, timeout=self.timeout)
+                    if response.status_code == 200:
+                        donnees = response.json()   # corps tronqué : ChunkedEncodingError / JSON invalide, retentés
+                        self._succes()
+                        conclu = True
+                        return donnees
+                except (requests.RequestException, ValueError) as e:
+                    erreur = f"{type(e).__name__} : {e}"
+                else:
+                    if response.status_code != 429 and response.status_code < 500:
+                        # L'amont répond : requête invalide, pas une panne (ni retry, ni disjoncteur)
+                        self._succes()
+                        conclu = True
+                        raise Exception(f"Erreur API {response.status_code}: {response.text[:500]}")
+                    erreur = f"Erreur API {response.status_code}"
+                    retry_after = response.headers.get('Retry-After')
+                if tentative == self.tentatives:
+                    break
+                pause = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (tentative - 1)))
+                if retry_after and retry_after.isdigit():
+                    pause = max(pause, min(self.backoff_max, float(retry_after)))
+                print(f"--- ⏳ {erreur}, nouvelle tentative LLM dans {round(pause, 1)}s ({tentative}/{self.tentatives}) ---")
+                time.sleep(pause)
+            raise Exception(f"LLM indisponible après {self.tentatives} tentative(s) : {erreur}")
+        finally:
+            if not conclu:
+                self._echec()
+
+CLIENT_LLM = ClientLLM(IA_API_URL, IA_CONNECT_TIMEOUT_SECONDS, IA_TIMEOUT_SECONDS, IA_HTTP_TENTATIVES,
+                       IA_BACKOFF_BASE_SECONDS, IA_BACKOFF_MAX_SECONDS, IA_DISJONCTEUR_SEUIL, IA_DISJONCTEUR_PAUSE_SECONDS)
+
 def appel_llm_ia(transaction):
-    global LAST_IA_CALL_TIME
-    
-    current_time = time.time()
-    time_since_last_call = current_time - LAST_IA_CALL_TIME
-    if time_since_last_call < IA_COOLDOWN_SECONDS:
-        wait_time = IA_COOLDOWN_SECONDS - time_since_last_call
-        print(f"--- ⚠️ RESPECT DU RATE LIMIT --- En attente de {round(wait_time, 1)}s...")
-        time.sleep(wait_time)
-    
-    print(f"--- 🧠 Appel au VRAI LLM (via REST API) pour : '{transaction['libelle']}' ---")
-    LAST_IA_CALL_TIME = time.time()
-    
-    categories_valides = [
-        "Charges Fixes", "Alimentation", "Abonnements", "Sorties",
-        "Shopping", "Santé", "Transport", "Épargne", "Autres"
-    ]
+    return appel_llm_ia_lot([transaction['libelle']])[0]
+
+def appel_llm_ia_lot(libelles):
+    """Classe plusieurs libellés en UN appel LLM ; retourne une classification par libellé, dans le même ordre.
+
+    Chaque entrée du tableau JSON renvoyé est validée séparément : une entrée absente ou illisible
+    donne « Erreur IA » (retentée par la file) sans invalider les autres.
+    """
+    # Le rate limit est appliqué par le worker de la file IA (LIMITEUR_IA), jamais dans une requête HTTP
+    print(f"--- 🧠 Appel au VRAI LLM (via REST API) pour {len(libelles)} libellé(s) : {libelles} ---")
+    erreur = lambda libelle: {'libelle_nettoye': libelle, 'categorie': 'A_VERIFIER', 'sous_categorie': 'Erreur IA'}
     
+    transactions_numerotees = "\n".join(f"    {i}: {json.dumps(libelle, ensure_ascii=False)}" for i, libelle in enumerate(libelles))
     prompt = f"""
     Tu es un expert en finances personnelles.
-    Analyse la transaction : "{transaction['libelle']}"
-    Tâches :
+    Analyse chacune des transactions suivantes (format "index: libellé") :
+{transactions_numerotees}
+    Tâches, pour CHAQUE transaction :
     1.  Propose un "libelle_nettoye" clair (ex: "Achat Fnac").
-    2.  Choisis la "categorie" la plus pertinente parmi cette liste : {json.dumps(categories_valides)}
+    2.  Choisis la "categorie" la plus pertinente parmi cette liste : {json.dumps(CATEGORIES_VALIDES, ensure_ascii=False)}
     RÈGLES CRITIQUES :
     -   Si tu ne peux pas deviner, utilise la catégorie "A_VERIFIER".
-    -   Ta réponse DOIT commencer par {{"et finir par }}".
+    -   Ta réponse DOIT être un tableau JSON avec un objet par transaction :
+        [{{"index": 0, "libelle_nettoye": "...", "categorie": "..."}}, ...]
     -   Ne réponds RIEN d'autre.
-    -   SEULEMENT l'objet JSON.
+    -   SEULEMENT le tableau JSON.
     """
     
     request_body = { "contents": [ { "parts": [ {"text": prompt} ] } ] }
     
+    debut = time.perf_counter()
     try:
-        response = requests.post(IA_API_URL, json=request_body, headers={'Content-Type': 'application/json'})
-        if response.status_code != 200:
-            raise Exception(f"Erreur API {response.status_code}: {response.text}")
-            
-        reponse_brute_ia = response.json()['candidates'][0]['content']['parts'][0]['text']
+        reponse_brute_ia = CLIENT_LLM.generer(request_body)['candidates'][0]['content']['parts'][0]['text']
         print(f"Réponse brute de l'IA : {reponse_brute_ia}")
 
-        resultat = extraire_json_de_reponse(reponse_brute_ia)
-        if resultat is None:
+        entrees = extraire_tableau_json_de_reponse(reponse_brute_ia)
+        if entrees is None:
             raise Exception("Impossible d'extraire le JSON de la réponse de l'IA.")
+    except DisjoncteurOuvert as e:
+        print(f"--- 🔌 {e} ---")
+        METRIQUES.incrementer('copilote_llm_appels_total', resultat='disjoncteur')
+        return [erreur(libelle) for libelle in libelles]
+    except Exception as e:
+        print(f"--- ERREUR lors de l'appel à l'IA (Requests) : {e} ---")
+        METRIQUES.incrementer('copilote_llm_appels_total', resultat='erreur')
+        METRIQUES.observer('copilote_llm_appel_duree_secondes', time.perf_counter() - debut)
+        return [erreur(libelle) for libelle in libelles]
+    METRIQUES.incrementer('copilote_llm_appels_total', resultat='succes')
+    METRIQUES.observer('copilote_llm_appel_duree_secondes', time.perf_counter() - debut)
+
+    resultats = [erreur(libelle) for libelle in libelles]
+    for position, entree in enumerate(entrees):
+        if not isinstance(entree, dict):
+            continue
+        index = entree.get('index', position if len(libelles) == 1 else None)
+        if not isinstance(index, int) or not 0 <= index < len(libelles):
+            continue
+        categorie = entree.get('categorie')
+        if categorie not in CATEGORIES_VALIDES:
+            categorie = 'A_VERIFIER'
+        libelle_nettoye = entree.get('libelle_nettoye')
+        resultats[index] = {
+            'libelle_nettoye': libelle_nettoye if isinstance(libelle_nettoye, str) and libelle_nettoye else libelles[index],
+            'categorie': categorie,
+            'sous_categorie': "Analysé par IA"
+        }
+    return resultats
 
-        if resultat.get('categorie') not in categories_valides and resultat.get('categorie') != 'A_VERIFIER':
-            resultat['categorie'] = 'A_VERIFIER'
+def classifier_transaction(transaction, user_id):
+    libelle_brut_upper = transaction['libelle'].upper()
+    texte = texte_de_recherche(transaction['libelle'])
+    
+    # NIVEAU 1 : BDD Personnelle (Le "Veto"), compilée en mémoire par utilisateur
+    with METRIQUES.chronometre('copilote_classification_etape_secondes', etape='regle_perso'):
+        regle_personnelle = CACHE_REGLES_PERSONNELLES.obtenir(user_id).rechercher(texte)
+    if regle_personnelle:
+        METRIQUES.incrementer('copilote_classifications_total', niveau='regle_perso')
+        return {**transaction, 'libelle_nettoye': regle_personnelle[0], 'categorie': regle_personnelle[1], 'sous_categorie': regle_personnelle[2], 'methode': 'Regle (Perso)'}
+
+    # NIVEAU 2 : Règles Générales (Le "Savoir Collectif" + Règles de Base), compilées en mémoire
+    with METRIQUES.chronometre('copilote_classification_etape_secondes', etape='regle_generale'):
+        rafraichir_regles_generales()
+        regle_generale = MATCHEUR_REGLES_GENERALES.rechercher(texte)
+    if regle_generale:
+        METRIQUES.incrementer('copilote_classifications_total', niveau='regle_generale')
+        return {**transaction, 'libelle_nettoye': regle_generale[0], 'categorie': regle_generale[1], 'sous_categorie': regle_generale[2], 'methode': 'Regle (Générale)'}
+
+    # NIVEAU 2 bis : Modèle local (n-grammes), le LLM n'est pas appelé s'il est assez confiant
+    with METRIQUES.chronometre('copilote_classification_etape_secondes', etape='modele_local'):
+        prediction = classification_modele_local(transaction['libelle'])
+    if prediction:
+        METRIQUES.incrementer('copilote_classifications_total', niveau='modele_local')
+        return {**transaction, **prediction}
             
+    # NIVEAU 3 : Moteur LLM (Le "Dernier Recours"), traité en arrière-plan par la file IA
+    with METRIQUES.chronometre('copilote_classification_etape_secondes', etape='file_ia'), get_db_connection() as conn:
+        cursor = conn.cursor()
+        resultat = mettre_en_file_ia(cursor, [libelle_brut_upper], user_id)[libelle_brut_upper]
+        conn.commit()
+        cursor.close()
+    METRIQUES.incrementer('copilote_classifications_total', niveau='file_ia')
+    REVEIL_WORKER_IA.set()
+    return {**transaction, 'libelle_nettoye': transaction['libelle'] if resultat['methode'] == 'IA (En attente)' else resultat['libelle_nettoye'],
+            'categorie': resultat['categorie'], 'sous_categorie': resultat['sous_categorie'], 'methode': resultat['methode']}
+
+def classifier_par_llm(transaction):
+    return classifier_par_llm_lot([transaction['libelle']])[0]
+
+def classifier_par_llm_lot(libelles):
+    """Appelle le LLM pour un lot de libellés et apprend une règle générale pour chaque catégorie trouvée."""
+    resultats = []
+    regles_apprises = []
+    for libelle, resultat_llm in zip(libelles, appel_llm_ia_lot(libelles)):
+        if resultat_llm['categorie'] != 'A_VERIFIER':
+            print(f"--- 🤖 APPRENTISSAGE AUTOMATIQUE (Général) ---")
+            sauvegarder_regle_generale(
+                mot_cle=libelle.upper(),
+                libelle_nettoye=resultat_llm['libelle_nettoye'],
+                categorie=resultat_llm['categorie'],
+                sous_categorie="Analysé par IA"
+            )
+            resultat_llm['methode'] = 'IA (Auto-Appris)'
+            regles_apprises.append((normaliser_libelle(libelle), resultat_llm['libelle_nettoye'], resultat_llm['categorie'], "Analysé par IA"))
+            METRIQUES.incrementer('copilote_llm_libelles_total', resultat='categorise')
+        else:
+            resultat_llm['methode'] = 'IA (A Vérifier)'
+            METRIQUES.incrementer('copilote_llm_libelles_total', resultat='erreur' if resultat_llm['sous_categorie'] == 'Erreur IA' else 'a_verifier')
+        resultats.append({
+            'libelle_nettoye': resultat_llm['libelle_nettoye'],
+            'categorie': resultat_llm['categorie'],
+            'sous_categorie': resultat_llm['sous_categorie'],
+            'methode': resultat_llm['methode']
+        })
+    planifier_reclassement_general(regles_apprises)
+    return resultats
+
+def charger_matcheur_personnel(user_id):
+    """Compile toutes les règles personnelles d'un utilisateur (une seule requête) pour les traitements par lot."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, mot_cle, libelle_nettoye, categorie, sous_categorie FROM regles_personnelles WHERE user_id = %s ORDER BY id",
+            (user_id,)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    matcheur = MatcheurMotsCles()
+    for regle_id, mot_cle, libelle_nettoye, categorie, sous_categorie in rows:
+        matcheur.ajouter(mot_cle, (libelle_nettoye, categorie, sous_categorie), ordre=regle_id)
+    return matcheur
+
+# --- CACHE DES RÈGLES PERSONNELLES (LRU par utilisateur + LISTEN/NOTIFY) ---
+CANAL_REGLES_PERSONNELLES = 'regles_personnelles'
+CACHE_PERSO_MAX_NOEUDS = int(os.environ.get('CACHE_PERSO_MAX_NOEUDS', 200000))   # borne mémoire : nœuds d'automate, tous utilisateurs
+CACHE_PERSO_TTL_SECONDS = 600   # filet de sécurité en plus des notifications
+CACHE_PERSO_PING_SECONDS = 30
+
+class CacheReglesPersonnelles:
+    """Matcheurs personnels compilés, par utilisateur, dans un LRU borné par le nombre total de nœuds d'automate.
+
+    Invalidation : NOTIFY sur le canal regles_personnelles (payload = user_id, ou '*' pour tout vider), écouté par
+    un thread par processus. Tant que l'écoute n'est pas active, le cache est contourné : jamais de règle périmée.
+    """
+
+    def __init__(self, max_noeuds, ttl):
+        self.max_noeuds = max_noeuds
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entrees = OrderedDict()   # user_id -> (matcheur, noeuds, charge_le)
+        self._noeuds = 0
+        self._generation = 0
+        self._ecoute_active = False
+        self._ecoute_pid = None
+        self._stats = {'hits': 0, 'miss': 0, 'evictions': 0, 'invalidations': 0}
+
+    def obtenir(self, user_id):
+        self._demarrer_ecoute()
+        user_id = str(user_id)
+        with self._lock:
+            entree = self._entrees.get(user_id)
+            if entree and self._ecoute_active and time.monotonic() - entree[2] < self.ttl:
+                self._entrees.move_to_end(user_id)
+                self._stats['hits'] += 1
+                return entree[0]
+            self._stats['miss'] += 1
+            generation = self._generation
+        matcheur = charger_matcheur_personnel(user_id)
+        with self._lock:
+            # Une invalidation arrivée pendant le chargement rend ce matcheur suspect : on ne le garde pas
+            if self._ecoute_active and generation == self._generation:
+                self._retirer(user_id)
+                noeuds = matcheur.nombre_noeuds()
+                self._entrees[user_id] = (matcheur, noeuds, time.monotonic())
+                self._noeuds += noeuds
+                while self._noeuds > self.max_noeuds and len(self._entrees) > 1:
+                    self._retirer(next(iter(self._entrees)))
+                    self._stats['evictions'] += 1
+        return matcheur
+
+    def _retirer(self, user_id):
+        entree = self._entrees.pop(user_id, None)
+        if entree:
+            self._noeuds -= entree[1]
+
+    def invalider(self, user_id):
+        with self._lock:
+            self._generation += 1
+            self._stats['invalidations'] += 1
+            if user_id == '*':
+                self._entrees.clear()
+                self._noeuds = 0
+            else:
+                self._retirer(str(user_id))
+
+    def _demarrer_ecoute(self):
+        if self._ecoute_pid == os.getpid():
+            return
+        with self._lock:
+            if self._ecoute_pid == os.getpid():
+                return
+            # Après un fork, le cache hérité du parent n'est plus couvert par une écoute
+            self._entrees.clear()
+            self._noeuds = 0
+            self._ecoute_active = False
+            threading.Thread(target=self._boucle_ecoute, name='ecoute-regles-perso', daemon=True).start()
+            self._ecoute_pid = os.getpid()
+
+    def _boucle_ecoute(self):
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(DATABASE_URL)
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CANAL_REGLES_PERSONNELLES}")
+                with self._lock:
+                    self._ecoute_active = True
+                while True:
+                    if select.select([conn], [], [], CACHE_PERSO_PING_SECONDS) == ([], [], []):
+                        with conn.cursor() as cursor:
+                            cursor.execute("SELECT 1")   # détecte une connexion morte
+                    conn.poll()
+                    while conn.notifies:
+                        self.invalider(conn.notifies.pop(0).payload)
+            except Exception as e:
+                print(f"--- ERREUR écoute des règles personnelles : {e} (cache vidé, reconnexion) ---")
+                with self._lock:
+                    self._ecoute_active = False
+                    self._generation += 1
+                    self._entrees.clear()
+                    self._noeuds = 0
+                if conn is not None and not conn.closed:
+                    conn.close()
+                time.sleep(5)
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, 'entrees': len(self._entrees), 'noeuds': self._noeuds, 'ecoute_active': self._ecoute_active}
+
+CACHE_REGLES_PERSONNELLES = CacheReglesPersonnelles(CACHE_PERSO_MAX_NOEUDS, CACHE_PERSO_TTL_SECONDS)
+
+def classifier_libelles(cursor, libelles, matcheur_personnel, user_id):
+    """Classe une liste de libellés DISTINCTS (en majuscules) via les niveaux Perso / Générale / Modèle local / LLM.
+
+    Les libellés inconnus des règles sont mis dans la file IA (dans la transaction de `cursor`).
+    Retourne {libelle: classification}.
+    """
+    rafraichir_regles_generales()
+    resultats = {}
+    inconnus = []
+    debut = time.perf_counter()
+    for libelle in libelles:
+        texte = texte_de_recherche(libelle)
+        regle = matcheur_personnel.rechercher(texte)
+        methode = 'Regle (Perso)'
+        if regle is None:
+            regle = MATCHEUR_REGLES_GENERALES.rechercher(texte)
+            methode = 'Regle (Générale)'
+        if regle is not None:
+            resultats[libelle] = {'libelle_nettoye': regle[0], 'categorie': regle[1], 'sous_categorie': regle[2], 'methode': methode}
+            METRIQUES.incrementer('copilote_classifications_total', niveau='regle_perso' if methode == 'Regle (Perso)' else 'regle_generale')
+        elif (prediction := classification_modele_local(libelle)) is not None:
+            resultats[libelle] = prediction
+            METRIQUES.incrementer('copilote_classifications_total', niveau='modele_local')
+        else:
+            inconnus.append(libelle)
+    METRIQUES.observer('copilote_classification_etape_secondes', time.perf_counter() - debut, etape='regles_lot')
+    if inconnus:
+        with METRIQUES.chronometre('copilote_classification_etape_secondes', etape='file_ia'):
+            resultats.update(mettre_en_file_ia(cursor, inconnus, user_id))
+        METRIQUES.incrementer('copilote_classifications_total', len(inconnus), niveau='file_ia')
+    return resultats
+
+# --- File de classification IA (non bloquante) ---
+# La file vit dans Postgres (table file_classification_ia) : elle est partagée par tous les workers,
+# survit aux redémarrages, et chaque worker la dépile dans un thread d'arrière-plan.
+CLASSIFICATION_EN_ATTENTE = {'categorie': 'A_VERIFIER', 'sous_categorie': 'En attente IA', 'methode': 'IA (En attente)'}
+
+class LimiteurIAPartage:
+    """Seau à jetons + quota journalier stockés dans Postgres : une seule cadence d'appels LLM pour tous les workers.
+
+    Le verrou de ligne sur limiteur_ia sérialise les prises de jeton ; quota_ia_jour sert aussi de registre de consommation.
+    """
+
+    def __init__(self, nom, appels_par_minute, capacite, appels_par_jour):
+        self.nom = nom
+        self.debit = appels_par_minute / 60
+        self.intervalle = 1 / self.debit   # secondes pour regagner un jeton
+        self.capacite = capacite
+        self.appels_par_jour = appels_par_jour
+
+    def _essayer(self):
+        """Prend un jeton si possible ; retourne 0, sinon le nombre de secondes à attendre avant de réessayer."""
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("INSERT INTO limiteur_ia (nom, jetons) VALUES (%s, %s) ON CONFLICT (nom) DO NOTHING", (self.nom, self.capacite))
+            cursor.execute("""
+                SELECT LEAST(%s, jetons + EXTRACT(EPOCH FROM clock_timestamp() - maj_le) * %s), clock_timestamp(),
+                       COALESCE((SELECT appels FROM quota_ia_jour WHERE jour = CURRENT_DATE), 0),
+                       EXTRACT(EPOCH FROM (CURRENT_DATE + 1) - LOCALTIMESTAMP)
+                FROM limiteur_ia WHERE nom = %s FOR UPDATE
+            """, (self.capacite, self.debit, self.nom))
+            jetons, instant, appels_jour, avant_minuit = cursor.fetchone()
+            jetons = float(jetons)
+            if self.appels_par_jour and appels_jour >= self.appels_par_jour:
+                attente = float(avant_minuit)
+            elif jetons < 1:
+                attente = (1 - jetons) / self.debit
+            else:
+                attente = 0
+                cursor.execute("UPDATE limiteur_ia SET jetons = %s, maj_le = %s WHERE nom = %s", (jetons - 1, instant, self.nom))
+                cursor.execute("""
+                    INSERT INTO quota_ia_jour (jour, appels) VALUES (CURRENT_DATE, 1)
+                    ON CONFLICT (jour) DO UPDATE SET appels = quota_ia_jour.appels + 1
+                """)
+                conn.commit()
+            cursor.close()
+        return attente
+
+    def attendre(self):
+        """Bloque jusqu'à obtenir un jeton ; retourne le temps attendu en secondes."""
+        debut = time.monotonic()
+        while True:
+            attente = self._essayer()
+            if attente == 0:
+                return time.monotonic() - debut
+            # Jamais plus d'un intervalle de recharge : un jeton pris de justesse par un autre worker ne coûte qu'un tour
+            time.sleep(min(attente, self.intervalle, IA_LIMITEUR_ATTENTE_MAX_SECONDS))
+
+    def rendre(self):
+        """Restitue un jeton pris pour rien (file vide) : ni la cadence ni le quota du jour ne sont consommés."""
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE limiteur_ia SET jetons = LEAST(%s, jetons + 1) WHERE nom = %s", (self.capacite, self.nom))
+            cursor.execute("UPDATE quota_ia_jour SET appels = appels - 1 WHERE jour = CURRENT_DATE AND appels > 0")
+            conn.commit()
+            cursor.close()
+
+    def usage(self, cursor):
+        cursor.execute("""
+            SELECT LEAST(%s, jetons + EXTRACT(EPOCH FROM clock_timestamp() - maj_le) * %s) FROM limiteur_ia WHERE nom = %s
+        """, (self.capacite, self.debit, self.nom))
+        row = cursor.fetchone()
+        cursor.execute("SELECT appels, libelles FROM quota_ia_jour WHERE jour = CURRENT_DATE")
+        appels_jour, libelles_jour = cursor.fetchone() or (0, 0)
         return {
-            'libelle_nettoye': resultat.get('libelle_nettoye', transaction['libelle']),
-            'categorie': resultat.get('categorie', 'A_VERIFIER'),
-            'sous_categorie': "Analysé par IA"
+            'appels_par_minute': round(self.debit * 60, 3),
+            'rafale': self.capacite,
+            'jetons_disponibles': round(float(row[0]), 3) if row else self.capacite,
+            'appels_aujourd_hui': appels_jour,
+            'libelles_aujourd_hui': libelles_jour,
+            'quota_appels_jour': self.appels_par_jour or None,
         }
-        
-    except Exception as e:
-        print(f"--- ERREUR lors de l'appel à l'IA (Requests) : {e} ---")
-        return {'libelle_nettoye': transaction['libelle'], 'categorie': 'A_VERIFIER', 'sous_categorie': 'Erreur IA'}
 
-def classifier_transaction(transaction, user_id):
-    libelle_brut_upper = transaction['libelle'].upper()
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # NIVEAU 1 : BDD Personnelle (Le "Veto")
-    cursor.execute(
-        "SELECT libelle_nettoye, categorie, sous_categorie FROM regles_personnelles WHERE user_id = %s AND %s LIKE '%%' || mot_cle || '%%'",
-        (user_id, libelle_brut_upper)
-    )
-    regle_personnelle = cursor.fetchone()
-    if regle_personnelle:
-        conn.close()
-        return {**transaction, 'libelle_nettoye': regle_personnelle[0], 'categorie': regle_personnelle[1], 'sous_categorie': regle_personnelle[2], 'methode': 'Regle (Perso)'}
+LIMITEUR_IA = LimiteurIAPartage('gemini', IA_APPELS_PAR_MINUTE, IA_RAFALE, IA_APPELS_PAR_JOUR)
+REVEIL_WORKER_IA = threading.Event()
+WORKER_IA_PID = None
+WORKER_IA_LOCK = threading.Lock()
+
+def mettre_en_file_ia(cursor, libelles, user_id):
+    """Place les libellés (majuscules) dans la file IA et retourne leur classification provisoire.
+
+    Un libellé déjà traité par l'IA (catégorisé ou jugé « A_VERIFIER ») n'est pas redemandé : son résultat est
+    retourné tel quel, même si ce worker n'a pas encore rechargé la règle générale apprise. Une erreur IA est retentée.
+    `user_id` devient le demandeur du libellé (pour l'équité entre utilisateurs) s'il n'est pas déjà en file.
+    """
+    cursor.execute("""
+        SELECT libelle, libelle_nettoye, categorie, sous_categorie, methode FROM file_classification_ia
+        WHERE libelle = ANY(%s) AND statut = 'TERMINE' AND sous_categorie IS DISTINCT FROM 'Erreur IA'
+    """, (list(libelles),))
+    resultats = {
+        libelle: {'libelle_nettoye': libelle_nettoye, 'categorie': categorie, 'sous_categorie': sous_categorie, 'methode': methode}
+        for libelle, libelle_nettoye, categorie, sous_categorie, methode in cursor.fetchall()
+    }
+    a_demander = [libelle for libelle in libelles if libelle not in resultats]
+    if a_demander:
+        execute_values(cursor, """
+            INSERT INTO file_classification_ia (libelle, demandeur) VALUES %s
+            ON CONFLICT (libelle) DO UPDATE SET statut = 'EN_ATTENTE', tentatives = 0, cree_le = CURRENT_TIMESTAMP,
+                demandeur = EXCLUDED.demandeur
+            WHERE file_classification_ia.statut = 'TERMINE' AND file_classification_ia.sous_categorie = 'Erreur IA'
+        """, [(libelle, user_id) for libelle in a_demander])
+        demarrer_worker_ia()
+    for libelle in a_demander:
+        resultats[libelle] = {'libelle_nettoye': libelle, **CLASSIFICATION_EN_ATTENTE}
+    return resultats
+
+def tache_ia_disponible(t):
+    return f"""
+        ({t}.statut = 'EN_ATTENTE' OR ({t}.statut = 'EN_COURS' AND {t}.pris_le < CURRENT_TIMESTAMP - make_interval(secs => %(bail)s)))
+    """
+
+def file_ia_a_traiter():
+    """Vrai si reserver_taches_ia trouverait au moins un libellé : lecture seule, sans verrou ni jeton du limiteur."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            SELECT EXISTS (
+                SELECT 1 FROM file_classification_ia c
+                LEFT JOIN usage_ia_utilisateurs u ON u.user_id = c.demandeur AND u.jour = CURRENT_DATE
+                WHERE {tache_ia_disponible('c')}
+                  AND (%(quota)s = 0 OR COALESCE(u.libelles, 0) < %(quota)s)
+            )
+        """, {'bail': IA_QUEUE_BAIL_SECONDS, 'quota': IA_LIBELLES_PAR_UTILISATEUR_JOUR})
+        a_traiter = cursor.fetchone()[0]
+        cursor.close()
+    return a_traiter
+
+def reserver_taches_ia(limite):
+    """Réserve jusqu'à `limite` libellés de la file ; un libellé EN_COURS n'est jamais envoyé deux fois au LLM.
+
+    Équité : les demandeurs passent à tour de rôle, en commençant par ceux qui ont le moins consommé aujourd'hui,
+    et un demandeur au quota IA_LIBELLES_PAR_UTILISATEUR_JOUR attend le lendemain.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"""
+            WITH taches AS (
+                UPDATE file_classification_ia SET statut = 'EN_COURS', pris_le = CURRENT_TIMESTAMP, tentatives = tentatives + 1
+                WHERE libelle IN (
+                    SELECT f.libelle FROM file_classification_ia f
+                    JOIN (
+                        SELECT c.libelle,
+                               COALESCE(u.libelles, 0) + ROW_NUMBER() OVER (PARTITION BY c.demandeur ORDER BY c.cree_le) AS rang
+                        FROM file_classification_ia c
+                        LEFT JOIN usage_ia_utilisateurs u ON u.user_id = c.demandeur AND u.jour = CURRENT_DATE
+                        WHERE {tache_ia_disponible('c')}
+                    ) r ON r.libelle = f.libelle
+                    WHERE {tache_ia_disponible('f')}
+                      AND (%(quota)s = 0 OR r.rang <= %(quota)s)
+                    ORDER BY r.rang, f.cree_le
+                    LIMIT %(limite)s
+                    FOR UPDATE OF f SKIP LOCKED
+                )
+                RETURNING libelle, tentatives, demandeur
+            ), usage_utilisateurs AS (
+                INSERT INTO usage_ia_utilisateurs (user_id, jour, libelles)
+                SELECT demandeur, CURRENT_DATE, COUNT(*) FROM taches WHERE demandeur IS NOT NULL GROUP BY demandeur
+                ON CONFLICT (user_id, jour) DO UPDATE SET libelles = usage_ia_utilisateurs.libelles + EXCLUDED.libelles
+            ), usage_global AS (
+                INSERT INTO quota_ia_jour (jour, libelles)
+                SELECT CURRENT_DATE, COUNT(*) FROM taches HAVING COUNT(*) > 0
+                ON CONFLICT (jour) DO UPDATE SET libelles = quota_ia_jour.libelles + EXCLUDED.libelles
+            )
+            SELECT libelle, tentatives FROM taches
+        """, {'bail': IA_QUEUE_BAIL_SECONDS, 'quota': IA_LIBELLES_PAR_UTILISATEUR_JOUR, 'limite': limite})
+        taches = cursor.fetchall()
+        conn.commit()
+        cursor.close()
+    return taches
+
+def appliquer_resultats_ia(cursor, user_id=None):
+    """Reporte les résultats IA terminés sur les transactions encore « En attente » (rattrape les courses d'insertion)."""
+    user_ids = verrouiller_utilisateurs(cursor, """
+        SELECT t.user_id FROM transactions t JOIN file_classification_ia f ON UPPER(t.libelle) = f.libelle
+        WHERE t.methode = 'IA (En attente)' AND f.statut = 'TERMINE' AND (%s::INTEGER IS NULL OR t.user_id = %s::INTEGER)
+    """, (user_id, user_id))
+    if not user_ids:
+        return 0
+    cursor.execute("""
+        WITH maj AS (
+            UPDATE transactions t
+            SET libelle_nettoye = f.libelle_nettoye, categorie = f.categorie, sous_categorie = f.sous_categorie, methode = f.methode
+            FROM file_classification_ia f
+            WHERE t.methode = 'IA (En attente)' AND UPPER(t.libelle) = f.libelle AND f.statut = 'TERMINE'
+              AND t.user_id = ANY(%s::INTEGER[])
+            RETURNING t.user_id
+        ), versions AS (
+            UPDATE utilisateurs SET version_transactions = version_transactions + 1
+            WHERE id IN (SELECT user_id FROM maj)
+        )
+        SELECT COUNT(*) FROM maj
+    """, (user_ids,))
+    return cursor.fetchone()[0]
+
+def verrouiller_utilisateurs(cursor, requete_user_ids, parametres=()):
+    """Verrouille, dans l'ordre des id, les utilisateurs qu'une instruction multi-utilisateurs va modifier ; retourne leurs id.
+
+    Le trigger de suivi des modifications verrouille la ligne utilisateur au fil des lignes écrites, donc dans un
+    ordre arbitraire : deux instructions qui se chevauchent (workers IA, reclassement) pourraient s'interbloquer.
+    L'instruction doit ensuite se limiter à ces utilisateurs (t.user_id = ANY(...)).
+    """
+    cursor.execute(f"""
+        SELECT id FROM utilisateurs WHERE id IN ({requete_user_ids}) ORDER BY id FOR NO KEY UPDATE
+    """, parametres)
+    return [row[0] for row in cursor.fetchall()]
+
+def marquer_transactions_modifiees(cursor, user_ids):
+    """Incrémente le compteur de version des transactions (sert d'ETag) ; à appeler dans la transaction qui modifie."""
+    cursor.execute(
+        "UPDATE utilisateurs SET version_transactions = version_transactions + 1 WHERE id = ANY(%s::INTEGER[])",
+        (list(user_ids),)
+    )
+
+def enregistrer_resultats_ia(taches, resultats):
+    """Enregistre les résultats d'un lot ; les erreurs IA repassent EN_ATTENTE tant qu'il reste des tentatives."""
+    lignes = []
+    for (libelle, tentatives), resultat in zip(taches, resultats):
+        reessayer = resultat['sous_categorie'] == 'Erreur IA' and tentatives < IA_MAX_TENTATIVES
+        lignes.append((libelle, 'EN_ATTENTE' if reessayer else 'TERMINE', resultat['libelle_nettoye'],
+                       resultat['categorie'], resultat['sous_categorie'], resultat['methode']))
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        execute_values(cursor, """
+            UPDATE file_classification_ia AS f
+            SET statut = v.statut, libelle_nettoye = v.libelle_nettoye, categorie = v.categorie,
+                sous_categorie = v.sous_categorie, methode = v.methode, resolu_le = CURRENT_TIMESTAMP
+            FROM (VALUES %s) AS v (libelle, statut, libelle_nettoye, categorie, sous_categorie, methode)
+            WHERE f.libelle = v.libelle
+        """, lignes)
+        nb_transactions = appliquer_resultats_ia(cursor)
+        conn.commit()
+        cursor.close()
+    termines = sum(1 for ligne in lignes if ligne[1] == 'TERMINE')
+    print(f"--- 📬 File IA : {termines}/{len(lignes)} libellé(s) résolu(s), {nb_transactions} transaction(s) mise(s) à jour ---")
+
+def boucle_worker_ia():
+    while True:
+        try:
+            # Disjoncteur ouvert : on laisse la file intacte plutôt que d'épuiser les tentatives des libellés
+            pause = CLIENT_LLM.attente_disjoncteur()
+            if pause > 0:
+                time.sleep(pause)
+                continue
+            # File vide : on attend sans toucher au seau partagé (un worker inactif ne prend ni ne rend de jeton)
+            if not file_ia_a_traiter():
+                REVEIL_WORKER_IA.wait(IA_QUEUE_POLL_SECONDS)
+                REVEIL_WORKER_IA.clear()
+                continue
+            # Un jeton du limiteur = un appel LLM, quel que soit le nombre de libellés du lot
+            attente = LIMITEUR_IA.attendre()
+            taches = reserver_taches_ia(IA_TAILLE_LOT)
+            if not taches:
+                # Un autre worker a vidé la file pendant l'attente du jeton
+                LIMITEUR_IA.rendre()
+                continue
+            METRIQUES.observer('copilote_llm_attente_limiteur_secondes', attente)
+            if attente > 1:
+                print(f"--- ⚠️ RESPECT DU RATE LIMIT --- {round(attente, 1)}s d'attente avant un lot de {len(taches)} libellé(s)")
+            enregistrer_resultats_ia(taches, classifier_par_llm_lot([libelle for libelle, _ in taches]))
+        except Exception as e:
+            print(f"--- ERREUR dans le worker de la file IA : {e} ---")
+            time.sleep(IA_QUEUE_POLL_SECONDS)
+
+def demarrer_worker_ia():
+    """Démarre (une fois par processus, y compris après un fork gunicorn) le thread qui dépile la file IA."""
+    global WORKER_IA_PID
+    if WORKER_IA_PID == os.getpid():
+        return
+    with WORKER_IA_LOCK:
+        if WORKER_IA_PID == os.getpid():
+            return
+        threading.Thread(target=boucle_worker_ia, name='worker-file-ia', daemon=True).start()
+        WORKER_IA_PID = os.getpid()
+
+# --- Import de relevés bancaires (CSV / OFX) ---
+IMPORT_BATCH_SIZE = 1000
+IMPORT_FORMATS_DATE = ('%d/%m/%Y', '%d/%m/%y', '%Y-%m-%d', '%d-%m-%Y', '%d.%m.%Y', '%Y%m%d')
+IMPORT_COLONNES_LIBELLE = ('libelle', 'libelle operation', 'libelle simplifie', 'label', 'description', 'intitule', 'detail', 'memo', 'name')
+IMPORT_COLONNES_MONTANT = ('montant', 'montant eur', 'montant (eur)', 'amount', 'valeur')
+
+def _normaliser_entete(entete):
+    entete = unicodedata.normalize('NFKD', entete).encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(entete.strip().lower().split())
+
+def parser_montant(valeur):
+    valeur = (valeur or '').replace('\xa0', '').replace(' ', '').replace('€', '').replace('EUR', '').strip()
+    if not valeur:
+        return None
+    if ',' in valeur and '.' in valeur:
+        valeur = valeur.replace('.', '') if valeur.rfind(',') > valeur.rfind('.') else valeur.replace(',', '')
+    try:
+        return float(valeur.replace(',', '.'))
+    except ValueError:
+        return None
+
+def parser_date(valeur):
+    valeur = (valeur or '').strip()
+    for format_date in IMPORT_FORMATS_DATE:
+        try:
+            candidat = valeur[:8] if format_date == '%Y%m%d' else valeur
+            return datetime.strptime(candidat, format_date).date().isoformat()
+        except ValueError:
+            continue
+    return None
 
-    # NIVEAU 2 : BDD Générale (Le "Savoir Collectif" + Règles de Base)
-    cursor.execute(
-        "SELECT libelle_nettoye, categorie, sous_categorie FROM regles_generales WHERE %s LIKE '%%' || mot_cle || '%%'",
-        (libelle_brut_upper,)
-    )
-    regle_generale = cursor.fetchone()
-    if regle_generale:
-        conn.close()
-        return {**transaction, 'libelle_nettoye': regle_generale[0], 'categorie': regle_generale[1], 'sous_categorie': regle_generale[2], 'methode': 'Regle (Générale)'}
+def lire_lignes_csv(flux_texte, premiere_ligne):
+    """Générateur de (date, libelle, montant) ou None pour une ligne illisible. Séparateur et colonnes détectés depuis l'en-tête."""
+    separateur = max(';', ',', '\t', key=premiere_ligne.count)
+    entetes = [_normaliser_entete(e) for e in next(csv.reader([premiere_ligne], delimiter=separateur))]
 
-    cursor.close()
-    conn.close()
-            
-    # NIVEAU 3 : Moteur LLM (Le "Dernier Recours")
-    resultat_llm = appel_llm_ia(transaction)
-    
-    if resultat_llm['categorie'] != 'A_VERIFIER':
-        print(f"--- 🤖 APPRENTISSAGE AUTOMATIQUE (Général) ---")
-        sauvegarder_regle_generale(
-            mot_cle=libelle_brut_upper,
-            libelle_nettoye=resultat_llm['libelle_nettoye'],
-            categorie=resultat_llm['categorie'],
-            sous_categorie="Analysé par IA"
-        )
-        resultat_llm['methode'] = 'IA (Auto-Appris)'
-    else:
-        resultat_llm['methode'] = 'IA (A Vérifier)'
+    def index_de(candidats):
+        for i, entete in enumerate(entetes):
+            if entete in candidats:
+                return i
+        return None
 
-    return {
-        **transaction,
-        'libelle_nettoye': resultat_llm['libelle_nettoye'],
-        'categorie': resultat_llm['categorie'],
-        'sous_categorie': resultat_llm['sous_categorie'],
-        'methode': resultat_llm['methode']
-    }
+    i_date = next((i for i, e in enumerate(entetes) if e.startswith('date')), None)
+    i_libelle = index_de(IMPORT_COLONNES_LIBELLE)
+    i_montant = index_de(IMPORT_COLONNES_MONTANT)
+    i_debit = index_de(('debit', 'debit eur'))
+    i_credit = index_de(('credit', 'credit eur'))
+    if i_date is None or i_libelle is None or (i_montant is None and i_debit is None and i_credit is None):
+        raise ValueError(f"En-têtes CSV non reconnus : {entetes}")
+
+    for cellules in csv.reader(flux_texte, delimiter=separateur):
+        if not any(c.strip() for c in cellules):
+            continue
+        try:
+            if i_montant is not None:
+                montant = parser_montant(cellules[i_montant])
+            else:
+                debit = parser_montant(cellules[i_debit]) if i_debit is not None else None
+                credit = parser_montant(cellules[i_credit]) if i_credit is not None else None
+                montant = None if debit is None and credit is None else (credit or 0) - abs(debit or 0)
+            date = parser_date(cellules[i_date])
+            libelle = ' '.join(cellules[i_libelle].split())
+        except IndexError:
+            yield None
+            continue
+        yield (date, libelle, montant) if date and libelle and montant is not None else None
+
+def lire_lignes_ofx(flux_texte, premiere_ligne, taille_bloc=65536):
+    """Générateur de (date, libelle, montant) lu bloc par bloc dans les <STMTTRN> d'un fichier OFX (SGML ou XML)."""
+    tampon = premiere_ligne
+    while True:
+        morceau = flux_texte.read(taille_bloc)
+        tampon += morceau
+        while True:
+            debut = tampon.find('<STMTTRN>')
+            fin = tampon.find('</STMTTRN>', debut)
+            if debut == -1 or fin == -1:
+                break
+            champs = dict(
+                (tag.upper(), valeur.strip())
+                for tag, valeur in re.findall(r'<(\w+)>([^<\r\n]*)', tampon[debut + 9:fin])
+            )
+            tampon = tampon[fin + 10:]
+            date = parser_date(champs.get('DTPOSTED'))
+            libelle = ' '.join(' '.join(filter(None, (champs.get('NAME'), champs.get('MEMO')))).split())
+            montant = parser_montant(champs.get('TRNAMT'))
+            yield (date, libelle, montant) if date and libelle and montant is not None else None
+        if not morceau:
+            break
+        if '<STMTTRN>' not in tampon:
+            tampon = tampon[-9:]
+
+def inserer_transactions(cursor, user_id, transactions):
+    """INSERT multi-lignes (execute_values) ; retourne les ids dans l'ordre des transactions."""
+    rows = execute_values(cursor, """
+        INSERT INTO transactions (user_id, date, libelle, libelle_nettoye, montant, categorie, sous_categorie, methode)
+        VALUES %s
+        RETURNING id
+    """, [
+        (user_id, tx['date'], tx['libelle'], tx['libelle_nettoye'], tx['montant'], tx['categorie'], tx['sous_categorie'], tx['methode'])
+        for tx in transactions
+    ], page_size=IMPORT_BATCH_SIZE, fetch=True)
+    return [row[0] for row in rows]
 
 # --- 4. Routes de l'API ---
+@app.before_request
+def debut_requete():
+    g.debut_requete = time.perf_counter()
+
+@app.after_request
+def journaliser_requete(reponse):
+    """Durée de chaque requête (histogramme par route) + une ligne de log JSON par requête."""
+    if 'debut_requete' in g:
+        duree = time.perf_counter() - g.debut_requete
+        route = request.endpoint or 'inconnue'
+        METRIQUES.observer('copilote_requete_duree_secondes', duree, route=route, methode=request.method, statut=str(reponse.status_code))
+        print(json.dumps({
+            'evenement': 'requete', 'methode': request.method, 'chemin': request.path, 'route': route,
+            'statut': reponse.status_code, 'duree_ms': round(duree * 1000, 2), 'pid': os.getpid(),
+        }), flush=True)
+    return reponse
+
 @app.route('/')
 def home():
     return render_template('index.html')
@@ -322,17 +2423,16 @@ def api_signup():
     password = data.get('password')
     if not email or not password:
         return jsonify({"msg": "Email et mot de passe requis"}), 400
-    pw_hash = bcrypt.generate_password_hash(password).decode('utf-8')
+    pw_hash = executer_bcrypt(bcrypt.generate_password_hash, password).decode('utf-8')
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO utilisateurs (email, password_hash) VALUES (%s, %s)",
-            (email, pw_hash)
-        )
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT INTO utilisateurs (email, password_hash) VALUES (%s, %s)",
+                (email, pw_hash)
+            )
+            conn.commit()
+            cursor.close()
         return jsonify({"msg": "Utilisateur créé avec succès"}), 201
     except Exception as e:
         print(f"Erreur BDD (signup) : {e}")
@@ -345,56 +2445,339 @@ def api_login():
     password = data.get('password')
     if not email or not password:
         return jsonify({"msg": "Email et mot de passe requis"}), 400
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, password_hash FROM utilisateurs WHERE email = %s", (email,))
-    user = cursor.fetchone()
-    cursor.close()
-    conn.close()
-    if user and bcrypt.check_password_hash(user[1], password):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, password_hash FROM utilisateurs WHERE email = %s", (email,))
+        user = cursor.fetchone()
+        cursor.close()
+    if user and executer_bcrypt(bcrypt.check_password_hash, user[1], password):
         user_id = user[0]
         access_token = create_access_token(identity=str(user_id))
         return jsonify(access_token=access_token)
     else:
         return jsonify({"msg": "Email ou mot de passe incorrect"}), 401
 
+def transaction_depuis_ligne(row):
+    """(id, date, libelle, libelle_nettoye, montant, categorie, sous_categorie, methode, updated_at) -> dict JSON (dates ISO, montant float)."""
+    return {
+        'id': str(row[0]),
+        'date': row[1].isoformat() if hasattr(row[1], 'isoformat') else row[1],
+        'libelle': row[2],
+        'libelle_nettoye': row[3],
+        'montant': float(row[4]),
+        'categorie': row[5],
+        'sous_categorie': row[6],
+        'methode': row[7],
+        'updated_at': row[8].isoformat() if row[8] is not None else None
+    }
+
+def encoder_curseur(date, transaction_id):
+    return base64.urlsafe_b64encode(json.dumps([str(date), transaction_id]).encode()).decode().rstrip('=')
+
+def decoder_curseur(curseur):
+    try:
+        date, transaction_id = json.loads(base64.urlsafe_b64decode(curseur + '=' * (-len(curseur) % 4)))
+        return str(date), int(transaction_id)
+    except (ValueError, TypeError):
+        raise ValueError("Curseur invalide")
+
+def encoder_jeton_synchro(seq, transaction_id=None):
+    """[seq] : tout ce qui est <= seq a été reçu. [seq, id] : reprise au milieu d'une séquence (page pleine)."""
+    valeur = [seq] if transaction_id is None else [seq, transaction_id]
+    return base64.urlsafe_b64encode(json.dumps(valeur).encode()).decode().rstrip('=')
+
+def decoder_jeton_synchro(jeton):
+    try:
+        valeur = json.loads(base64.urlsafe_b64decode(jeton + '=' * (-len(jeton) % 4)))
+        if not isinstance(valeur, list) or len(valeur) not in (1, 2):
+            raise ValueError
+        return int(valeur[0]), (int(valeur[1]) if len(valeur) == 2 else None)
+    except (ValueError, TypeError):
+        raise ValueError("Jeton de synchronisation invalide")
+
+def lire_date_iso(valeur):
+    if not valeur:
+        return None
+    try:
+        return datetime.strptime(valeur, '%Y-%m-%d').date().isoformat()
+    except ValueError:
+        raise ValueError(f"Date invalide (format attendu AAAA-MM-JJ) : {valeur}")
+
 # 🆕 NOUVELLE ROUTE : Récupérer les transactions d'un utilisateur
+# Pagination par curseur sur (date, id) : ?limit=&cursor=&from=&to=. Le curseur de la page suivante
+# est renvoyé dans l'en-tête X-Curseur-Suivant. Une liste inchangée coûte un 304 (If-None-Match).
+# Le corps est produit en flux par blocs (pagination par clé, une courte transaction par bloc), compressé selon
+# Accept-Encoding ; ?format=colonnes renvoie des blocs {champ: [valeurs]} au lieu d'un objet par transaction.
+TRANSACTIONS_LIMITE_DEFAUT = 500
+TRANSACTIONS_LIMITE_MAX = 5000
+
+TRANSACTIONS_TAILLE_BLOC = 1000
+CHAMPS_TRANSACTION = ('id', 'date', 'libelle', 'libelle_nettoye', 'montant', 'categorie', 'sous_categorie', 'methode', 'updated_at')
+
+def json_en_octets(valeur):
+    if orjson is not None:
+        return orjson.dumps(valeur)
+    return json.dumps(valeur, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def blocs_transactions(conditions, parametres):
+    """Produit, dans l'ordre (date, id), des listes d'au plus TRANSACTIONS_TAILLE_BLOC transactions (dict).
+
+    Pagination par clé (index user_id, date, id) : une courte transaction et un emprunt au pool par bloc. Un client
+    lent n'immobilise ni une connexion du pool ni un instantané (qui retiendrait le vacuum) pendant tout l'envoi.
+    """
+    dernier = None
+    while True:
+        conditions_bloc = list(conditions)
+        parametres_bloc = list(parametres)
+        if dernier:
+            conditions_bloc.append("(date, id) > (%s, %s)")
+            parametres_bloc.extend(dernier)
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT id, date, libelle, libelle_nettoye, montant, categorie, sous_categorie, methode, updated_at
+                FROM transactions
+                WHERE {' AND '.join(conditions_bloc)}
+                ORDER BY date ASC, id ASC
+                LIMIT %s
+            """, (*parametres_bloc, TRANSACTIONS_TAILLE_BLOC))
+            rows = cursor.fetchall()
+            conn.commit()
+            cursor.close()
+        if rows:
+            yield [transaction_depuis_ligne(row) for row in rows]
+        if len(rows) < TRANSACTIONS_TAILLE_BLOC:
+            return
+        dernier = (rows[-1][1], rows[-1][0])
+
+def flux_json_transactions(conditions, parametres, colonnes=False):
+    """Produit le JSON au fil de l'eau, bloc par bloc : mémoire constante.
+
+    Format par défaut : tableau d'objets. `colonnes` : tableau de blocs {champ: [valeurs]} (clés écrites une fois par bloc).
+    """
+    yield b'['
+    separateur = b''
+    for transactions in blocs_transactions(conditions, parametres):
+        if colonnes:
+            morceau = json_en_octets({champ: [tx[champ] for tx in transactions] for champ in CHAMPS_TRANSACTION})
+        else:
+            morceau = json_en_octets(transactions)[1:-1]
+        yield separateur + morceau
+        separateur = b','
+    yield b']'
+
+def encodage_negocie():
+    """Meilleur encodage accepté par le client parmi ceux disponibles (br si le module brotli est installé), ou None."""
+    disponibles = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return request.accept_encodings.best_match(disponibles)
+
+def compresser_flux(morceaux, encodage):
+    if encodage == 'br':
+        compresseur = brotli.Compressor(quality=5)
+        compresser, terminer = compresseur.process, compresseur.finish
+    else:
+        compresseur = zlib.compressobj(6, zlib.DEFLATED, 31)   # wbits=31 : en-tête gzip
+        compresser, terminer = compresseur.compress, compresseur.flush
+    for morceau in morceaux:
+        donnees = compresser(morceau)
+        if donnees:
+            yield donnees
+    yield terminer()
+
 @app.route('/api/transactions', methods=['GET'])
 @jwt_required()
 def api_get_transactions():
     user_id = get_jwt_identity()
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, date, libelle, libelle_nettoye, montant, categorie, sous_categorie, methode
-            FROM transactions
-            WHERE user_id = %s
-            ORDER BY date ASC
-        """, (user_id,))
-        
-        rows = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        
-        transactions = []
-        for row in rows:
-            transactions.append({
-                'id': str(row[0]),
-                'date': row[1],
-                'libelle': row[2],
-                'libelle_nettoye': row[3],
-                'montant': row[4],
-                'categorie': row[5],
-                'sous_categorie': row[6],
-                'methode': row[7]
-            })
+        limite = min(max(request.args.get('limit', TRANSACTIONS_LIMITE_DEFAUT, type=int), 1), TRANSACTIONS_LIMITE_MAX)
+        date_debut = lire_date_iso(request.args.get('from'))
+        date_fin = lire_date_iso(request.args.get('to'))
+        curseur = decoder_curseur(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError as e:
+        return jsonify({"msg": str(e)}), 400
+    colonnes = request.args.get('format') == 'colonnes'
+    
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT version_transactions FROM utilisateurs WHERE id = %s", (user_id,))
+            row = cursor.fetchone()
+            version = row[0] if row else 0
+            # ETag faible : le même contenu peut partir compressé (gzip / br) ou non
+            etag = f"{user_id}-{version}-{zlib.crc32(request.query_string):08x}"
+            if request.if_none_match.contains_weak(etag):
+                cursor.close()
+                reponse = app.response_class(status=304)
+                reponse.set_etag(etag, weak=True)
+                reponse.headers['Cache-Control'] = 'private, no-cache'
+                reponse.vary.update(('Authorization', 'Accept-Encoding'))
+                return reponse
+            
+            conditions = ["user_id = %s"]
+            parametres = [user_id]
+            if date_debut:
+                conditions.append("date >= %s")
+                parametres.append(date_debut)
+            if date_fin:
+                conditions.append("date <= %s")
+                parametres.append(date_fin)
+            if curseur:
+                conditions.append("(date, id) > (%s, %s)")
+                parametres.extend(curseur)
+            # Borne de la page lue AVANT le flux (l'en-tête part avant le corps) : parcours d'index seulement
+            cursor.execute(f"""
+                SELECT date, id FROM transactions
+                WHERE {' AND '.join(conditions)}
+                ORDER BY date ASC, id ASC
+                OFFSET %s LIMIT 2
+            """, (*parametres, limite - 1))
+            bornes = cursor.fetchall()
+            cursor.close()
         
-        return jsonify(transactions)
+        curseur_suivant = None
+        if len(bornes) == 2:
+            # La page s'arrête sur la borne (et non sur un LIMIT) : une insertion entre les deux requêtes ne fait sauter aucune ligne
+            conditions.append("(date, id) <= (%s, %s)")
+            parametres.extend(bornes[0])
+            curseur_suivant = encoder_curseur(bornes[0][0], bornes[0][1])
+        corps = stream_with_context(flux_json_transactions(conditions, parametres, colonnes))
+        encodage = encodage_negocie()
+        if encodage:
+            corps = compresser_flux(corps, encodage)
+        reponse = app.response_class(corps, mimetype='application/json')
+        if encodage:
+            reponse.headers['Content-Encoding'] = encodage
+        if curseur_suivant:
+            reponse.headers['X-Curseur-Suivant'] = curseur_suivant
+        reponse.set_etag(etag, weak=True)
+        reponse.headers['Cache-Control'] = 'private, no-cache'
+        reponse.vary.update(('Authorization', 'Accept-Encoding'))
+        return reponse
     except Exception as e:
         print(f"Erreur lors de la récupération des transactions : {e}")
         return jsonify({"msg": "Erreur serveur"}), 500
 
+# 🆕 ROUTE : Export complet en flux (CSV réimportable via /api/transactions/import, ou JSON Lines)
+@app.route('/api/transactions/export', methods=['GET'])
+@jwt_required()
+def api_export_transactions():
+    user_id = get_jwt_identity()
+    format_export = request.args.get('format', 'csv')
+    if format_export not in ('csv', 'jsonl'):
+        return jsonify({"msg": "Format inconnu (csv ou jsonl)"}), 400
+    try:
+        date_debut = lire_date_iso(request.args.get('from'))
+        date_fin = lire_date_iso(request.args.get('to'))
+    except ValueError as e:
+        return jsonify({"msg": str(e)}), 400
+
+    conditions = ["user_id = %s"]
+    parametres = [user_id]
+    if date_debut:
+        conditions.append("date >= %s")
+        parametres.append(date_debut)
+    if date_fin:
+        conditions.append("date <= %s")
+        parametres.append(date_fin)
+
+    def flux_csv():
+        tampon = io.StringIO()
+        ecrivain = csv.writer(tampon, delimiter=';', lineterminator='\r\n')
+        ecrivain.writerow(CHAMPS_TRANSACTION)
+        yield '\ufeff' + tampon.getvalue()   # BOM : ouverture correcte dans Excel
+        for transactions in blocs_transactions(conditions, parametres):
+            tampon.seek(0)
+            tampon.truncate()
+            ecrivain.writerows([tx[champ] for champ in CHAMPS_TRANSACTION] for tx in transactions)
+            yield tampon.getvalue()
+
+    def flux_jsonl():
+        for transactions in blocs_transactions(conditions, parametres):
+            yield b''.join(json_en_octets(tx) + b'\n' for tx in transactions)
+
+    if format_export == 'csv':
+        corps = (morceau.encode('utf-8') for morceau in flux_csv())
+        mimetype = 'text/csv; charset=utf-8'
+    else:
+        corps = flux_jsonl()
+        mimetype = 'application/x-ndjson'
+    encodage = encodage_negocie()
+    if encodage:
+        corps = compresser_flux(corps, encodage)
+    reponse = app.response_class(stream_with_context(corps), mimetype=mimetype)
+    if encodage:
+        reponse.headers['Content-Encoding'] = encodage
+    nom_fichier = f"transactions_{date_debut or 'debut'}_{date_fin or datetime.now().date().isoformat()}.{format_export}"
+    reponse.headers['Content-Disposition'] = f'attachment; filename="{nom_fichier}"'
+    reponse.headers['Cache-Control'] = 'private, no-store'
+    reponse.vary.update(('Authorization', 'Accept-Encoding'))
+    return reponse
+
+# 🆕 ROUTE : Synchronisation différentielle ?since=<jeton>&limit=
+# Sans jeton : toutes les transactions. Avec : seulement les créations / modifications / suppressions depuis ce jeton.
+# "complet" = false tant qu'il reste des pages (rappeler avec le nouveau jeton) ; 410 = jeton trop récent, repartir de zéro.
+@app.route('/api/transactions/changes', methods=['GET'])
+@jwt_required()
+def api_transactions_changes():
+    user_id = get_jwt_identity()
+    try:
+        limite = min(max(request.args.get('limit', TRANSACTIONS_LIMITE_MAX, type=int), 1), TRANSACTIONS_LIMITE_MAX)
+        depuis = decoder_jeton_synchro(request.args['since']) if request.args.get('since') else None
+    except ValueError as e:
+        return jsonify({"msg": str(e)}), 400
+    
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            # Version lue AVANT les modifications : une écriture validée entre les deux sera renvoyée deux fois, jamais perdue
+            cursor.execute("SELECT version_transactions FROM utilisateurs WHERE id = %s", (user_id,))
+            row = cursor.fetchone()
+            version = row[0] if row else 0
+            if depuis and depuis[0] > version + 1:
+                cursor.close()
+                return jsonify({"msg": "Jeton de synchronisation inconnu, resynchronisation complète nécessaire"}), 410
+            
+            if depuis is None:
+                condition, parametres = "seq_modif >= 0", []
+            elif depuis[1] is None:
+                condition, parametres = "seq_modif > %s", [depuis[0]]
+            else:
+                condition, parametres = "(seq_modif, {id}) > (%s, %s)", list(depuis)
+            requete = f"""
+                SELECT seq_modif, id, date, libelle, libelle_nettoye, montant, categorie, sous_categorie, methode, updated_at, FALSE
+                FROM transactions WHERE user_id = %s AND {condition.format(id='id')}
+            """
+            parametres_requete = [user_id, *parametres]
+            if depuis is not None:
+                # Les pierres tombales ne servent qu'aux clients qui ont déjà une copie
+                requete += f"""
+                UNION ALL
+                SELECT seq_modif, transaction_id, NULL, NULL, NULL, NULL, NULL, NULL, NULL, supprime_le, TRUE
+                FROM transactions_supprimees WHERE user_id = %s AND {condition.format(id='transaction_id')}
+                """
+                parametres_requete += [user_id, *parametres]
+            cursor.execute(requete + " ORDER BY 1, 2 LIMIT %s", (*parametres_requete, limite + 1))
+            rows = cursor.fetchall()
+            cursor.close()
+    except Exception as e:
+        print(f"Erreur lors de la synchronisation des transactions : {e}")
+        return jsonify({"msg": "Erreur serveur"}), 500
+    
+    complet = len(rows) <= limite
+    rows = rows[:limite]
+    if complet:
+        jeton = encoder_jeton_synchro(version)
+    else:
+        jeton = encoder_jeton_synchro(rows[-1][0], rows[-1][1])
+    reponse = jsonify({
+        'modifications': [transaction_depuis_ligne(row[1:10]) for row in rows if not row[10]],
+        'suppressions': [str(row[1]) for row in rows if row[10]],
+        'jeton': jeton,
+        'complet': complet
+    })
+    reponse.headers['Cache-Control'] = 'private, no-store'
+    return reponse
+
 # 🆕 NOUVELLE ROUTE : Ajouter une transaction
 @app.route('/api/transactions', methods=['POST'])
 @jwt_required()
@@ -407,35 +2790,106 @@ def api_add_transaction():
     
     # Sauvegarder dans la BDD
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO transactions (user_id, date, libelle, libelle_nettoye, montant, categorie, sous_categorie, methode)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """, (
-            user_id,
-            transaction_nettoyee['date'],
-            transaction_nettoyee['libelle'],
-            transaction_nettoyee['libelle_nettoye'],
-            transaction_nettoyee['montant'],
-            transaction_nettoyee['categorie'],
-            transaction_nettoyee['sous_categorie'],
-            transaction_nettoyee['methode']
-        ))
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO transactions (user_id, date, libelle, libelle_nettoye, montant, categorie, sous_categorie, methode)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id, updated_at
+            """, (
+                user_id,
+                transaction_nettoyee['date'],
+                transaction_nettoyee['libelle'],
+                transaction_nettoyee['libelle_nettoye'],
+                transaction_nettoyee['montant'],
+                transaction_nettoyee['categorie'],
+                transaction_nettoyee['sous_categorie'],
+                transaction_nettoyee['methode']
+            ))
         
-        new_id = cursor.fetchone()[0]
-        conn.commit()
-        cursor.close()
-        conn.close()
+            new_id, updated_at = cursor.fetchone()
+            marquer_transactions_modifiees(cursor, [user_id])
+            conn.commit()
+            cursor.close()
         
         transaction_nettoyee['id'] = str(new_id)
+        transaction_nettoyee['updated_at'] = updated_at.isoformat()
         return jsonify(transaction_nettoyee), 201
         
     except Exception as e:
         print(f"Erreur lors de l'ajout de la transaction : {e}")
         return jsonify({"msg": "Erreur serveur"}), 500
 
+# 🆕 ROUTE : Import d'un relevé bancaire complet (CSV ou OFX)
+@app.route('/api/transactions/import', methods=['POST'])
+@jwt_required()
+def api_import_transactions():
+    user_id = get_jwt_identity()
+    fichier = request.files.get('file')
+    flux_binaire = fichier.stream if fichier else request.stream
+    nom_fichier = (fichier.filename or '') if fichier else ''
+    format_import = (request.args.get('format') or nom_fichier.rsplit('.', 1)[-1]).lower()
+    encodage = request.args.get('encoding', 'utf-8-sig')
+    try:
+        # Les codecs non textuels (base64, rot13...) sont refusés par TextIOWrapper : même erreur 400
+        if not codecs.lookup(encodage)._is_text_encoding:
+            raise LookupError(encodage)
+    except LookupError:
+        return jsonify({"msg": f"Encodage inconnu : {encodage}"}), 400
+    flux_texte = io.TextIOWrapper(flux_binaire, encoding=encodage, errors='replace', newline='')
+    premiere_ligne = flux_texte.readline()
+    if format_import not in ('csv', 'ofx', 'qfx'):
+        format_import = 'ofx' if 'OFX' in premiere_ligne.upper() else 'csv'
+    
+    resume = {'importees': 0, 'ignorees': 0, 'libelles_distincts': 0, 'par_methode': {}}
+    a_verifier = []
+    classifications = {}
+    
+    def traiter_lot(cursor, lot, matcheur_personnel):
+        # Chaque libellé distinct n'est classé qu'une fois pour tout le fichier
+        nouveaux = list(dict.fromkeys(libelle.upper() for _, libelle, _ in lot if libelle.upper() not in classifications))
+        classifications.update(classifier_libelles(cursor, nouveaux, matcheur_personnel, user_id))
+        resume['libelles_distincts'] += len(nouveaux)
+        transactions = [
+            {'date': date, 'libelle': libelle, 'montant': montant, **classifications[libelle.upper()]}
+            for date, libelle, montant in lot
+        ]
+        for tx, new_id in zip(transactions, inserer_transactions(cursor, user_id, transactions)):
+            tx['id'] = str(new_id)
+            resume['par_methode'][tx['methode']] = resume['par_methode'].get(tx['methode'], 0) + 1
+            if tx['categorie'] == 'A_VERIFIER':
+                a_verifier.append(tx)
+        resume['importees'] += len(transactions)
+    
+    try:
+        lecteur = lire_lignes_ofx if format_import in ('ofx', 'qfx') else lire_lignes_csv
+        matcheur_personnel = CACHE_REGLES_PERSONNELLES.obtenir(user_id)
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            lot = []
+            for ligne in lecteur(flux_texte, premiere_ligne):
+                if ligne is None:
+                    resume['ignorees'] += 1
+                    continue
+                lot.append(ligne)
+                if len(lot) >= IMPORT_BATCH_SIZE:
+                    traiter_lot(cursor, lot, matcheur_personnel)
+                    lot = []
+            if lot:
+                traiter_lot(cursor, lot, matcheur_personnel)
+            marquer_transactions_modifiees(cursor, [user_id])
+            conn.commit()
+            cursor.close()
+        REVEIL_WORKER_IA.set()
+    except ValueError as e:
+        return jsonify({"msg": str(e)}), 400
+    except Exception as e:
+        print(f"Erreur lors de l'import des transactions : {e}")
+        return jsonify({"msg": "Erreur serveur"}), 500
+    
+    print(f"--- 📥 Import (User {user_id}) : {resume['importees']} transactions, {resume['libelles_distincts']} libellés distincts ---")
+    return jsonify({**resume, 'a_verifier': a_verifier}), 201
+
 @app.route('/api/categorize', methods=['POST'])
 @jwt_required() 
 def api_categorize():
@@ -444,30 +2898,69 @@ def api_categorize():
     transaction_nettoyee = classifier_transaction(transaction_brute, user_id)
     return jsonify(transaction_nettoyee)
 
-@app.route('/api/create_budget', methods=['POST'])
-@jwt_required() 
-def api_create_budget():
-    data = request.json
-    transactions = data.get('transactions', [])
-    objectif_epargne = data.get('objectif', 0)
-    revenus = 0
-    charges_fixes = 0
-    depenses_variables_observees = {}
-    total_depenses_variables = 0
-    
-    for tx in transactions:
-        categorie = tx.get('categorie')
-        montant = tx.get('montant', 0)
-        if categorie == 'Revenus': 
-            revenus += montant
-        elif categorie == 'Charges Fixes': 
-            charges_fixes += montant
-        elif categorie not in ['A_VERIFIER', 'Revenus', 'Charges Fixes'] and montant < 0:
-            if categorie not in depenses_variables_observees: 
-                depenses_variables_observees[categorie] = 0
-            depenses_variables_observees[categorie] += montant
-            total_depenses_variables += montant
+# 🆕 ROUTE : Résultats de la file IA. Sondage immédiat ; ?wait=<secondes> (long-poll) n'est honoré qu'en mode
+# coopératif (gevent) : avec des workers synchrones, une attente immobiliserait tout le worker.
+@app.route('/api/classifications', methods=['GET'])
+@jwt_required()
+def api_classifications():
+    user_id = get_jwt_identity()
+    libelles = list(dict.fromkeys(libelle.upper() for libelle in request.args.getlist('libelle') if libelle))
+    if not libelles:
+        return jsonify({"msg": "Paramètre 'libelle' requis"}), 400
+    attente_max = min(request.args.get('wait', 0, type=float), IA_LONG_POLL_MAX_SECONDS) if mode_cooperatif() else 0
+    limite = time.monotonic() + attente_max
+    demarrer_worker_ia()
+    while True:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT libelle, statut, libelle_nettoye, categorie, sous_categorie, methode
+                FROM file_classification_ia WHERE libelle = ANY(%s)
+            """, (libelles,))
+            rows = cursor.fetchall()
+            appliquer_resultats_ia(cursor, user_id)
+            conn.commit()
+            cursor.close()
+        termines = [row for row in rows if row[1] == 'TERMINE']
+        if len(termines) == len(libelles) or time.monotonic() >= limite:
+            break
+        time.sleep(1)
     
+    resultats = []
+    for libelle, statut, libelle_nettoye, categorie, sous_categorie, methode in rows:
+        if statut == 'TERMINE':
+            resultats.append({'libelle': libelle, 'statut': statut, 'libelle_nettoye': libelle_nettoye, 'categorie': categorie, 'sous_categorie': sous_categorie, 'methode': methode})
+        else:
+            resultats.append({'libelle': libelle, 'statut': statut, 'libelle_nettoye': libelle, **CLASSIFICATION_EN_ATTENTE})
+    return jsonify(resultats)
+
+# 🆕 ROUTE : Consommation IA (cadence et quota partagés par tous les workers, part de l'utilisateur)
+@app.route('/api/ia/usage', methods=['GET'])
+@jwt_required()
+def api_ia_usage():
+    user_id = get_jwt_identity()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        usage_global = LIMITEUR_IA.usage(cursor)
+        cursor.execute("SELECT statut, COUNT(*) FROM file_classification_ia WHERE statut <> 'TERMINE' GROUP BY statut")
+        file_ia = dict(cursor.fetchall())
+        cursor.execute("SELECT libelles FROM usage_ia_utilisateurs WHERE user_id = %s AND jour = CURRENT_DATE", (user_id,))
+        row = cursor.fetchone()
+        cursor.execute("SELECT COUNT(*) FROM file_classification_ia WHERE demandeur = %s AND statut <> 'TERMINE'", (user_id,))
+        en_file = cursor.fetchone()[0]
+        cursor.close()
+    return jsonify({
+        'global': {**usage_global, 'file_en_attente': file_ia.get('EN_ATTENTE', 0), 'file_en_cours': file_ia.get('EN_COURS', 0)},
+        'utilisateur': {
+            'libelles_aujourd_hui': row[0] if row else 0,
+            'quota_libelles_jour': IA_LIBELLES_PAR_UTILISATEUR_JOUR or None,
+            'en_file': en_file,
+        }
+    })
+
+def proposer_budget(revenus, charges_fixes, depenses_variables_observees, objectif_epargne):
+    """Calcule la proposition du coach à partir des totaux observés (dépenses variables négatives, par catégorie)."""
+    total_depenses_variables = sum(depenses_variables_observees.values())
     charges_fixes_abs = round(abs(charges_fixes), 2)
     revenus_observes = round(revenus, 2)
     total_depenses_variables_abs = round(abs(total_depenses_variables), 2)
@@ -499,7 +2992,7 @@ def api_create_budget():
     reste_a_vivre_jour = reste_a_vivre_total / 30
     message_ia = f"OK ! Pour atteindre votre objectif de {objectif_epargne}€ d'épargne (sur {revenus_observes}€ de revenus), il nous reste {reste_a_vivre_total}€ à répartir. Je vous propose les enveloppes suivantes :"
     
-    reponse_coach = { 
+    return { 
         'revenus_observes': revenus_observes, 
         'fixes_observes': charges_fixes_abs, 
         'enveloppes_proposees': enveloppes_proposees, 
@@ -507,7 +3000,207 @@ def api_create_budget():
         'reste_a_vivre_total': round(reste_a_vivre_total, 2), 
         'reste_a_vivre_jour': round(reste_a_vivre_jour, 2) 
     }
-    return jsonify(reponse_coach)
+
+@app.route('/api/create_budget', methods=['POST'])
+@jwt_required() 
+def api_create_budget():
+    # Ancienne API : le client envoie toute sa liste. Préférer GET /api/budget/proposition.
+    data = request.json
+    transactions = data.get('transactions', [])
+    objectif_epargne = data.get('objectif', 0)
+    revenus = 0
+    charges_fixes = 0
+    depenses_variables_observees = {}
+    
+    for tx in transactions:
+        categorie = tx.get('categorie')
+        montant = tx.get('montant', 0)
+        if categorie == 'Revenus': 
+            revenus += montant
+        elif categorie == 'Charges Fixes': 
+            charges_fixes += montant
+        elif categorie not in ['A_VERIFIER', 'Revenus', 'Charges Fixes'] and montant < 0:
+            if categorie not in depenses_variables_observees: 
+                depenses_variables_observees[categorie] = 0
+            depenses_variables_observees[categorie] += montant
+    
+    return jsonify(proposer_budget(revenus, charges_fixes, depenses_variables_observees, objectif_epargne))
+
+def lire_mois(valeur):
+    if not valeur:
+        return None
+    try:
+        return datetime.strptime(valeur, '%Y-%m').date()
+    except ValueError:
+        raise ValueError(f"Mois invalide (format attendu AAAA-MM) : {valeur}")
+
+# 🆕 ROUTE : Proposition de budget calculée côté serveur depuis les agrégats mensuels
+# ?objectif=<épargne>&from=AAAA-MM&to=AAAA-MM (bornes incluses, par défaut tout l'historique)
+@app.route('/api/budget/proposition', methods=['GET'])
+@jwt_required()
+def api_budget_proposition():
+    user_id = get_jwt_identity()
+    try:
+        objectif_epargne = request.args.get('objectif', 0, type=float)
+        mois_debut = lire_mois(request.args.get('from'))
+        mois_fin = lire_mois(request.args.get('to'))
+    except ValueError as e:
+        return jsonify({"msg": str(e)}), 400
+    
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT categorie, SUM(total), SUM(total_debits)
+                FROM agregats_mensuels
+                WHERE user_id = %s
+                  AND (%s::DATE IS NULL OR mois >= %s::DATE)
+                  AND (%s::DATE IS NULL OR mois <= %s::DATE)
+                  AND nombre > 0
+                GROUP BY categorie
+                ORDER BY categorie
+            """, (user_id, mois_debut, mois_debut, mois_fin, mois_fin))
+            rows = cursor.fetchall()
+            cursor.close()
+    except Exception as e:
+        print(f"Erreur lors du calcul de la proposition de budget : {e}")
+        return jsonify({"msg": "Erreur serveur"}), 500
+    
+    revenus = 0
+    charges_fixes = 0
+    depenses_variables_observees = {}
+    for categorie, total, total_debits in rows:
+        if categorie == 'Revenus':
+            revenus = float(total)
+        elif categorie == 'Charges Fixes':
+            charges_fixes = float(total)
+        elif categorie != 'A_VERIFIER' and total_debits < 0:
+            depenses_variables_observees[categorie] = float(total_debits)
+    
+    return jsonify(proposer_budget(revenus, charges_fixes, depenses_variables_observees, objectif_epargne))
+
+# --- Analyses mensuelles (séries par catégorie, cache par utilisateur) ---
+ANALYTICS_FENETRE_DEFAUT = 3
+ANALYTICS_FENETRE_MAX = 12
+ANALYTICS_CACHE_MAX_ENTREES = int(os.environ.get('ANALYTICS_CACHE_MAX_ENTREES', 1000))
+
+class CacheAnalytique:
+    """Résultats d'analyse par (utilisateur, paramètres), valides tant que version_transactions n'a pas bougé.
+
+    La version est relue à chaque requête (lecture par clé primaire) : toute écriture passant par
+    marquer_transactions_modifiees invalide le cache de tous les workers, sans canal de notification.
+    """
+
+    def __init__(self, max_entrees):
+        self.max_entrees = max_entrees
+        self._lock = threading.Lock()
+        self._entrees = OrderedDict()   # (user_id, cle) -> (version, resultat)
+        self._stats = {'hits': 0, 'miss': 0, 'evictions': 0}
+
+    def obtenir(self, user_id, cle, version):
+        with self._lock:
+            entree = self._entrees.get((user_id, cle))
+            if entree and entree[0] == version:
+                self._entrees.move_to_end((user_id, cle))
+                self._stats['hits'] += 1
+                return entree[1]
+            self._stats['miss'] += 1
+            return None
+
+    def enregistrer(self, user_id, cle, version, resultat):
+        with self._lock:
+            self._entrees[(user_id, cle)] = (version, resultat)
+            self._entrees.move_to_end((user_id, cle))
+            while len(self._entrees) > self.max_entrees:
+                self._entrees.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            return {**self._stats, 'entrees': len(self._entrees)}
+
+CACHE_ANALYTIQUE = CacheAnalytique(ANALYTICS_CACHE_MAX_ENTREES)
+
+def calculer_analytique(cursor, user_id, fenetre, mois_debut, mois_fin):
+    """Totaux mensuels par catégorie (mois sans transaction = 0), moyenne glissante sur `fenetre` mois et variation
+    d'un mois sur l'autre. Fenêtres calculées sur tout l'historique, puis filtrées : les bornes restent exactes."""
+    cursor.execute("""
+        WITH presentes AS (
+            SELECT mois, categorie, total, nombre FROM agregats_mensuels WHERE user_id = %s AND nombre > 0
+        ), mois AS (
+            SELECT generate_series(MIN(mois), MAX(mois), INTERVAL '1 month')::DATE AS mois FROM presentes
+        ), serie AS (
+            SELECT c.categorie, m.mois, COALESCE(p.total, 0) AS total, COALESCE(p.nombre, 0) AS nombre
+            FROM (SELECT DISTINCT categorie FROM presentes) c
+            CROSS JOIN mois m
+            LEFT JOIN presentes p ON p.categorie = c.categorie AND p.mois = m.mois
+        ), fenetres AS (
+            SELECT categorie, mois, total, nombre,
+                   AVG(total) OVER (PARTITION BY categorie ORDER BY mois ROWS BETWEEN %s PRECEDING AND CURRENT ROW) AS moyenne,
+                   total - LAG(total) OVER (PARTITION BY categorie ORDER BY mois) AS variation,
+                   LAG(total) OVER (PARTITION BY categorie ORDER BY mois) AS precedent
+            FROM serie
+        )
+        SELECT categorie, mois, total, nombre, moyenne, variation, variation / NULLIF(ABS(precedent), 0) * 100
+        FROM fenetres
+        WHERE (%s::DATE IS NULL OR mois >= %s::DATE) AND (%s::DATE IS NULL OR mois <= %s::DATE)
+        ORDER BY categorie, mois
+    """, (user_id, fenetre - 1, mois_debut, mois_debut, mois_fin, mois_fin))
+    
+    def nombre_ou_none(valeur, decimales=2):
+        return None if valeur is None else round(float(valeur), decimales)
+    
+    mois = set()
+    categories = {}
+    for categorie, mois_ligne, total, nombre, moyenne, variation, variation_pct in cursor.fetchall():
+        mois.add(mois_ligne.strftime('%Y-%m'))
+        serie = categories.setdefault(categorie, {'total': [], 'nombre': [], 'moyenne_glissante': [], 'variation': [], 'variation_pct': []})
+        serie['total'].append(float(total))
+        serie['nombre'].append(nombre)
+        serie['moyenne_glissante'].append(nombre_ou_none(moyenne))
+        serie['variation'].append(nombre_ou_none(variation))
+        serie['variation_pct'].append(nombre_ou_none(variation_pct, 1))
+    return {'fenetre': fenetre, 'mois': sorted(mois), 'categories': categories}
+
+# 🆕 ROUTE : Séries mensuelles par catégorie (totaux, moyenne glissante, variation mensuelle)
+# ?fenetre=<mois de la moyenne glissante>&from=AAAA-MM&to=AAAA-MM. Réponse en colonnes alignées sur "mois".
+@app.route('/api/analytics', methods=['GET'])
+@jwt_required()
+def api_analytics():
+    user_id = get_jwt_identity()
+    try:
+        fenetre = min(max(request.args.get('fenetre', ANALYTICS_FENETRE_DEFAUT, type=int), 1), ANALYTICS_FENETRE_MAX)
+        mois_debut = lire_mois(request.args.get('from'))
+        mois_fin = lire_mois(request.args.get('to'))
+    except ValueError as e:
+        return jsonify({"msg": str(e)}), 400
+    cle = (fenetre, mois_debut, mois_fin)
+    
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT version_transactions FROM utilisateurs WHERE id = %s", (user_id,))
+            row = cursor.fetchone()
+            version = row[0] if row else 0
+            etag = f"a{user_id}-{version}-{fenetre}-{mois_debut}-{mois_fin}"
+            if request.if_none_match.contains_weak(etag):
+                cursor.close()
+                reponse = app.response_class(status=304)
+            else:
+                resultat = CACHE_ANALYTIQUE.obtenir(user_id, cle, version)
+                if resultat is None:
+                    resultat = calculer_analytique(cursor, user_id, fenetre, mois_debut, mois_fin)
+                    CACHE_ANALYTIQUE.enregistrer(user_id, cle, version, resultat)
+                cursor.close()
+                reponse = jsonify(resultat)
+    except Exception as e:
+        print(f"Erreur lors du calcul des analyses : {e}")
+        return jsonify({"msg": "Erreur serveur"}), 500
+    
+    reponse.set_etag(etag, weak=True)
+    reponse.headers['Cache-Control'] = 'private, no-cache'
+    reponse.vary.update(('Authorization',))
+    return reponse
 
 @app.route('/api/learn_rule', methods=['POST'])
 @jwt_required() 
@@ -526,8 +3219,16 @@ def api_learn_rule():
         categorie=categorie,
         sous_categorie="Validé (Utilisateur)"
     )
+    if success and data.get('retroactif'):
+        # Les transactions existantes qui correspondent sont reclassées en une seule instruction
+        try:
+            reclassees = reclasser_transactions_personnelles(user_id, mot_cle, mot_cle.capitalize(), categorie, "Validé (Utilisateur)")
+        except Exception as e:
+            print(f"Erreur BDD (reclassement rétroactif) : {e}")
+            return jsonify({'status': 'erreur', 'message': 'Règle sauvegardée, erreur lors du reclassement'}), 500
+        return jsonify({'status': 'ok', 'message': f"Règle PERSONNELLE '{normaliser_libelle(mot_cle)}' sauvegardée.", 'reclassees': reclassees})
     if success:
-        return jsonify({'status': 'ok', 'message': f"Règle PERSONNELLE '{mot_cle.upper()}' sauvegardée."})
+        return jsonify({'status': 'ok', 'message': f"Règle PERSONNELLE '{normaliser_libelle(mot_cle)}' sauvegardée."})
     else:
         return jsonify({'status': 'erreur', 'message': 'Erreur BDD'}), 500
 
@@ -538,51 +3239,235 @@ def api_update_transaction(transaction_id):
     user_id = get_jwt_identity()
     data = request.json
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        # On vérifie que la transaction appartient bien à l'utilisateur
-        cursor.execute("""
-            UPDATE transactions 
-            SET categorie = %s, sous_categorie = %s, methode = %s
-            WHERE id = %s AND user_id = %s
-        """, (data['categorie'], "Validé (Utilisateur)", "Utilisateur", transaction_id, user_id))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            # On vérifie que la transaction appartient bien à l'utilisateur
+            cursor.execute("""
+                UPDATE transactions 
+                SET categorie = %s, sous_categorie = %s, methode = %s
+                WHERE id = %s AND user_id = %s
+                RETURNING libelle
+            """, (data['categorie'], "Validé (Utilisateur)", "Utilisateur", transaction_id, user_id))
+            row = cursor.fetchone()
+            if row:
+                marquer_transactions_modifiees(cursor, [user_id])
+            conn.commit()
+            cursor.close()
+        if row:
+            MODELE_LOCAL.apprendre(row[0], data['categorie'])
         return jsonify({'status': 'ok'})
     except Exception as e:
         print(f"Erreur update transaction: {e}")
         return jsonify({"msg": "Erreur serveur"}), 500
 
+# 🆕 ROUTE : Supprimer une transaction (laisse une pierre tombale pour /api/transactions/changes)
+@app.route('/api/transactions/<int:transaction_id>', methods=['DELETE'])
+@jwt_required()
+def api_delete_transaction(transaction_id):
+    user_id = get_jwt_identity()
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM transactions WHERE id = %s AND user_id = %s", (transaction_id, user_id))
+            supprimee = cursor.rowcount > 0
+            if supprimee:
+                marquer_transactions_modifiees(cursor, [user_id])
+            conn.commit()
+            cursor.close()
+    except Exception as e:
+        print(f"Erreur suppression transaction: {e}")
+        return jsonify({"msg": "Erreur serveur"}), 500
+    if not supprimee:
+        return jsonify({"msg": "Transaction introuvable"}), 404
+    return jsonify({'status': 'ok'})
+
+# 🆕 ROUTE : Mise à jour groupée (une seule instruction UPDATE ... FROM (VALUES ...) pour toute la liste)
+@app.route('/api/transactions', methods=['PATCH'])
+@jwt_required()
+def api_update_transactions():
+    user_id = int(get_jwt_identity())
+    data = request.json
+    modifications = data.get('transactions') if isinstance(data, dict) else data
+    if not isinstance(modifications, list) or not modifications:
+        return jsonify({"msg": "Liste de modifications {id, categorie, sous_categorie} requise"}), 400
+    if len(modifications) > TRANSACTIONS_LIMITE_MAX:
+        return jsonify({"msg": f"Au plus {TRANSACTIONS_LIMITE_MAX} modifications par appel"}), 400
+
+    resultats = {}
+    valides = {}   # un même id envoyé deux fois : la dernière modification gagne
+    for modification in modifications:
+        transaction_id = modification.get('id') if isinstance(modification, dict) else None
+        try:
+            transaction_id = int(transaction_id)
+        except (TypeError, ValueError):
+            resultats[str(transaction_id)] = 'invalide'
+            continue
+        categorie = modification.get('categorie')
+        if not isinstance(categorie, str) or not categorie:
+            resultats[transaction_id] = 'invalide'
+            continue
+        resultats.pop(transaction_id, None)
+        valides[transaction_id] = (transaction_id, user_id, categorie, modification.get('sous_categorie') or "Validé (Utilisateur)")
+
+    modifiees = []
+    if valides:
+        try:
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                # La propriété est vérifiée dans la même instruction : l'id d'un autre utilisateur ne correspond à rien
+                modifiees = execute_values(cursor, """
+                    UPDATE transactions t
+                    SET categorie = v.categorie, sous_categorie = v.sous_categorie, methode = 'Utilisateur'
+                    FROM (VALUES %s) AS v (id, user_id, categorie, sous_categorie)
+                    WHERE t.id = v.id AND t.user_id = v.user_id
+                    RETURNING t.id, t.libelle, t.categorie
+                """, list(valides.values()), template='(%s::INTEGER, %s::INTEGER, %s, %s)', page_size=len(valides), fetch=True)
+                if modifiees:
+                    marquer_transactions_modifiees(cursor, [user_id])
+                conn.commit()
+                cursor.close()
+        except Exception as e:
+            print(f"Erreur update transactions (groupé) : {e}")
+            return jsonify({"msg": "Erreur serveur"}), 500
+
+    ids_modifies = {transaction_id for transaction_id, _, _ in modifiees}
+    for transaction_id in valides:
+        resultats[transaction_id] = 'ok' if transaction_id in ids_modifies else 'introuvable'
+    for _, libelle, categorie in modifiees:
+        MODELE_LOCAL.apprendre(libelle, categorie)
+    return jsonify({
+        'modifiees': len(ids_modifies),
+        'resultats': [{'id': str(transaction_id), 'statut': statut} for transaction_id, statut in resultats.items()]
+    })
+
 # 🆕 ROUTE : Gérer le budget (Sauvegarde et Lecture)
 @app.route('/api/budget', methods=['GET', 'POST'])
 @jwt_required()
 def api_budget_manager():
     user_id = get_jwt_identity()
-    conn = get_db_connection()
-    cursor = conn.cursor()
     
     if request.method == 'POST':
-        # Sauvegarder le budget
-        budget_data = json.dumps(request.json)
+        # Sauvegarder le budget : les restants sont calculés et tenus à jour par la BDD
+        budget = request.json
         try:
-            cursor.execute("""
-                INSERT INTO budgets (user_id, data) VALUES (%s, %s)
-                ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = CURRENT_TIMESTAMP
-            """, (user_id, budget_data))
-            conn.commit()
+            with get_db_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    INSERT INTO budgets (user_id, revenus_observes, fixes_observes, reste_a_vivre_total, message_ia, debut)
+                    VALUES (%s, %s, %s, %s, %s, CURRENT_TIMESTAMP)
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        data = NULL, revenus_observes = EXCLUDED.revenus_observes, fixes_observes = EXCLUDED.fixes_observes,
+                        reste_a_vivre_total = EXCLUDED.reste_a_vivre_total, message_ia = EXCLUDED.message_ia,
+                        debut = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+                """, (user_id, budget.get('revenus_observes', 0), budget.get('fixes_observes', 0),
+                      budget.get('reste_a_vivre_total', 0), budget.get('message_ia', '')))
+                # Restants recalculés côté serveur avec la règle du trigger : enveloppe pleine, moins les dépenses
+                # déjà datées depuis le début du budget (une recatégorisation ultérieure reste alors cohérente)
+                enregistrer_enveloppes(cursor, user_id, [
+                    {k: v for k, v in env.items() if k != 'montant_restant'} for env in budget.get('enveloppes_proposees', [])
+                ])
+                imputer_depenses_du_budget(cursor, user_id)
+                conn.commit()
+                cursor.close()
             return jsonify({'status': 'saved'})
         except Exception as e:
             return jsonify({"msg": str(e)}), 500
     
-    elif request.method == 'GET':
-        # Lire le budget
-        cursor.execute("SELECT data FROM budgets WHERE user_id = %s", (user_id,))
+    # Lire le budget
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT revenus_observes, fixes_observes, reste_a_vivre_total, message_ia
+            FROM budgets WHERE user_id = %s AND reste_a_vivre_total IS NOT NULL
+        """, (user_id,))
         row = cursor.fetchone()
+        enveloppes = []
         if row:
-            return jsonify(json.loads(row[0]))
+            cursor.execute("""
+                SELECT categorie, depense_observee, enveloppe_proposee, montant_restant
+                FROM enveloppes WHERE user_id = %s ORDER BY ordre
+            """, (user_id,))
+            enveloppes = cursor.fetchall()
+        cursor.close()
+    if not row:
+        return jsonify(None) # Pas de budget encore
+    revenus_observes, fixes_observes, reste_a_vivre_total, message_ia = row
+    return jsonify({
+        'revenus_observes': float(revenus_observes),
+        'fixes_observes': float(fixes_observes),
+        'enveloppes_proposees': [
+            {'categorie': categorie, 'depense_observee': float(depense_observee),
+             'enveloppe_proposee': float(enveloppe_proposee), 'montant_restant': float(montant_restant)}
+            for categorie, depense_observee, enveloppe_proposee, montant_restant in enveloppes
+        ],
+        'message_ia': message_ia,
+        'reste_a_vivre_total': float(reste_a_vivre_total),
+        'reste_a_vivre_jour': round(float(reste_a_vivre_total) / 30, 2)
+    })
+
+# 🆕 ROUTE : Montants restants seulement (léger, à appeler après chaque dépense)
+@app.route('/api/budget/restants', methods=['GET'])
+@jwt_required()
+def api_budget_restants():
+    user_id = get_jwt_identity()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT b.reste_a_vivre_total, e.categorie, e.montant_restant
+            FROM budgets b LEFT JOIN enveloppes e ON e.user_id = b.user_id
+            WHERE b.user_id = %s AND b.reste_a_vivre_total IS NOT NULL
+        """, (user_id,))
+        rows = cursor.fetchall()
+        cursor.close()
+    if not rows:
+        return jsonify(None)
+    reste_a_vivre_total = float(rows[0][0])
+    return jsonify({
+        'reste_a_vivre_total': reste_a_vivre_total,
+        'reste_a_vivre_jour': round(reste_a_vivre_total / 30, 2),
+        'enveloppes': {categorie: float(montant_restant) for _, categorie, montant_restant in rows if categorie is not None}
+    })
+
+def acces_interne(route):
+    """Réserve une route d'exploitation au collecteur (jeton METRIQUES_TOKEN) ou à la machine locale."""
+    @wraps(route)
+    def verifier(*args, **kwargs):
+        if METRIQUES_TOKEN:
+            autorise = hmac.compare_digest(request.headers.get('Authorization', '').encode(), f"Bearer {METRIQUES_TOKEN}".encode())
         else:
-            return jsonify(None) # Pas de budget encore
-    
-    cursor.close()
-    conn.close()      
\ No newline at end of file
+            try:
+                autorise = ipaddress.ip_address(request.remote_addr or '').is_loopback
+            except ValueError:
+                autorise = False
+        if not autorise:
+            return jsonify({"msg": "Accès réservé"}), 403
+        return route(*args, **kwargs)
+    return verifier
+
+# 🆕 ROUTE : Métriques Prometheus (par worker)
+@app.route('/metrics', methods=['GET'])
+@acces_interne
+def metrics():
+    stats_pool = DB_POOL.stats()
+    jauges = [
+        ('copilote_db_pool_connexions_en_cours', "Connexions du pool actuellement empruntées", stats_pool.get('en_cours', 0)),
+        ('copilote_db_pool_timeouts', "Emprunts abandonnés faute de connexion disponible (cumul)", stats_pool.get('timeouts', 0)),
+        ('copilote_llm_disjoncteur_attente_secondes', "Secondes avant la réouverture des appels LLM (0 = disjoncteur fermé)", CLIENT_LLM.attente_disjoncteur()),
+    ]
+    stats_cache = CACHE_REGLES_PERSONNELLES.stats()
+    jauges += [
+        (f"copilote_cache_regles_perso_{nom}", f"Cache des règles personnelles : {nom} (cumul pour hits / miss / evictions / invalidations)", stats_cache[nom])
+        for nom in ('entrees', 'noeuds', 'hits', 'miss', 'evictions', 'invalidations')
+    ]
+    stats_analytique = CACHE_ANALYTIQUE.stats()
+    jauges += [
+        (f"copilote_cache_analytique_{nom}", f"Cache des analyses mensuelles : {nom} (cumul pour hits / miss / evictions)", stats_analytique[nom])
+        for nom in ('entrees', 'hits', 'miss', 'evictions')
+    ]
+    return Response(METRIQUES.exporter(jauges), mimetype='text/plain; version=0.0.4')
+
+# 🆕 ROUTE : Statistiques du pool de connexions (par worker)
+@app.route('/api/stats/db', methods=['GET'])
+@acces_interne
+def api_db_stats():
+    return jsonify(DB_POOL.stats())
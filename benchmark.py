@@ -0,0 +1,380 @@
+"""Banc de charge reproductible : faux serveur Gemini + Postgres local + API, résultats en JSON.
+
+Exemple (lance l'API avec gunicorn, pointée vers le faux Gemini) :
+    DATABASE_URL=postgresql://localhost/copilote_bench python benchmark.py --utilisateurs 20 --regles 2000 \\
+        --concurrence 16 --duree 30 --sortie bench_$(git rev-parse --short HEAD).json
+    python benchmark.py --comparer bench_avant.json bench_apres.json
+
+Avec --url, l'API déjà lancée est utilisée telle quelle (elle doit avoir IA_API_URL=http://127.0.0.1:<--port-gemini>/).
+"""
+import argparse
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2
+import requests
+from psycopg2.extras import execute_values
+
+CATEGORIES = ["Charges Fixes", "Alimentation", "Abonnements", "Sorties", "Shopping", "Santé", "Transport", "Épargne", "Autres"]
+ENDPOINTS = ('login', 'ajout_transaction', 'categorize', 'liste_transactions', 'create_budget')
+REGEX_LIBELLE_PROMPT = re.compile(r'^\s*(\d+): (".*")\s*$', re.MULTILINE)
+
+
+# --- 1. Faux serveur Gemini (generateContent) ---
+class FauxGemini(BaseHTTPRequestHandler):
+    """Répond comme generateContent : un tableau JSON indexé, après une latence et avec un taux d'erreur réglables."""
+    latence_ms = 800
+    taux_erreur = 0.0
+    taux_a_verifier = 0.1
+    compteurs = {'appels': 0, 'erreurs_injectees': 0, 'libelles': 0}
+    verrou = threading.Lock()
+
+    def do_POST(self):
+        corps = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        prompt = corps['contents'][0]['parts'][0]['text']
+        libelles = [(int(i), json.loads(libelle)) for i, libelle in REGEX_LIBELLE_PROMPT.findall(prompt)]
+        time.sleep(max(0.0, random.gauss(self.latence_ms, self.latence_ms / 4)) / 1000)
+        with self.verrou:
+            self.compteurs['appels'] += 1
+            self.compteurs['libelles'] += len(libelles)
+            erreur = random.random() < self.taux_erreur
+            if erreur:
+                self.compteurs['erreurs_injectees'] += 1
+        if erreur:
+            self._repondre(random.choice((429, 500, 503)), {'error': {'message': 'erreur injectée par le banc'}})
+            return
+        entrees = [
+            {'index': i, 'libelle_nettoye': libelle.title()[:40],
+             'categorie': 'A_VERIFIER' if random.random() < self.taux_a_verifier else CATEGORIES[zlib.crc32(libelle.encode('utf-8')) % len(CATEGORIES)]}
+            for i, libelle in libelles
+        ]
+        self._repondre(200, {'candidates': [{'content': {'parts': [{'text': json.dumps(entrees, ensure_ascii=False)}]}}]})
+
+    def _repondre(self, statut, donnees):
+        contenu = json.dumps(donnees).encode('utf-8')
+        self.send_response(statut)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(contenu)))
+        self.end_headers()
+        self.wfile.write(contenu)
+
+    def log_message(self, *args):
+        pass
+
+
+def demarrer_faux_gemini(port, latence_ms, taux_erreur, taux_a_verifier):
+    FauxGemini.latence_ms, FauxGemini.taux_erreur, FauxGemini.taux_a_verifier = latence_ms, taux_erreur, taux_a_verifier
+    serveur = ThreadingHTTPServer(('127.0.0.1', port), FauxGemini)
+    threading.Thread(target=serveur.serve_forever, name='faux-gemini', daemon=True).start()
+    print(f"Faux Gemini : http://127.0.0.1:{port}/ (latence {latence_ms} ms, erreurs {taux_erreur:.0%})")
+    return serveur
+
+
+# --- 2. Lancement de l'API ---
+def demarrer_api(args):
+    env = {**os.environ, 'IA_API_URL': f"http://127.0.0.1:{args.port_gemini}/", 'GEMINI_API_KEY': 'banc'}
+    if args.gevent:
+        env['GUNICORN_MODE'] = 'gevent'
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'bootstrap'], env=env, check=True)
+    processus = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '--threads', str(args.threads),
+         '-b', f"127.0.0.1:{args.port_api}", 'app:app'],
+        env=env, stdout=subprocess.DEVNULL if not args.verbeux else None
+    )
+    url = f"http://127.0.0.1:{args.port_api}"
+    for _ in range(100):
+        try:
+            requests.get(f"{url}/api/stats/db", timeout=1)
+            return processus, url
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    processus.terminate()
+    raise RuntimeError("L'API n'a pas démarré")
+
+
+# --- 3. Données de test ---
+def semer(args, url, identifiant):
+    """Crée N utilisateurs (via l'API), M règles générales et K règles personnelles par utilisateur (en SQL)."""
+    comptes = [(f"banc-{identifiant}-{i}@banc.local", 'banc-mot-de-passe') for i in range(args.utilisateurs)]
+    with ThreadPoolExecutor(max_workers=8) as executeur:
+        list(executeur.map(lambda compte: requests.post(f"{url}/api/signup", json={'email': compte[0], 'password': compte[1]}), comptes))
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cursor = conn.cursor()
+    execute_values(cursor, """
+        INSERT INTO regles_generales (mot_cle, libelle_nettoye, categorie, sous_categorie) VALUES %s
+        ON CONFLICT (mot_cle) DO NOTHING
+    """, [(f"BANCMARCHAND{i}", f"Marchand {i}", CATEGORIES[i % len(CATEGORIES)], 'Banc') for i in range(args.regles)])
+    cursor.execute("SELECT id, email FROM utilisateurs WHERE email LIKE %s", (f"banc-{identifiant}-%",))
+    user_ids = {email: user_id for user_id, email in cursor.fetchall()}
+    execute_values(cursor, """
+        INSERT INTO regles_personnelles (user_id, mot_cle, libelle_nettoye, categorie, sous_categorie) VALUES %s
+        ON CONFLICT (user_id, mot_cle) DO NOTHING
+    """, [(user_id, f"BANCPERSO{user_id}X{j}", f"Perso {j}", CATEGORIES[j % len(CATEGORIES)], 'Banc')
+          for user_id in user_ids.values() for j in range(args.regles_perso)])
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return [(email, mot_de_passe, user_ids[email]) for email, mot_de_passe in comptes if email in user_ids]
+
+
+def libelle_aleatoire(args, user_id):
+    """Libellé tiré selon le mélange demandé : règle perso / règle générale / inconnu (file IA)."""
+    tirage = random.random()
+    if tirage < args.part_perso and args.regles_perso:
+        return f"CB BANCPERSO{user_id}X{random.randrange(args.regles_perso)} 12/03"
+    if tirage < args.part_perso + args.part_generale and args.regles:
+        return f"PRLV SEPA BANCMARCHAND{random.randrange(args.regles)} REF {random.randrange(10**6)}"
+    return f"CB INCONNU {uuid.uuid4().hex[:10].upper()}"
+
+
+# --- 4. Charge ---
+class Mesures:
+    def __init__(self):
+        self.verrou = threading.Lock()
+        self.durees = {}
+        self.erreurs = {}
+        self.en_attente_ia = {}
+
+    def ajouter(self, cle, duree, ok):
+        with self.verrou:
+            self.durees.setdefault(cle, []).append(duree)
+            if not ok:
+                self.erreurs[cle] = self.erreurs.get(cle, 0) + 1
+
+
+def executer_scenario(args, url, comptes, mesures):
+    local = threading.local()
+    jetons = {}
+
+    def session():
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        return local.session
+
+    def appel(nom, methode, chemin, jeton=None, **kwargs):
+        headers = {'Authorization': f"Bearer {jeton}"} if jeton else {}
+        debut = time.perf_counter()
+        try:
+            reponse = session().request(methode, f"{url}{chemin}", headers=headers, timeout=60, **kwargs)
+            ok = reponse.status_code < 400
+        except requests.RequestException:
+            reponse, ok = None, False
+        duree = time.perf_counter() - debut
+        mesures.ajouter(nom, duree, ok)
+        return reponse, duree
+
+    def connexion(email, mot_de_passe, user_id):
+        reponse, _ = appel('login', 'POST', '/api/login', json={'email': email, 'password': mot_de_passe})
+        if reponse is not None and reponse.ok:
+            jetons[user_id] = reponse.json()['access_token']
+
+    for compte in comptes:
+        connexion(*compte)
+
+    poids = {'login': args.poids_login, 'ajout_transaction': args.poids_ajout, 'categorize': args.poids_categorize,
+             'liste_transactions': args.poids_liste, 'create_budget': args.poids_budget}
+    noms, ponderations = zip(*poids.items())
+
+    def iteration():
+        email, mot_de_passe, user_id = random.choice(comptes)
+        jeton = jetons.get(user_id)
+        nom = random.choices(noms, ponderations)[0]
+        if nom == 'login' or jeton is None:
+            connexion(email, mot_de_passe, user_id)
+        elif nom in ('ajout_transaction', 'categorize'):
+            libelle = libelle_aleatoire(args, user_id)
+            transaction = {'date': datetime.now().strftime('%Y-%m-%d'), 'libelle': libelle, 'montant': -round(random.uniform(1, 120), 2)}
+            chemin = '/api/transactions' if nom == 'ajout_transaction' else '/api/categorize'
+            reponse, duree = appel(nom, 'POST', chemin, jeton, json=transaction)
+            if reponse is not None and reponse.ok:
+                methode = reponse.json().get('methode', 'inconnue')
+                mesures.ajouter(f"niveau:{methode}", duree, True)
+                if methode == 'IA (En attente)':
+                    with mesures.verrou:
+                        mesures.en_attente_ia.setdefault(libelle.upper(), (time.perf_counter() - duree, jeton))
+        elif nom == 'liste_transactions':
+            appel(nom, 'GET', f"/api/transactions?limit={args.limite_liste}", jeton)
+        else:
+            transactions = [{'categorie': random.choice(CATEGORIES + ['Revenus']), 'montant': round(random.uniform(-200, 50), 2)}
+                            for _ in range(args.transactions_budget)]
+            appel(nom, 'POST', '/api/create_budget', jeton, json={'transactions': transactions, 'objectif': 100})
+
+    fin = time.monotonic() + args.duree
+    debut = time.perf_counter()
+
+    def boucle():
+        while time.monotonic() < fin:
+            iteration()
+
+    with ThreadPoolExecutor(max_workers=args.concurrence) as executeur:
+        for futur in [executeur.submit(boucle) for _ in range(args.concurrence)]:
+            futur.result()
+    return time.perf_counter() - debut
+
+
+def attendre_resolutions_ia(url, mesures, delai_max):
+    """Long-poll /api/classifications jusqu'à résolution des libellés mis en file ; mesure l'attente de bout en bout."""
+    restants = dict(mesures.en_attente_ia)
+    limite = time.monotonic() + delai_max
+    while restants and time.monotonic() < limite:
+        par_jeton = {}
+        for libelle, (debut, jeton) in restants.items():
+            par_jeton.setdefault(jeton, []).append(libelle)
+        for jeton, libelles in par_jeton.items():
+            for i in range(0, len(libelles), 50):
+                lot = libelles[i:i + 50]
+                reponse = requests.get(f"{url}/api/classifications", params=[('libelle', l) for l in lot] + [('wait', 2)],
+                                       headers={'Authorization': f"Bearer {jeton}"}, timeout=30)
+                if not reponse.ok:
+                    continue
+                for resultat in reponse.json():
+                    if resultat['statut'] == 'TERMINE' and resultat['libelle'] in restants:
+                        debut, _ = restants.pop(resultat['libelle'])
+                        mesures.ajouter('resolution_ia', time.perf_counter() - debut, resultat['sous_categorie'] != 'Erreur IA')
+    return len(restants)
+
+
+# --- 5. Rapport ---
+def percentile(valeurs_triees, p):
+    if not valeurs_triees:
+        return None
+    return valeurs_triees[min(len(valeurs_triees) - 1, max(0, round(p / 100 * len(valeurs_triees)) - 1))]
+
+
+def resumer(durees, erreurs, duree_totale):
+    triees = sorted(durees)
+    ms = lambda valeur: round(valeur * 1000, 2) if valeur is not None else None
+    return {
+        'requetes': len(triees),
+        'erreurs': erreurs,
+        'debit_par_s': round(len(triees) / duree_totale, 2) if duree_totale else None,
+        'moyenne_ms': ms(sum(triees) / len(triees)) if triees else None,
+        'p50_ms': ms(percentile(triees, 50)),
+        'p95_ms': ms(percentile(triees, 95)),
+        'p99_ms': ms(percentile(triees, 99)),
+        'max_ms': ms(triees[-1]) if triees else None,
+    }
+
+
+def version_git():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparer(fichier_avant, fichier_apres):
+    avant, apres = (json.load(open(fichier)) for fichier in (fichier_avant, fichier_apres))
+    print(f"{'':32} {'p50 ms':>18} {'p95 ms':>18} {'p99 ms':>18} {'req/s':>16}")
+    for section in ('endpoints', 'niveaux'):
+        for nom in sorted(set(avant[section]) | set(apres[section])):
+            a, b = avant[section].get(nom, {}), apres[section].get(nom, {})
+            colonnes = []
+            for cle in ('p50_ms', 'p95_ms', 'p99_ms', 'debit_par_s'):
+                va, vb = a.get(cle), b.get(cle)
+                delta = f"{(vb - va) / va:+.0%}" if va and vb is not None else ''
+                colonnes.append(f"{va if va is not None else '-':>7} → {vb if vb is not None else '-':<7}{delta:>5}")
+            print(f"{nom[:32]:32} " + ' '.join(colonnes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', help="API déjà lancée (sinon gunicorn est démarré par le banc)")
+    parser.add_argument('--port-api', type=int, default=5055)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--gevent', action='store_true', help="workers gevent (GUNICORN_MODE=gevent)")
+    parser.add_argument('--port-gemini', type=int, default=5056)
+    parser.add_argument('--latence-gemini-ms', type=float, default=800)
+    parser.add_argument('--taux-erreur-gemini', type=float, default=0.02)
+    parser.add_argument('--taux-a-verifier', type=float, default=0.1)
+    parser.add_argument('--utilisateurs', type=int, default=10)
+    parser.add_argument('--regles', type=int, default=1000, help="règles générales semées")
+    parser.add_argument('--regles-perso', type=int, default=20, help="règles personnelles par utilisateur")
+    parser.add_argument('--part-perso', type=float, default=0.3, help="part des libellés couverts par une règle perso")
+    parser.add_argument('--part-generale', type=float, default=0.5, help="part des libellés couverts par une règle générale")
+    parser.add_argument('--concurrence', type=int, default=8)
+    parser.add_argument('--duree', type=float, default=30, help="secondes de charge")
+    parser.add_argument('--poids-login', type=float, default=1)
+    parser.add_argument('--poids-ajout', type=float, default=4)
+    parser.add_argument('--poids-categorize', type=float, default=2)
+    parser.add_argument('--poids-liste', type=float, default=3)
+    parser.add_argument('--poids-budget', type=float, default=1)
+    parser.add_argument('--limite-liste', type=int, default=500)
+    parser.add_argument('--transactions-budget', type=int, default=200)
+    parser.add_argument('--attente-ia', type=float, default=120, help="délai max pour mesurer la résolution des libellés en file IA")
+    parser.add_argument('--graine', type=int, default=42)
+    parser.add_argument('--sortie', default='bench_resultats.json')
+    parser.add_argument('--verbeux', action='store_true')
+    parser.add_argument('--comparer', nargs=2, metavar=('AVANT', 'APRES'))
+    args = parser.parse_args()
+
+    if args.comparer:
+        comparer(*args.comparer)
+        return
+    if not os.environ.get('DATABASE_URL'):
+        sys.exit("DATABASE_URL doit pointer vers la base Postgres locale du banc.")
+
+    random.seed(args.graine)
+    identifiant = f"{datetime.now():%Y%m%d%H%M%S}-{uuid.uuid4().hex[:6]}"
+    serveur_gemini = demarrer_faux_gemini(args.port_gemini, args.latence_gemini_ms, args.taux_erreur_gemini, args.taux_a_verifier)
+    processus_api, url = (None, args.url) if args.url else demarrer_api(args)
+    try:
+        print("Semis des données...")
+        comptes = semer(args, url, identifiant)
+        print(f"{len(comptes)} utilisateur(s), {args.regles} règle(s) générale(s), {args.regles_perso} règle(s) perso / utilisateur")
+        mesures = Mesures()
+        print(f"Charge : {args.concurrence} client(s) concurrent(s) pendant {args.duree}s...")
+        duree_totale = executer_scenario(args, url, comptes, mesures)
+        print(f"Attente de la file IA ({len(mesures.en_attente_ia)} libellé(s))...")
+        non_resolus = attendre_resolutions_ia(url, mesures, args.attente_ia)
+        # Même jeton que l'API (METRIQUES_TOKEN) ; sans jeton, /metrics n'est servi qu'en local
+        jeton = os.environ.get('METRIQUES_TOKEN')
+        entetes = {'Authorization': f"Bearer {jeton}"} if jeton else {}
+        reponse_metriques = requests.get(f"{url}/metrics", headers=entetes, timeout=10)
+        metriques = reponse_metriques.text if reponse_metriques.ok else None
+    finally:
+        if processus_api:
+            processus_api.terminate()
+            processus_api.wait()
+        serveur_gemini.shutdown()
+
+    resultats = {
+        'commit': version_git(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'parametres': {cle: valeur for cle, valeur in vars(args).items() if cle not in ('comparer', 'verbeux')},
+        'duree_s': round(duree_totale, 2),
+        'endpoints': {nom: resumer(mesures.durees.get(nom, []), mesures.erreurs.get(nom, 0), duree_totale) for nom in ENDPOINTS},
+        'niveaux': {cle.split(':', 1)[1]: resumer(durees, 0, duree_totale) for cle, durees in mesures.durees.items() if cle.startswith('niveau:')},
+        'resolution_ia': {**resumer(mesures.durees.get('resolution_ia', []), mesures.erreurs.get('resolution_ia', 0), None),
+                          'non_resolus': non_resolus},
+        'faux_gemini': dict(FauxGemini.compteurs),
+        'metrics_api': metriques,
+    }
+    with open(args.sortie, 'w', encoding='utf-8') as fichier:
+        json.dump(resultats, fichier, ensure_ascii=False, indent=2)
+
+    print(f"\n{'':24} {'req':>7} {'err':>5} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for section in ('endpoints', 'niveaux'):
+        for nom, r in resultats[section].items():
+            print(f"{nom[:24]:24} {r['requetes']:>7} {r['erreurs']:>5} {r['debit_par_s'] or 0:>8} "
+                  f"{r['p50_ms'] or '-':>9} {r['p95_ms'] or '-':>9} {r['p99_ms'] or '-':>9}")
+    r = resultats['resolution_ia']
+    print(f"{'resolution_ia':24} {r['requetes']:>7} {r['erreurs']:>5} {'':>8} {r['p50_ms'] or '-':>9} {r['p95_ms'] or '-':>9} {r['p99_ms'] or '-':>9}")
+    print(f"\nRésultats enregistrés dans {args.sortie}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,10 @@
+# Configuration gunicorn (lue automatiquement au lancement de `gunicorn app:app` depuis ce dossier).
+# Les options passées en ligne de commande restent prioritaires.
+import os
+
+# GUNICORN_MODE=gevent : chaque worker sert des centaines de requêtes en vol (long-poll /api/classifications,
+# attentes Postgres) ; gunicorn applique le monkey-patching gevent avant d'importer app.py, qui branche alors
+# psycopg2 sur la boucle (voir attendre_gevent). Par défaut : workers synchrones, comme avant.
+if os.environ.get('GUNICORN_MODE') == 'gevent':
+    worker_class = 'gevent'
+    worker_connections = int(os.environ.get('GEVENT_CONNEXIONS', 500))
@@ -45,6 +45,9 @@ const modalCancelBtn = document.getElementById('modal-cancel-btn');
 // --- 3. MÉMOIRE LOCALE ---
 let userToken = null; 
 let transactionsNettoyees = [];
+let jetonSynchro = null; // dernier jeton de /api/transactions/changes
+let cleSynchro = null; // copie locale (localStorage, par utilisateur) des transactions : une reconnexion ne télécharge que le delta
+const CHAMPS_COPIE_LOCALE = ['id', 'date', 'libelle', 'libelle_nettoye', 'montant', 'categorie', 'sous_categorie', 'methode', 'updated_at'];
 let currentBudget = {}; 
 let txIdEnCoursDeCategorisation = null; 
 
@@ -70,13 +73,68 @@ async function fetchSecure(url, options = {}) {
     return text ? JSON.parse(text) : {};
 }
 
-// 🆕 Charger les transactions depuis le serveur
+// 🆕 Synchroniser les transactions : seules les modifications depuis le dernier jeton sont téléchargées
 async function loadTransactions() {
-    const data = await fetchSecure('/api/transactions', { method: 'GET' });
-    if (data) {
-        transactionsNettoyees = data;
-        displayTransactions(transactionsNettoyees);
+    const parId = new Map(transactionsNettoyees.map(tx => [tx.id, tx]));
+    let complet = false;
+    while (!complet) {
+        const url = jetonSynchro ? `/api/transactions/changes?since=${encodeURIComponent(jetonSynchro)}` : '/api/transactions/changes';
+        const response = await fetch(url, { headers: { 'Authorization': `Bearer ${userToken}` } });
+        if (response.status === 401) {
+            handleLogout();
+            return;
+        }
+        if (response.status === 410) {
+            // Jeton inconnu du serveur : on repart d'une copie vide
+            jetonSynchro = null;
+            parId.clear();
+            continue;
+        }
+        if (!response.ok) {
+            console.error(`Erreur ${response.status} de l'API ${url}:`, await response.text());
+            return;
+        }
+        const data = await response.json();
+        data.modifications.forEach(tx => parId.set(tx.id, tx));
+        data.suppressions.forEach(id => parId.delete(id));
+        jetonSynchro = data.jeton;
+        complet = data.complet;
     }
+    transactionsNettoyees = [...parId.values()].sort((a, b) => a.date.localeCompare(b.date) || Number(a.id) - Number(b.id));
+    sauvegarderCopieLocale();
+    displayTransactions(transactionsNettoyees);
+    attendreClassificationsIA();
+}
+
+function restaurerCopieLocale(email) {
+    cleSynchro = `copilote_synchro_${email}`;
+    try {
+        const copie = JSON.parse(localStorage.getItem(cleSynchro));
+        if (copie && copie.jeton && Array.isArray(copie.lignes)) {
+            jetonSynchro = copie.jeton;
+            transactionsNettoyees = copie.lignes.map(ligne => Object.fromEntries(CHAMPS_COPIE_LOCALE.map((champ, i) => [champ, ligne[i]])));
+        }
+    } catch (e) { console.error("Copie locale illisible", e); }
+}
+
+function sauvegarderCopieLocale() {
+    if (!cleSynchro) return;
+    try {
+        // Instantané compact : une ligne (tableau) par transaction, les noms de champs ne sont pas répétés
+        const lignes = transactionsNettoyees.map(tx => CHAMPS_COPIE_LOCALE.map(champ => tx[champ]));
+        localStorage.setItem(cleSynchro, JSON.stringify({ jeton: jetonSynchro, lignes }));
+    } catch (e) {
+        // Quota dépassé : pas de copie partielle ou périmée, la prochaine session repartira de zéro
+        console.error("Copie locale non enregistrée", e);
+        supprimerCopieLocale();
+    }
+}
+
+function supprimerCopieLocale() {
+    if (!cleSynchro) return;
+    try {
+        localStorage.removeItem(cleSynchro);
+    } catch (e) { console.error("Copie locale non supprimée", e); }
 }
 
 // 🆕 Ajouter une transaction sur le serveur
@@ -88,6 +146,41 @@ async function addTransaction(transaction) {
     return data;
 }
 
+// 🆕 Attendre les catégories calculées en arrière-plan par l'IA : sondage avec backoff côté client
+// (le serveur ne fait patienter la requête, via wait, que s'il tourne en mode coopératif)
+async function attendreClassificationsIA() {
+    let delai = 2000;
+    for (let essai = 0; essai < 10; essai++) {
+        const enAttente = transactionsNettoyees.filter(tx => tx && tx.methode === 'IA (En attente)');
+        if (enAttente.length === 0 || !userToken) return;
+        const params = new URLSearchParams({ wait: 20 });
+        [...new Set(enAttente.map(tx => tx.libelle.toUpperCase()))].forEach(l => params.append('libelle', l));
+        const debut = Date.now();
+        const resultats = await fetchSecure(`/api/classifications?${params}`, { method: 'GET' });
+        if (!resultats) return;
+        const termines = resultats.filter(r => r.statut === 'TERMINE');
+        for (const res of termines) {
+            for (const tx of enAttente.filter(tx => tx.methode === 'IA (En attente)' && tx.libelle.toUpperCase() === res.libelle)) {
+                Object.assign(tx, {
+                    libelle_nettoye: res.libelle_nettoye, categorie: res.categorie,
+                    sous_categorie: res.sous_categorie, methode: res.methode
+                });
+            }
+        }
+        if (termines.length > 0) {
+            displayTransactions(transactionsNettoyees);
+            if (currentBudget.reste_a_vivre_total !== undefined) {
+                updateDashboardRealTime();
+            }
+        }
+        if (Date.now() - debut < 1000) {
+            // Réponse immédiate (pas de long-poll) : on espace les sondages
+            await new Promise(resolve => setTimeout(resolve, delai));
+            delai = Math.min(delai * 2, 30000);
+        }
+    }
+}
+
 async function fetchCategorizedTransaction(transaction) {
     return await fetchSecure('/api/categorize', {
         method: 'POST',
@@ -150,26 +243,26 @@ function displayBudgetProposal(proposal) {
     newTransactionForm.style.display = 'block'; 
 }
 
-function updateDashboardRealTime(newTransaction) {
-    if (newTransaction && newTransaction.montant < 0) {
-        const categorie = newTransaction.categorie;
-        const montant = Math.abs(newTransaction.montant);
-        
-        const enveloppe = currentBudget.enveloppes_proposees.find(env => env.categorie === categorie);
-        if (enveloppe) {
-            enveloppe.montant_restant -= montant;
-            const envElement = document.getElementById(`env-restant-${categorie}`);
-            if (envElement) {
-                envElement.innerText = enveloppe.montant_restant.toFixed(2);
-            }
+// Les restants sont tenus à jour côté serveur (triggers sur les transactions) :
+// on relit simplement les valeurs au lieu de les décrémenter localement.
+async function updateDashboardRealTime() {
+    const restants = await fetchSecure('/api/budget/restants', { method: 'GET' });
+    if (!restants) return;
+
+    for (const enveloppe of currentBudget.enveloppes_proposees || []) {
+        if (restants.enveloppes[enveloppe.categorie] === undefined) continue;
+        enveloppe.montant_restant = restants.enveloppes[enveloppe.categorie];
+        const envElement = document.getElementById(`env-restant-${enveloppe.categorie}`);
+        if (envElement) {
+            envElement.innerText = enveloppe.montant_restant.toFixed(2);
         }
-        
-        currentBudget.reste_a_vivre_total -= montant;
-        currentBudget.reste_a_vivre_jour = currentBudget.reste_a_vivre_total / 30;
-        
-        resteTotalText.innerText = `${currentBudget.reste_a_vivre_total.toFixed(2)} €`;
-        resteJourText.innerText = `soit ${currentBudget.reste_a_vivre_jour.toFixed(2)} € par jour`;
     }
+
+    currentBudget.reste_a_vivre_total = restants.reste_a_vivre_total;
+    currentBudget.reste_a_vivre_jour = restants.reste_a_vivre_jour;
+
+    resteTotalText.innerText = `${currentBudget.reste_a_vivre_total.toFixed(2)} €`;
+    resteJourText.innerText = `soit ${currentBudget.reste_a_vivre_jour.toFixed(2)} € par jour`;
 }
 
 // --- 6. LOGIQUE DES BOUTONS ET ACTIONS ---
@@ -249,7 +342,8 @@ loginBtn.addEventListener('click', async () => {
             loginView.style.display = 'none';
             dashboardView.style.display = 'block';
             
-            // 🆕 Charger les transactions de l'utilisateur
+            // 🆕 Charger les transactions de l'utilisateur (copie locale + modifications depuis la dernière visite)
+            restaurerCopieLocale(email);
             await loadTransactions();
 
             // 🆕 Charger le budget existant s'il y en a un
@@ -288,6 +382,8 @@ loginBtn.addEventListener('click', async () => {
 function handleLogout() {
     userToken = null;
     transactionsNettoyees = [];
+    jetonSynchro = null;
+    cleSynchro = null;
     currentBudget = {};
     loginView.style.display = 'block';
     dashboardView.style.display = 'none';
@@ -302,7 +398,13 @@ function handleLogout() {
     transactionsList.innerHTML = '';
 }
 
-logoutBtn.addEventListener('click', handleLogout);
+// Déconnexion explicite : la copie locale n'est effacée que si l'utilisateur le demande (appareil partagé)
+logoutBtn.addEventListener('click', () => {
+    if (confirm("Effacer aussi les transactions enregistrées sur cet appareil ?")) {
+        supprimerCopieLocale();
+    }
+    handleLogout();
+});
 
 // Clic sur "Catégoriser ?" (Modale)
 transactionsList.addEventListener('click', (event) => {
@@ -329,10 +431,6 @@ async function onCategorieSelectionnee(nouvelleCategorie) {
     txNettoyee.methode = "Utilisateur";
     displayTransactions(transactionsNettoyees);
     
-    if (currentBudget.reste_a_vivre_total !== undefined) {
-         updateDashboardRealTime(txNettoyee);
-    }
-    
     // 2. Mise à jour BASE DE DONNÉES (La transaction précise) -> C'est ça qui manquait !
     try {
         await fetchSecure(`/api/transactions/${txNettoyee.id}`, {
@@ -343,13 +441,23 @@ async function onCategorieSelectionnee(nouvelleCategorie) {
         });
     } catch (e) { console.error("Erreur sauvegarde transaction", e); }
 
-    // 3. Apprentissage (La règle générale)
+    if (currentBudget.reste_a_vivre_total !== undefined) {
+         updateDashboardRealTime();
+    }
+
+    // 3. Apprentissage (La règle) + reclassement des transactions existantes qui correspondent
     if (motCle) {
         try {
-            await fetchSecure('/api/learn_rule', {
+            const resultat = await fetchSecure('/api/learn_rule', {
                 method: 'POST',
-                body: JSON.stringify({ 'mot_cle': motCle, 'categorie': nouvelleCategorie })
+                body: JSON.stringify({ 'mot_cle': motCle, 'categorie': nouvelleCategorie, 'retroactif': true })
             });
+            if (resultat && resultat.reclassees > 0) {
+                await loadTransactions();
+                if (currentBudget.reste_a_vivre_total !== undefined) {
+                    updateDashboardRealTime();
+                }
+            }
         } catch (error) { console.error("Erreur apprentissage", error); }
     }
     
@@ -389,13 +497,8 @@ analyzeBudgetButton.addEventListener('click', async () => {
     }
     const objectifEpargne = parseFloat(savingsGoalInput.value) || 0;
     try {
-        const payload = {
-            transactions: transactionsNettoyees,
-            objectif: objectifEpargne
-        };
-        const budgetProposal = await fetchSecure('/api/create_budget', {
-            method: 'POST',
-            body: JSON.stringify(payload)
+        const budgetProposal = await fetchSecure(`/api/budget/proposition?objectif=${objectifEpargne}`, {
+            method: 'GET'
         });
         
         if (budgetProposal) { 
@@ -450,10 +553,12 @@ newTransactionForm.addEventListener('submit', async (event) => {
         displayTransactions(transactionsNettoyees); 
         
         if (currentBudget.reste_a_vivre_total !== undefined) {
-             updateDashboardRealTime(newTxNettoyee); 
+             updateDashboardRealTime(); 
         }
         
-        if (newTxNettoyee.categorie === 'A_VERIFIER') {
+        if (newTxNettoyee.methode === 'IA (En attente)') {
+            attendreClassificationsIA();
+        } else if (newTxNettoyee.categorie === 'A_VERIFIER') {
             alert(`Nouvelle dépense ajoutée ! Veuillez la catégoriser dans la liste.`);
         }
     }
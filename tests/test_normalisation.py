@@ -0,0 +1,26 @@
+import pytest
+
+app = pytest.importorskip('app')
+
+
+@pytest.mark.parametrize('libelle', [
+    'CB CARREFOUR 12/03 LYON',
+    'CB CARREFOUR 12/03 PARIS',
+    'CB CARREFOUR 45.20 EUR',
+])
+def test_dates_et_montants_separent_la_cle(libelle):
+    assert app.normaliser_libelle(libelle) == 'CARREFOUR'
+
+
+@pytest.mark.parametrize('libelle', [
+    'CB CARREFOUR 12/03 LYON',
+    'CB CARREFOUR 45.20 EUR',
+    'DE CARTE FOO',
+    '45.20 EUR',
+    'AB 12 CD',
+    'CAFÉ DE FLORE',
+    'PRLV SEPA EDF 0123456',
+])
+def test_normalisation_idempotente(libelle):
+    cle = app.normaliser_libelle(libelle)
+    assert app.normaliser_libelle(cle) == cle